@@ -0,0 +1,269 @@
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Callable, Dict, List, Optional
+
+from gmail_sync import GmailSync
+from models import SyncResult
+from notifications import NotificationCoalescer
+from state_manager import StateManager
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Account:
+    account_id: str
+    credentials_doc_id: str
+    sync_state_doc_id: str
+    base_path: str
+    label_id: str = 'INBOX'
+    # Address of the mailbox, matching the account to its Gmail notifications
+    email_address: Optional[str] = None
+
+
+def parse_account(index: int, config: Dict) -> Optional[Account]:
+    """
+    Validate an account of the registry.
+
+    An account has an `id` and optionally a `credentialsDocId`, `syncStateDocId` and
+    `basePath`, defaulting to 'google_credentials_{id}', 'last_sync_state_{id}' and the id,
+    so that accounts never share credentials, sync state or files. `labelId` is the label
+    synced, defaulting to 'INBOX', and `emailAddress` the address of the mailbox.
+
+    Returns:
+    Account: The account, or None if it has `enabled` set to false.
+    """
+    try:
+        account_id = config['id']
+        if not isinstance(account_id, str) or not account_id:
+            raise ValueError("`id` must be a non-empty string")
+        if not config.get('enabled', True):
+            return None
+        return Account(
+            account_id=account_id,
+            credentials_doc_id=config.get('credentialsDocId') or f'google_credentials_{account_id}',
+            sync_state_doc_id=config.get('syncStateDocId') or f'last_sync_state_{account_id}',
+            base_path=config.get('basePath', account_id),
+            label_id=config.get('labelId') or 'INBOX',
+            email_address=(config.get('emailAddress') or '').strip().lower() or None,
+        )
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        raise ValueError(f"Invalid account {index}: {str(e)}") from e
+
+
+class AccountRegistry:
+    """Gmail accounts kept in a StateManager document as `{'accounts': [...]}`."""
+
+    def __init__(self, state_store: StateManager, doc_id: str = 'gmail_accounts'):
+        self.__state_store = state_store
+        self.__doc_id = doc_id
+
+    def accounts(self) -> List[Account]:
+        """The enabled accounts, in the order they were registered."""
+        config = self.__state_store.get_documents_by_ids([self.__doc_id])[self.__doc_id] or {}
+        accounts = [parse_account(index, account)
+                    for index, account in enumerate(config.get('accounts', []))]
+        ids = [account.account_id for account in accounts if account]
+        if len(ids) != len(set(ids)):
+            raise ValueError(f"Accounts of `{self.__doc_id}` have duplicate IDs")
+        return [account for account in accounts if account]
+
+    def get(self, account_id: str) -> Optional[Account]:
+        return next((account for account in self.accounts() if account.account_id == account_id), None)
+
+    def find_by_email(self, email_address: str) -> Optional[Account]:
+        email_address = (email_address or '').strip().lower()
+        return next((account for account in self.accounts()
+                     if account.email_address == email_address), None)
+
+    def synced_history_id(self, account: Account) -> int:
+        """History ID the account is synced to, 0 before its first sync."""
+        state = self.__state_store.get_documents_by_ids(
+            [account.sync_state_doc_id])[account.sync_state_doc_id]
+        return int(state['historyId']) if state else 0
+
+    def register(self, config: Dict) -> Account:
+        """
+        Add an account to the registry, or replace the account with the same ID.
+
+        Parameters:
+        - config (Dict): The account, see `parse_account`.
+
+        Returns:
+        Account: The account as parsed.
+        """
+        account = parse_account(0, config)
+
+        def update(registry: Optional[Dict]) -> Dict:
+            accounts = [existing for existing in (registry or {}).get('accounts', [])
+                        if existing.get('id') != config['id']]
+            return {**(registry or {}), 'accounts': accounts + [config]}
+
+        self.__state_store.transact(self.__doc_id, update)
+        return account
+
+
+@dataclass
+class AccountSyncResult:
+    account_id: str
+    result: Optional[SyncResult] = None
+    error: Optional[str] = None
+    # Another sync already covered the history of the notification
+    already_synced: bool = False
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+    def to_dict(self) -> Dict:
+        if self.error is not None:
+            return {'error': self.error}
+        if self.already_synced:
+            return {'already_synced': True}
+        return json.loads(str(self.result))
+
+
+class MultiAccountSync:
+    """
+    Syncs the Gmail accounts of a registry concurrently from one worker.
+
+    Every account is synced by a GmailSync of its own, built by `create_sync` with the
+    credentials, sync state and base path of the account and kept for later syncs. Gmail
+    quota is per user, so each of them should get its own QuotaScheduler: an account being
+    throttled then never slows the others. At most `max_workers` accounts sync at once, and
+    an account failing is logged and reported in the results without stopping the others.
+
+    An account syncs one at a time however many requests ask for it, through a
+    NotificationCoalescer of its own that outlives the GmailSync of the account.
+    """
+
+    def __init__(self,
+                 registry: AccountRegistry,
+                 create_sync: Callable[[Account], GmailSync],
+                 max_workers: int = 4,
+                 debounce_seconds: float = 0.0):
+        """
+        Initialization of MultiAccountSync class.
+
+        Parameters:
+        - registry (AccountRegistry): The accounts to sync.
+        - create_sync (Callable): Builds the GmailSync of an account.
+        - max_workers (int): Accounts synced at once, defaults to 4.
+        - debounce_seconds (float): How long a notification of an account waits for the rest
+          of a burst, see NotificationCoalescer. Defaults to 0.
+        """
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        self.__registry = registry
+        self.__create_sync = create_sync
+        self.__max_workers = max_workers
+        self.__debounce_seconds = debounce_seconds
+        self.__coalescers: Dict[str, NotificationCoalescer] = {}
+        self.__syncs: Dict[str, GmailSync] = {}
+        # Account each GmailSync was built for, so it is rebuilt when the account changes
+        self.__accounts: Dict[str, Account] = {}
+        self.__lock = threading.Lock()
+
+    @property
+    def registry(self) -> AccountRegistry:
+        return self.__registry
+
+    def __get_sync(self, account: Account) -> GmailSync:
+        with self.__lock:
+            if self.__accounts.get(account.account_id) == account:
+                return self.__syncs[account.account_id]
+            # The account syncs one at a time, so the GmailSync replaced is not in use
+            previous = self.__syncs.pop(account.account_id, None)
+            self.__syncs[account.account_id] = self.__create_sync(account)
+            self.__accounts[account.account_id] = account
+            sync = self.__syncs[account.account_id]
+        if previous:
+            previous.close()
+        return sync
+
+    def __get_coalescer(self, account_id: str) -> NotificationCoalescer:
+        with self.__lock:
+            if account_id not in self.__coalescers:
+                self.__coalescers[account_id] = NotificationCoalescer(self.__debounce_seconds)
+            return self.__coalescers[account_id]
+
+    def __evict(self, account_id: str) -> None:
+        with self.__lock:
+            sync = self.__syncs.pop(account_id, None)
+            self.__accounts.pop(account_id, None)
+        if sync:
+            sync.close()
+
+    def sync_account(self,
+                     account: Account,
+                     history_types: List[str] = ["messageAdded", "labelAdded"],
+                     history_id: Optional[int] = None) -> AccountSyncResult:
+        """
+        Sync one account, reporting a failure in the result rather than raising it.
+
+        Parameters:
+        - account (Account): The account to sync.
+        - history_types (List[str]): History types to sync.
+        - history_id (int): History ID announced by a notification of the account, which is
+          not synced again once a sync covered it. Defaults to None to always sync.
+        """
+        def sync():
+            return self.__get_sync(account).sync(label_id=account.label_id,
+                                                 history_types=history_types)
+
+        coalescer = self.__get_coalescer(account.account_id)
+        try:
+            if history_id is None:
+                result = coalescer.run_now(sync)
+            else:
+                result = coalescer.run(
+                    history_id,
+                    sync=sync,
+                    get_synced_history_id=lambda: self.__registry.synced_history_id(account),
+                )
+                if result is None:
+                    return AccountSyncResult(account.account_id, already_synced=True)
+        except Exception as e:
+            logger.error(f"Failed to sync account {account.account_id}: {str(e)}")
+            # Rebuild it on the next sync, e.g. after the credentials were revoked
+            self.__evict(account.account_id)
+            return AccountSyncResult(account.account_id, error=str(e))
+        if result is None:
+            return AccountSyncResult(account.account_id, error="Failed to fetch Gmail history")
+        return AccountSyncResult(account.account_id, result=result)
+
+    def sync_all(self,
+                 history_types: List[str] = ["messageAdded", "labelAdded"],
+                 account_ids: Optional[List[str]] = None,
+                 history_id: Optional[int] = None) -> List[AccountSyncResult]:
+        """
+        Sync the accounts of the registry on a pool of at most `max_workers` threads.
+
+        Parameters:
+        - history_types (List[str]): History types to sync.
+        - account_ids (List[str]): Only sync these accounts, defaults to None for all of them.
+        - history_id (int): History ID of the notification the sync is for, see `sync_account`.
+
+        Returns:
+        List[AccountSyncResult]: The result of every account synced, in registry order.
+        """
+        accounts = self.__registry.accounts()
+        if account_ids is not None:
+            accounts = [account for account in accounts if account.account_id in account_ids]
+        if not accounts:
+            return []
+
+        logger.info(f"Syncing {len(accounts)} Gmail accounts")
+        with ThreadPoolExecutor(max_workers=min(self.__max_workers, len(accounts))) as executor:
+            results = list(executor.map(partial(self.sync_account, history_types=history_types,
+                                                history_id=history_id),
+                                        accounts))
+        failed = [r.account_id for r in results if not r.succeeded]
+        if failed:
+            logger.warning(f"Failed to sync {len(failed)} of {len(results)} accounts: {failed}")
+        return results
@@ -0,0 +1,268 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+
+import aiohttp
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+from gmail_sync import attachment_metadata, extract_attachment_info, get_save_path, parse_message
+from models import Attachment, HistoryPage, Message
+from routing import Router
+from state_manager import AsyncStateManager, SyncState
+from storage_manager import AsyncStorageManager
+
+
+logger = logging.getLogger(__name__)
+
+
+GMAIL_API_URL = 'https://gmail.googleapis.com/gmail/v1/users/me'
+
+
+class GmailApiError(RuntimeError):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"Gmail API returned {status}: {message}")
+        self.status = status
+
+
+class AsyncGmailClient:
+    """Gmail REST client on aiohttp covering the calls made by AsyncGmailSync."""
+
+    def __init__(self,
+                 credentials: Optional[Credentials] = None,
+                 base_url: str = GMAIL_API_URL,
+                 connection_limit: int = 100):
+        """
+        Initialization of AsyncGmailClient class.
+
+        Parameters:
+        - credentials (Credentials): OAuth credentials of the mailbox, defaults to None
+          which sends unauthenticated requests, e.g. to a local fake server.
+        - base_url (str): URL of the Gmail user resource, defaults to the public API.
+        - connection_limit (int): Maximum number of open connections, defaults to 100.
+        """
+        self.__credentials = credentials
+        self.__base_url = base_url.rstrip('/')
+        self.__connection_limit = connection_limit
+        self.__session: Optional[aiohttp.ClientSession] = None
+        self.__refresh_lock = asyncio.Lock()
+
+    async def __aenter__(self) -> 'AsyncGmailClient':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        if self.__session:
+            await self.__session.close()
+            self.__session = None
+
+    async def __auth_headers(self) -> Dict[str, str]:
+        if not self.__credentials:
+            return {}
+        if not self.__credentials.valid:
+            async with self.__refresh_lock:
+                if not self.__credentials.valid:
+                    await asyncio.to_thread(self.__credentials.refresh, Request())
+        return {'Authorization': f'Bearer {self.__credentials.token}'}
+
+    async def __get(self, path: str, params: Optional[List] = None) -> Dict:
+        if not self.__session:
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.__connection_limit)
+            )
+        async with self.__session.get(f"{self.__base_url}/{path}", params=params or [],
+                                      headers=await self.__auth_headers()) as resp:
+            if resp.status >= 400:
+                raise GmailApiError(resp.status, await resp.text())
+            return await resp.json(content_type=None)
+
+    async def list_history(self,
+                           start_history_id: str,
+                           label_id: Optional[str] = None,
+                           history_types: Optional[List[str]] = None,
+                           page_token: Optional[str] = None) -> Dict:
+        params = [('startHistoryId', start_history_id)]
+        if label_id:
+            params.append(('labelId', label_id))
+        params.extend(('historyTypes', history_type) for history_type in history_types or [])
+        if page_token:
+            params.append(('pageToken', page_token))
+        return await self.__get('history', params)
+
+    async def get_message(self, msg_id: str) -> Dict:
+        return await self.__get(f'messages/{msg_id}')
+
+    async def get_attachment(self, msg_id: str, attachment_id: str) -> Dict:
+        return await self.__get(f'messages/{msg_id}/attachments/{attachment_id}')
+
+
+class AsyncGmailSync:
+    def __init__(self,
+                 state_store: AsyncStateManager,
+                 storage: AsyncStorageManager,
+                 gmail_client: AsyncGmailClient,
+                 base_path: str = '',
+                 sync_state_doc_id: str = 'last_sync_state',
+                 concurrency: int = 100,
+                 router: Optional[Router] = None):
+        """
+        Initialization of AsyncGmailSync class.
+
+        Parameters:
+        - state_store (AsyncStateManager): An instance of AsyncStateManager to manage states.
+        - storage (AsyncStorageManager): An instance of AsyncStorageManager to manage storage.
+        - gmail_client (AsyncGmailClient): An instance of AsyncGmailClient.
+        - base_path (str): The base path, defaults to an empty string.
+        - sync_state_doc_id (str): Document ID of sync state, defaults to 'last_sync_state'.
+        - concurrency (int): Maximum number of Gmail and storage calls in flight,
+          defaults to 100.
+        - router (Router): Routes attachments to save paths, defaults to the built-in rules.
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+
+        self.__state_store = state_store
+        self.__storage = storage
+        self.__gmail = gmail_client
+        self.__base_path = base_path.strip('/')
+        self.__sync_state_doc_id = sync_state_doc_id
+        self.__concurrency = concurrency
+        self.__router = router
+        self.__semaphore: Optional[asyncio.Semaphore] = None
+        self.__semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def __limit(self, coro):
+        """Await `coro` once fewer than `concurrency` calls are in flight."""
+        # Created on first use so the semaphore belongs to the running event loop
+        loop = asyncio.get_running_loop()
+        if self.__semaphore_loop is not loop:
+            self.__semaphore = asyncio.Semaphore(self.__concurrency)
+            self.__semaphore_loop = loop
+        async with self.__semaphore:
+            return await coro
+
+    async def __get_last_sync_state(self) -> SyncState:
+        last_state = await self.__state_store.get_document_by_id(self.__sync_state_doc_id)
+        return SyncState(
+            historyId=last_state['historyId'],
+            updatedTime=last_state.get('updatedTime'),
+            pageToken=last_state.get('pageToken'),
+        )
+
+    async def __save_history_id(self, history_id: str, page_token: Optional[str] = None):
+        ts = datetime.now()
+        sync_state = SyncState(historyId=history_id, updatedTime=int(ts.strftime('%s')),
+                               pageToken=page_token)
+        return await self.__state_store.set_document_by_id(
+            id=self.__sync_state_doc_id,
+            data={k: v for k, v in vars(sync_state).items() if v is not None}
+        )
+
+    async def __iter_history_pages(self,
+                                   start_history_id: str,
+                                   label_id: str,
+                                   history_types: List[str],
+                                   page_token: Optional[str] = None
+                                   ) -> AsyncIterator[HistoryPage]:
+        while True:
+            history_resp = await self.__limit(self.__gmail.list_history(
+                start_history_id, label_id, history_types, page_token
+            ))
+
+            msg_ids = {}
+            for entry in history_resp.get('history', []):
+                for message_resp in entry.get('messages', []):
+                    msg_ids[message_resp['id']] = None
+
+            page_token = history_resp.get('nextPageToken')
+            yield HistoryPage(
+                msg_ids=list(msg_ids),
+                history_id=history_resp.get('historyId'),
+                next_page_token=page_token,
+            )
+            if not page_token:
+                return
+
+    async def __download_attachment(self, msg_id: str, attachment: Dict) -> Attachment:
+        attachment_resp = await self.__limit(
+            self.__gmail.get_attachment(msg_id, attachment['attachmentId'])
+        )
+        return Attachment(
+            id=attachment['attachmentId'],
+            filename=attachment['filename'],
+            mime_type=attachment['mimeType'],
+            encoded_data=attachment_resp.get('data'),
+            part_id=attachment['partId'],
+        )
+
+    async def get_message(self, msg_id: str) -> Message:
+        message_resp = await self.__limit(self.__gmail.get_message(msg_id))
+        attachments = await asyncio.gather(*(
+            self.__download_attachment(msg_id, attachment)
+            for attachment in extract_attachment_info(message_resp)
+        ))
+        return parse_message(msg_id, message_resp, list(attachments))
+
+    async def __save_attachment(self, msg: Message, attachment: Attachment) -> None:
+        save_path = get_save_path(msg.from_address.lower(), msg.subject, attachment.filename,
+                                  router=self.__router)
+        destination = f"{self.__base_path}/{save_path}"
+        await self.__limit(self.__storage.put_stream(
+            key=destination,
+            stream=attachment.iter_data(),
+            metadata=attachment_metadata(msg, attachment),
+        ))
+        logger.info(f"File '{attachment.filename}' saved at '{destination}'")
+
+    async def __process_message(self, msg_id: str) -> None:
+        try:
+            msg = await self.get_message(msg_id)
+            await asyncio.gather(*(
+                self.__save_attachment(msg, attachment) for attachment in msg.attachments
+            ))
+        except Exception as e:
+            logger.error(f"Failed to process message {msg_id}: {str(e)}")
+
+    async def sync(self,
+                   label_id: str = 'INBOX',
+                   history_types: List[str] = ["messageAdded", "labelAdded"],
+                   start_history_id: str = None) -> str:
+        page_token = None
+        if not start_history_id:
+            last_state = await self.__get_last_sync_state()
+            start_history_id, page_token = last_state.historyId, last_state.pageToken
+
+        logger.info(f"Syncing Gmail from {start_history_id} with "
+                    + f"label_id={label_id}, history_types={history_types}"
+                    + (f", resuming from page {page_token}" if page_token else ""))
+
+        pages = self.__iter_history_pages(start_history_id, label_id, history_types, page_token)
+        has_history = bool(page_token)
+        next_history_id = None
+        while True:
+            try:
+                page = await anext(pages, None)
+            except Exception as e:
+                logger.error(f"Failed to fetch Gmail history: {str(e)}")
+                return
+            if not page:
+                break
+
+            next_history_id = page.history_id
+            if page.msg_ids:
+                has_history = True
+                await asyncio.gather(*(self.__process_message(msg_id) for msg_id in page.msg_ids))
+            if page.next_page_token:
+                # Checkpoint so an interrupted walk resumes from the next page
+                has_history = True
+                await self.__save_history_id(start_history_id, page_token=page.next_page_token)
+
+        if has_history:
+            await self.__save_history_id(next_history_id)
+            return "{ \"history_id\": \"" + next_history_id + "\"}"
+        else:
+            logger.info("Data is already up-to-date")
+            return "Data is already up-to-date"
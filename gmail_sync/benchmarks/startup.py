@@ -0,0 +1,198 @@
+"""
+Cold start benchmark of the Cloud Function entry points in main.py.
+
+Every run starts a fresh interpreter and measures how long `import main` takes and how
+long it takes from the start of that import until one handler answers its first request.
+Firestore and GCS are replaced through the client registry and Google HTTP endpoints
+are answered in-process, so only local work is measured.
+
+Usage, from the gmail_sync directory:
+
+    python -m benchmarks.startup --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ENTRY_POINTS = [
+    'download_attachments_handler',
+    'callback_handler',
+    'refresh_token_handler',
+    'renew_watch_handler',
+]
+
+CREDENTIALS = {
+    'token': 'fake-token',
+    'refresh_token': 'fake-refresh-token',
+    'client_id': 'fake-client-id',
+    'client_secret': 'fake-client-secret',
+    'token_uri': 'https://oauth2.googleapis.com/token',
+}
+
+
+class FakeStateStore:
+    def __init__(self):
+        self.documents = {
+            'google_credentials': dict(CREDENTIALS),
+            'last_sync_state': {'historyId': '1', 'updatedTime': 0},
+        }
+
+    def get_document_by_id(self, id, use_cache=True):
+        return self.documents[id]
+
+    def set_document_by_id(self, id, data):
+        self.documents[id] = data
+        return 'OK'
+
+
+class FakeStorage:
+    def put(self, key, data, metadata=None, content_type=None):
+        pass
+
+    def put_stream(self, key, stream, metadata=None, chunk_size=None):
+        pass
+
+    def get(self, key):
+        raise RuntimeError(f"No data found for key: {key}")
+
+
+class FakeReportingClient:
+    def __init__(self):
+        self.errors = []
+
+    def report_exception(self):
+        import traceback
+        self.errors.append(traceback.format_exc())
+
+
+class FakeRequest:
+    args = {'code': 'fake-code'}
+
+    def get_json(self, silent=False):
+        return None
+
+
+def fake_response(uri: str) -> bytes:
+    if uri.startswith(CREDENTIALS['token_uri']):
+        content = {
+            'access_token': 'fake-token',
+            'expires_in': 3600,
+            'token_type': 'Bearer',
+            'scope': 'https://www.googleapis.com/auth/gmail.readonly',
+        }
+    elif '/watch' in uri:
+        content = {'historyId': '1', 'expiration': '0'}
+    else:
+        content = {'historyId': '1'}
+    return json.dumps(content).encode()
+
+
+def fake_http_responses():
+    """Answer Google API and OAuth token calls without touching the network."""
+    from unittest.mock import patch
+
+    import httplib2
+    import requests
+
+    def httplib2_request(self, uri, method='GET', *args, **kwargs):
+        return httplib2.Response({'status': '200'}), fake_response(uri)
+
+    def requests_request(self, method, url, *args, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.request = requests.Request(method, url).prepare()
+        response.headers['Content-Type'] = 'application/json'
+        response._content = fake_response(url)
+        return response
+
+    return [
+        patch('httplib2.Http.request', httplib2_request),
+        patch('requests.Session.request', requests_request),
+    ]
+
+
+def run_child(entry_point: str, measure_response: bool) -> dict:
+    patches = fake_http_responses() if measure_response else []
+    for p in patches:
+        p.start()
+    # Patching preloads httplib2 and requests, which every handler needs anyway
+    started = time.perf_counter()
+    import main
+    imported = time.perf_counter()
+    result = {'entry_point': entry_point, 'import_s': imported - started}
+    if measure_response:
+        reporting_client = FakeReportingClient()
+        main._clients['error_reporting'] = reporting_client
+        main._clients['state_store'] = FakeStateStore()
+        main._clients['storage'] = FakeStorage()
+        getattr(main, entry_point)(FakeRequest())
+        result['first_response_s'] = time.perf_counter() - started
+        result['errors'] = reporting_client.errors
+    return result
+
+
+def run(entry_point: str, measure_response: bool) -> dict:
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as secrets:
+        json.dump({'web': {
+            'client_id': CREDENTIALS['client_id'],
+            'client_secret': CREDENTIALS['client_secret'],
+            'auth_uri': 'https://accounts.google.com/o/oauth2/auth',
+            'token_uri': CREDENTIALS['token_uri'],
+        }}, secrets)
+        secrets.flush()
+        env = dict(
+            os.environ,
+            LOG_LEVEL='ERROR',
+            GOOGLE_CLIENT_SECRETS_FILE=secrets.name,
+            GOOGLE_OAUTH_SCOPES='https://www.googleapis.com/auth/gmail.readonly',
+            GMAIL_LABEL_ID='INBOX',
+            GMAIL_HISTORY_TYPES='messageAdded',
+            SYNC_STATE_DOCUMENT_ID='last_sync_state',
+            DESTINATION_BASE_PATH='benchmark',
+        )
+        with tempfile.TemporaryDirectory() as cwd:
+            # The token cache is written to the working directory
+            env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.getcwd(),
+                                                              env.get('PYTHONPATH')]))
+            args = [sys.executable, '-m', 'benchmarks.startup', '--child', entry_point]
+            if measure_response:
+                args.append('--measure-response')
+            output = subprocess.run(args, env=env, cwd=cwd, check=True,
+                                    capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', choices=ENTRY_POINTS, help=argparse.SUPPRESS)
+    parser.add_argument('--measure-response', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args.child, args.measure_response)))
+        return
+
+    print(f"{'entry point':<32}{'import (ms)':>14}{'first response (ms)':>22}")
+    for entry_point in ENTRY_POINTS:
+        imports = [run(entry_point, False)['import_s'] for _ in range(args.runs)]
+        responses = [run(entry_point, True) for _ in range(args.runs)]
+        failed = sum(bool(r['errors']) for r in responses)
+        for r in responses:
+            for error in r['errors']:
+                print(error, file=sys.stderr)
+        print(f"{entry_point:<32}"
+              f"{statistics.median(imports) * 1000:>14.1f}"
+              f"{statistics.median(r['first_response_s'] for r in responses) * 1000:>22.1f}"
+              + (f"  ({failed} failed)" if failed else ""))
+
+
+if __name__ == '__main__':
+    main()
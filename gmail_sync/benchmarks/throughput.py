@@ -0,0 +1,231 @@
+"""
+End-to-end throughput benchmark of the sync engines against a local fake Gmail API.
+
+A backlog of messages with attachments is served by the fake server from
+tests/fake_gmail_server.py with the configured latency and error rate. Every scenario
+syncs the whole backlog into in-memory state and storage backends in a fresh
+interpreter, so peak RSS is measured per scenario, and reports messages and attachment
+bytes per second, peak RSS and the Gmail API calls it made.
+
+Usage, from the gmail_sync directory:
+
+    python -m benchmarks.throughput --messages 500 --latency 0.02
+
+Results can be saved with --output and compared to a saved run with --baseline, which
+exits with an error when a scenario got slower than --tolerance allows.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+SCENARIOS = {
+    'sequential': {},
+    'threads': {'max_workers': 8},
+    'batched': {'batch_size': 50},
+    'batched-threads': {'batch_size': 50, 'max_workers': 8},
+    'async': {'concurrency': 100},
+    # Only messages a routing rule matches are fetched in full
+    'two-phase': {'batch_size': 50, 'max_workers': 8, 'routed_only': True},
+    'thread-fetch': {'max_workers': 8, 'fetch_threads': True},
+}
+
+
+def build_backlog(messages: int, attachments: int, attachment_size: int, page_size: int,
+                  thread_size: int = 1):
+    from tests.fake_gmail_server import fake_message
+
+    # Every attachment serves the same content, so the fake server stays small
+    data = (bytes(range(256)) * (attachment_size // 256 + 1))[:attachment_size]
+    encoded = base64.urlsafe_b64encode(data).decode()
+    msg_ids = [f'msg{i}' for i in range(messages)]
+    thread_ids = {msg_id: f'thread{i // thread_size}' for i, msg_id in enumerate(msg_ids)}
+    # Every fourth message is a statement the default routing rules match
+    senders = ['statement@centralthe1card.com'] + [f'sender{i}@example.com' for i in range(1, 4)]
+    history_pages = [
+        {'history': [{'messages': [{'id': msg_id, 'threadId': thread_ids[msg_id]}]}
+                     for msg_id in msg_ids[i:i + page_size]],
+         'historyId': str(2 + i // page_size)}
+        for i in range(0, messages, page_size)
+    ] or [{'historyId': '2'}]
+    return {
+        'history_pages': history_pages,
+        'messages': {
+            msg_id: fake_message(msg_id, f'Sender <{senders[i % len(senders)]}>',
+                                 f'Statement ({i % 28 + 1:02d}/01/2024)',
+                                 [f'{msg_id}-att{j}' for j in range(attachments)],
+                                 thread_id=thread_ids[msg_id])
+            for i, msg_id in enumerate(msg_ids)
+        },
+        'attachments': {f'{msg_id}-att{j}': encoded
+                        for msg_id in msg_ids for j in range(attachments)},
+    }
+
+
+class ThreadLocalHttp:
+    """httplib2 transport keeping one connection pool per thread, as it isn't thread-safe."""
+
+    def __init__(self):
+        self.__local = threading.local()
+
+    def request(self, *args, **kwargs):
+        import httplib2
+
+        if not hasattr(self.__local, 'http'):
+            self.__local.http = httplib2.Http()
+        return self.__local.http.request(*args, **kwargs)
+
+
+def build_gmail_client(server_url: str):
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.discovery_cache import get_static_doc
+
+    document = json.loads(get_static_doc('gmail', 'v1'))
+    # Batch requests are sent to the root URL, so it is replaced instead of the endpoint
+    document['rootUrl'] = f'{server_url}/'
+    return build_from_document(document, http=ThreadLocalHttp())
+
+
+def run_sync(scenario: str, server_url: str, storage, quota: float) -> None:
+    from state_manager import InMemoryStateManager
+
+    state_store = InMemoryStateManager({'last_sync_state': {'historyId': '1'}})
+    options = dict(SCENARIOS[scenario])
+    if scenario == 'async':
+        from async_gmail_sync import AsyncGmailClient, AsyncGmailSync
+        from state_manager import ThreadedAsyncStateManager
+        from storage_manager import ThreadedAsyncStorageManager
+
+        async def sync():
+            async with AsyncGmailClient(base_url=f'{server_url}/gmail/v1/users/me') as client:
+                await AsyncGmailSync(ThreadedAsyncStateManager(state_store),
+                                     ThreadedAsyncStorageManager(storage), client,
+                                     **options).sync()
+        asyncio.run(sync())
+    else:
+        from google.auth.credentials import AnonymousCredentials
+        from gmail_sync import GmailSync, MessageFilter
+        from scheduler import QuotaScheduler
+
+        if options.pop('routed_only', False):
+            options['message_filter'] = MessageFilter(routed_only=True)
+        # Retries back off as usual, the pacing is effectively lifted unless a quota is given
+        scheduler = QuotaScheduler(units_per_second=quota or 1e9,
+                                   max_concurrency=options.get('max_workers', 1) * 2)
+        # The fake server needs no authorization, but workers need credentials for their own
+        # transports
+        with GmailSync(state_store=state_store, storage=storage,
+                       gmail_client=build_gmail_client(server_url),
+                       credentials=AnonymousCredentials(), scheduler=scheduler,
+                       **options) as gmail_sync:
+            gmail_sync.sync()
+
+
+def run_child(scenario: str, server_url: str, quota: float) -> dict:
+    from storage_manager import InMemoryStorageManager
+
+    logging.basicConfig(level=logging.CRITICAL)
+    storage = InMemoryStorageManager()
+    started = time.perf_counter()
+    run_sync(scenario, server_url, storage, quota)
+    elapsed = time.perf_counter() - started
+    return {
+        'elapsed_s': elapsed,
+        'attachments_saved': len(storage.objects),
+        'bytes_saved': sum(len(data) for data in storage.objects.values()),
+        # Kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run(scenario: str, server, messages: int, quota: float) -> dict:
+    server.reset()
+    args = [sys.executable, '-m', 'benchmarks.throughput', '--child', scenario,
+            '--server-url', server.url, '--quota', str(quota)]
+    output = subprocess.run(args, check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result.update(
+        scenario=scenario,
+        messages_per_s=messages / result['elapsed_s'],
+        bytes_per_s=result['bytes_saved'] / result['elapsed_s'],
+        api_calls=dict(server.call_counts()),
+    )
+    return result
+
+
+def check_baseline(results: list, baseline_path: str, tolerance: float) -> list:
+    with open(baseline_path) as f:
+        baseline = {r['scenario']: r for r in json.load(f)}
+    return [
+        f"{r['scenario']}: {r['messages_per_s']:.1f} messages/s, "
+        f"baseline {baseline[r['scenario']]['messages_per_s']:.1f}"
+        for r in results
+        if r['scenario'] in baseline
+        and r['messages_per_s'] < baseline[r['scenario']]['messages_per_s'] * (1 - tolerance)
+    ]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--attachments', type=int, default=2, help="Attachments per message")
+    parser.add_argument('--attachment-size', type=int, default=256 * 1024, help="In bytes")
+    parser.add_argument('--page-size', type=int, default=100, help="Messages per history page")
+    parser.add_argument('--thread-size', type=int, default=1, help="Messages per thread")
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds per API call")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Share of message and attachment calls failing with 503")
+    parser.add_argument('--quota', type=float, default=0,
+                        help="Gmail quota units per second, 250 per user, defaults to unlimited")
+    parser.add_argument('--output', help="Save the results as JSON")
+    parser.add_argument('--baseline', help="Compare to results saved with --output")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Allowed drop of messages/s against the baseline")
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--server-url', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        print(json.dumps(run_child(args.child, args.server_url, args.quota)))
+        return
+
+    from tests.fake_gmail_server import FakeGmailServer
+
+    backlog = build_backlog(args.messages, args.attachments, args.attachment_size,
+                            args.page_size, args.thread_size)
+    print(f"{args.messages} messages with {args.attachments} x {args.attachment_size} byte "
+          f"attachments, {args.latency * 1000:.0f} ms latency, {args.error_rate:.0%} errors")
+    print(f"{'scenario':<18}{'msgs/s':>10}{'MB/s':>10}{'saved':>8}{'peak RSS MB':>13}  API calls")
+    results = []
+    with FakeGmailServer(latency=args.latency, error_rate=args.error_rate, **backlog) as server:
+        for scenario in args.scenarios:
+            r = run(scenario, server, args.messages, args.quota)
+            results.append(r)
+            calls = ', '.join(f'{route}={n}' for route, n in sorted(r['api_calls'].items()))
+            print(f"{scenario:<18}{r['messages_per_s']:>10.1f}{r['bytes_per_s'] / 2 ** 20:>10.1f}"
+                  f"{r['attachments_saved']:>8}{r['peak_rss_mb']:>13.1f}  {calls}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        regressions = check_baseline(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
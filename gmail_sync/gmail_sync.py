@@ -1,33 +1,183 @@
 import base64
+import hashlib
 import logging
 import os
+import random
 import re
+import socket
+import threading
 import uuid
-from datetime import datetime
-from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 
+import httplib2
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest, HttpRequest
 
-from state_manager import StateManager, SyncState
-from storage_manager import StorageManager
-from models import Attachment, Message
+from state_manager import StateManager, SyncState, WriteResult
+from storage_manager import PutItem, StorageManager
+from ledger import ProcessedLedger
+from routing import AttachmentFilter, Router
+from instrumentation import Instrumentation
+from scheduler import GMAIL_QUOTA_UNITS, QuotaScheduler, is_retryable
+from models import Attachment, HistoryPage, Message, SyncResult
 
 
 logger = logging.getLogger(__name__)
 
 
+# Gmail rejects batch requests with more than 100 calls
+GMAIL_MAX_BATCH_SIZE = 100
+GMAIL_MAX_LIST_RESULTS = 500
 ADDRESS_PATTERN = re.compile(r'\<([^\>]+)\>')
-EMAIL_PATTERNS = {
-    'statement@centralthe1card.com': {
-        'pattern': re.compile(r'\((?P<dom>\d\d)/(?P<month>\d\d)/(?P<year>\d{4})\)'),
-        'path': 'centralthe1card/statement_date={}/{}'
-    },
-    'statement@firstchoicecard.com': {
-        'pattern': re.compile(r'\((?P<dom>\d\d)/(?P<month>\d\d)/(?P<year>\d{4})\)'),
-        'path': 'firstchoicecard/statement_date={}/{}'
-    },
-}
+DEFAULT_ROUTER = Router()
+# Partial response of a metadata fetch, just enough to filter and route a message
+METADATA_HEADERS = ['From', 'Subject']
+METADATA_FIELDS = 'id,labelIds,sizeEstimate,payload/headers'
+# Metadata fetches are batched even when full fetches are not
+METADATA_BATCH_SIZE = 50
+
+
+def get_save_path(from_addr: str, subject: str, filename: str,
+                  digest: Optional[str] = None,
+                  router: Optional[Router] = None) -> str:
+    """Determine the save path with the routing rules for the sender and subject."""
+    path = (router or DEFAULT_ROUTER).route(from_addr, subject, filename)
+    if path:
+        return path
+
+    # Default path if no pattern match, content-addressed when the digest is known
+    prefix = digest[:16] if digest else uuid.uuid4()
+    return f'unmatched_documents/from={from_addr}/{prefix}_{filename}'
+
+
+def attachment_metadata(msg: Message, attachment: Attachment) -> Dict:
+    """Object metadata saved along with an attachment."""
+    return {
+        'subject': msg.subject,
+        'from': msg.from_address.lower(),
+        'recievedDate': msg.recieved_date,
+        'filename': attachment.filename,
+        'mimeType': attachment.mime_type,
+        'gmailMessageID': msg.id,
+        'gmailThreadID': msg.thread_id,
+        'attachmentId': attachment.id,
+    }
+
+
+def extract_attachment_info(message: Dict) -> List[Dict]:
+    """Collect the attachment parts of a Gmail message resource."""
+    attachments = []
+
+    def traverse_parts(parts):
+        for part in parts:
+            if part.get('body', {}).get('attachmentId'):
+                attachment_id = part['body']['attachmentId']
+                attachments.append({
+                    'filename': part.get('filename', ''),
+                    'mimeType': part.get('mimeType', ''),
+                    'attachmentId': attachment_id,
+                    'partId': part.get('partId'),
+                    'size': part['body'].get('size', 0),
+                })
+
+            # Recursively check if there are nested parts
+            if part.get('parts'):
+                traverse_parts(part['parts'])
+
+    # Start the traversal with the top-level parts
+    if message.get('payload', {}).get('parts'):
+        traverse_parts(message['payload']['parts'])
+
+    return attachments
+
+
+def get_header(message_resp: Dict, name: str) -> Optional[str]:
+    headers = message_resp.get('payload', {}).get('headers') or []
+    return next((item['value'] for item in headers if item['name'] == name), None)
+
+
+def parse_address(sender: Optional[str]) -> Optional[str]:
+    """The address of a From header such as 'Bank <statement@bank.com>'."""
+    sender_found = ADDRESS_PATTERN.search(sender or '')
+    return sender_found.group(sender_found.lastindex) if sender_found else sender
+
+
+def parse_message(msg_id: str, message_resp: Dict, attachments: List[Attachment]) -> Message:
+    """Build a Message from a Gmail message resource and its downloaded attachments."""
+    return Message(
+        id=msg_id,
+        thread_id=message_resp.get('threadId'),
+        subject=get_header(message_resp, 'Subject'),
+        from_address=parse_address(get_header(message_resp, 'From')),
+        recieved_date=int(message_resp.get('internalDate')),
+        attachments=attachments
+    )
+
+
+@dataclass
+class MessageFilter:
+    """
+    Decides from the metadata of a message whether it is fetched in full.
+
+    Every condition that is set must hold. Senders are exact addresses or domains written
+    as '*@example.com'; a message passes the label condition with any of `label_ids`, and
+    the size conditions compare the size estimate of the whole message in bytes.
+    """
+    senders: Optional[List[str]] = None
+    label_ids: Optional[List[str]] = None
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+    # Skip messages no routing rule matches, whose attachments would be unmatched documents
+    routed_only: bool = False
+
+    def accepts(self, metadata: Dict, router: Optional[Router] = None) -> bool:
+        sender = (parse_address(get_header(metadata, 'From')) or '').lower()
+        if self.senders is not None:
+            senders = {s.lower() for s in self.senders}
+            if sender not in senders and f"*@{sender.rpartition('@')[2]}" not in senders:
+                return False
+        if self.label_ids is not None and not set(self.label_ids) & set(metadata.get('labelIds', [])):
+            return False
+        size = metadata.get('sizeEstimate', 0)
+        if (self.min_size is not None and size < self.min_size) \
+                or (self.max_size is not None and size > self.max_size):
+            return False
+        if self.routed_only:
+            return (router or DEFAULT_ROUTER).matches(sender, get_header(metadata, 'Subject'))
+        return True
+
+
+def split_by_label(history: List[Dict], label_starts: Dict[str, int]) -> Dict[str, List[str]]:
+    """
+    Message IDs added to each label by history records, in the order they appear.
+
+    A message counts for a label when it was added with that label or the label was added
+    to it, by a record newer than the history ID the label was synced to.
+
+    Parameters:
+    - history (List[Dict]): History records of an unfiltered history.list call.
+    - label_starts (Dict[str, int]): History ID each label of interest was synced to.
+    """
+    by_label: Dict[str, Dict[str, None]] = {}
+    for record in history:
+        record_id = int(record.get('id', 0))
+        added = [(item['message'], item['message'].get('labelIds', []))
+                 for item in record.get('messagesAdded', [])]
+        added += [(item['message'], item.get('labelIds', []))
+                  for item in record.get('labelsAdded', [])]
+        for message, label_ids in added:
+            for label_id in label_ids:
+                if label_id in label_starts and record_id > label_starts[label_id]:
+                    by_label.setdefault(label_id, {})[message['id']] = None
+    return {label_id: list(msg_ids) for label_id, msg_ids in by_label.items()}
 
 
 class GmailSync:
@@ -35,10 +185,23 @@ class GmailSync:
                  state_store: StateManager,
                  storage: StorageManager,
                  gmail_client: Optional[build] = None,
+                 credentials: Optional[Credentials] = None,
                  base_path: str = '',
                  credentials_cache_path: str = 'token.json',
                  credentials_doc_id: str = 'google_credentials',
-                 sync_state_doc_id: str = 'last_sync_state'):
+                 sync_state_doc_id: str = 'last_sync_state',
+                 batch_size: int = 0,
+                 max_workers: int = 1,
+                 deduplicate: bool = False,
+                 dedup_doc_prefix: str = 'attachment_sha256_',
+                 ledger: Optional[ProcessedLedger] = None,
+                 router: Optional[Router] = None,
+                 instrumentation: Optional[Instrumentation] = None,
+                 scheduler: Optional[QuotaScheduler] = None,
+                 message_filter: Optional[MessageFilter] = None,
+                 attachment_filter: Optional[AttachmentFilter] = None,
+                 defer_oversized: bool = False,
+                 fetch_threads: bool = False):
         """
         Initialization of GmailSync class.
 
@@ -46,17 +209,80 @@ class GmailSync:
         - state_store (StateManager): An instance of StateManager to manage states.
         - storage (StorageManager): An instance of StorageManager to manage storage.
         - gmail_client (build): An optional instance of Gmail client, defaults to None.
+        - credentials (Credentials): Credentials of `gmail_client`, needed with more than one
+          worker to give each thread a transport of its own. Defaults to None.
         - base_path (str): The base path, defaults to an empty string.
         - credentials_cache_path (str): Path to credentials cache, defaults to 'token.json'.
         - credentials_doc_id (str): Document ID of credentials, defaults to 'google_credentials'.
         - sync_state_doc_id (str): Document ID of sync state, defaults to 'last_sync_state'.
+        - batch_size (int): Number of Gmail API calls grouped into one batch request,
+          defaults to 0 which disables batching.
+        - max_workers (int): Number of threads fetching messages and attachments concurrently,
+          defaults to 1 which processes them one after another.
+        - deduplicate (bool): Skip uploading attachments whose content was saved before,
+          defaults to False.
+        - dedup_doc_prefix (str): Document ID prefix of the content index entries,
+          defaults to 'attachment_sha256_'.
+        - ledger (ProcessedLedger): An optional ledger of saved messages, used to skip them
+          on retries, defaults to None.
+        - router (Router): Routes attachments to save paths, defaults to the built-in rules.
+        - instrumentation (Instrumentation): Collects the counters and stage timings of each
+          sync, defaults to one logging them as JSON.
+        - scheduler (QuotaScheduler): Paces and retries every Gmail API call, defaults to one
+          for the quota of a single user allowing twice `max_workers` calls in flight.
+        - message_filter (MessageFilter): Fetch the metadata of messages first and only fetch
+          the ones it accepts in full with their attachments, defaults to None which fetches
+          every message in full.
+        - attachment_filter (AttachmentFilter): Attachments downloaded from messages whose
+          routing rule has no filter of its own, defaults to None which downloads them all.
+        - defer_oversized (bool): Queue attachments over the maximum size of their filter for
+          `process_deferred` instead of skipping them, defaults to False.
+        - fetch_threads (bool): Fetch the messages of a thread together with one threads.get
+          call when several of them are synced at once, defaults to False.
         """
+        if batch_size < 0 or batch_size > GMAIL_MAX_BATCH_SIZE:
+            raise ValueError(f"batch_size must be between 0 and {GMAIL_MAX_BATCH_SIZE}")
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        if gmail_client and max_workers > 1 and not credentials:
+            # The transport of the client would be shared by the workers, and httplib2 is not
+            # thread-safe
+            raise ValueError("credentials of gmail_client are needed with max_workers above 1")
 
         self.__state_store = state_store
         self.__storage = storage
         self.__base_path = base_path.strip('/')
         self.__sync_state_doc_id = sync_state_doc_id
         self.__credentials_doc_id = credentials_doc_id
+        self.__batch_size = batch_size
+        self.__max_workers = max_workers
+        self.__deduplicate = deduplicate
+        self.__dedup_doc_prefix = dedup_doc_prefix
+        self.__ledger = ledger
+        self.__router = router
+        self.__message_filter = message_filter
+        self.__attachment_filter = attachment_filter
+        self.__defer_oversized = defer_oversized
+        self.__fetch_threads = fetch_threads
+        # GmailSync instances saving the labels synced by `sync_labels`
+        self.__pipelines: Dict[Tuple[str, str], 'GmailSync'] = {}
+        # Attachments deferred by `defer_oversized` are queued in a document per message
+        self.__deferred_doc_prefix = f"{sync_state_doc_id}_deferred_message_"
+        self.__instrumentation = instrumentation or Instrumentation()
+        # Attachment downloads run in a pool of their own next to the message workers
+        self.__scheduler = scheduler or QuotaScheduler(max_concurrency=max_workers * 2,
+                                                       instrumentation=self.__instrumentation)
+        self.__credentials = credentials
+        self.__credentials_cache_path = credentials_cache_path
+        self.__local = threading.local()
+        # Syncs share the stats of the instance, so they run one at a time
+        self.__sync_lock = threading.Lock()
+        self.__attachment_pool = None
+        if max_workers > 1:
+            self.__attachment_pool = ThreadPoolExecutor(
+                max_workers=max_workers,
+                thread_name_prefix='gmail-sync-attachments'
+            )
 
         if not gmail_client:
             gmail_client = self.__init_gmail_client(credentials_cache_path, credentials_doc_id)
@@ -76,159 +302,1167 @@ class GmailSync:
         creds = None
         try:
             if os.path.exists(credentials_cache_path):
-                creds = Credentials.from_authorized_user_file('token.json')
+                creds = Credentials.from_authorized_user_file(credentials_cache_path)
             if not creds or not creds.valid or creds.expired:
-                creds_doc = self.__state_store.get_document_by_id(credentials_doc_id)
+                # The sync state comes along in the same round trip, so with a cache the first
+                # sync finds it there
+                creds_doc = self.__state_store.get_documents_by_ids(
+                    [credentials_doc_id, self.__sync_state_doc_id])[credentials_doc_id]
+                if not creds_doc:
+                    raise RuntimeError(f"Credentials `{credentials_doc_id}` not found")
                 creds = Credentials.from_authorized_user_info(creds_doc)
                 with open(credentials_cache_path, 'w') as token:
                     token.write(creds.to_json())
         except Exception as e:
             raise RuntimeError("Failed to initialize Gmail client.") from e
 
-        return build('gmail', 'v1', credentials=creds)
+        self.__credentials = creds
+        # Use the discovery document bundled with the pinned google-api-python-client
+        # rather than fetching it on every cold start
+        return build('gmail', 'v1', credentials=creds,
+                     static_discovery=True, cache_discovery=False)
+
+    @property
+    def instrumentation(self) -> Instrumentation:
+        return self.__instrumentation
+
+    def close(self) -> None:
+        """Shut down the attachment downloads of this instance and of its label pipelines."""
+        for pipeline in self.__pipelines.values():
+            pipeline.close()
+        if self.__attachment_pool:
+            self.__attachment_pool.shutdown()
 
-    def __get_last_history_id(self) -> str:
+    def __enter__(self) -> 'GmailSync':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __refresh_credentials_if_expired(self) -> None:
+        """Refresh the access token of a long-lived client once it has expired."""
+        creds = self.__credentials
+        if not creds or not creds.expired or not creds.refresh_token:
+            return
+        try:
+            creds.refresh(Request())
+            with open(self.__credentials_cache_path, 'w') as token:
+                token.write(creds.to_json())
+        except Exception as e:
+            raise RuntimeError("Failed to refresh Gmail credentials.") from e
+
+    def __execute(self, request: Union[HttpRequest, BatchHttpRequest], operation: str,
+                  units: Optional[float] = None):
+        """
+        Execute a Gmail API request through the scheduler, timed and counted as `operation`.
+
+        httplib2 is not thread-safe, so when running with several workers each thread
+        executes its requests on its own authorized transport.
+
+        Parameters:
+        - request (Union[HttpRequest, BatchHttpRequest]): The request to execute.
+        - operation (str): Name of the API method called.
+        - units (float): Quota units of the request, defaults to those of `operation`.
+        """
+        def send():
+            self.__instrumentation.count(f'api_calls.{operation}')
+            with self.__instrumentation.span(operation):
+                if self.__max_workers > 1 and self.__credentials:
+                    http = getattr(self.__local, 'http', None)
+                    if not http:
+                        http = AuthorizedHttp(self.__credentials, http=httplib2.Http())
+                        self.__local.http = http
+                    return request.execute(http=http)
+                return request.execute()
+
+        return self.__scheduler.execute(send, GMAIL_QUOTA_UNITS[operation] if units is None else units)
+
+    def __get_last_sync_state(self) -> SyncState:
         last_state = self.__state_store.get_document_by_id(self.__sync_state_doc_id)
-        return last_state['historyId']
+        return SyncState(
+            historyId=last_state['historyId'],
+            updatedTime=last_state.get('updatedTime'),
+            pageToken=last_state.get('pageToken'),
+        )
 
-    def __save_history_id(self, history_id: str):
+    def __save_history_id(self, history_id: str, page_token: Optional[str] = None,
+                          doc_id: Optional[str] = None):
         ts = datetime.now()
-        sync_state = SyncState(historyId=history_id, updatedTime=int(ts.strftime('%s')))
-        result = self.__state_store.set_document_by_id(
-            id=self.__sync_state_doc_id,
-            data=vars(sync_state)
-        )
+        sync_state = SyncState(historyId=history_id, updatedTime=int(ts.strftime('%s')),
+                               pageToken=page_token)
+        with self.__instrumentation.span('state.save'):
+            result = self.__state_store.set_document_by_id(
+                id=doc_id or self.__sync_state_doc_id,
+                data={k: v for k, v in vars(sync_state).items() if v is not None}
+            )
         return result.update_time
 
-    def __get_save_path(self, from_addr, subject, filename):
-        """Determine the save path based on sender addresses and subject patterns."""
-        config = EMAIL_PATTERNS.get(from_addr.lower())
-        if config:
-            parts = config['pattern'].search(subject)
-            if parts:
-                partition = f"{parts['year']}-{parts['month']}-{parts['dom']}"
-                return config['path'].format(partition, filename)
+    def __digest(self, attachment: Attachment) -> str:
+        sha256 = hashlib.sha256()
+        with self.__instrumentation.span('digest'):
+            for chunk in attachment.iter_data():
+                sha256.update(chunk)
+        return sha256.hexdigest()
 
-        # Default path if no pattern match
-        return f'unmatched_documents/from={from_addr}/{uuid.uuid4()}_{filename}'
+    def __get_indexed_attachment(self, digest: str) -> Optional[Dict]:
+        """The index entry of `digest`, None if it is missing. Raises if it cannot be read."""
+        doc_id = self.__dedup_doc_prefix + digest
+        return self.__state_store.get_documents_by_ids([doc_id])[doc_id]
 
-    def __save_message_attachments(self, msg: Message) -> None:
-        """Save message attachments based on sender and subject."""
-        from_addr = msg.from_address.lower()
-        for attachment in msg.attachments:
-            save_path = self.__get_save_path(from_addr, msg.subject, attachment.filename)
-            metadata = {
-                'subject': msg.subject,
-                'from': from_addr,
-                'recievedDate': msg.recieved_date,
-                'filename': attachment.filename,
-                'mimeType': attachment.mime_type,
+    def __index_attachment(self, digest: str, destination: str, msg: Message,
+                           attachment: Attachment) -> None:
+        indexed = self.__state_store.compare_and_set(
+            self.__dedup_doc_prefix + digest,
+            None,
+            {
+                'key': destination,
                 'gmailMessageID': msg.id,
-                'gmailThreadID': msg.thread_id,
                 'attachmentId': attachment.id,
+                'aliases': [],
             }
+        )
+        if not indexed:
+            # Another message saved the same content meanwhile, keep its entry and aliases
+            self.__record_alias(digest, msg, attachment, destination)
+
+    def __record_alias(self, digest: str, msg: Message, attachment: Attachment,
+                       destination: str) -> None:
+        def add_alias(indexed):
+            aliases = list(indexed.get('aliases', []))
+            if msg.id == indexed.get('gmailMessageID') \
+                    or any(alias['gmailMessageID'] == msg.id for alias in aliases):
+                # A retry of a message that is already indexed
+                return None
+            aliases.append({
+                'key': destination,
+                'gmailMessageID': msg.id,
+                'gmailThreadID': msg.thread_id,
+                'attachmentId': attachment.id,
+            })
+            return {**indexed, 'aliases': aliases}
+
+        # Messages sharing an attachment may be saved concurrently
+        self.__state_store.transact(self.__dedup_doc_prefix + digest, add_alias)
+
+    def __plan_uploads(self, msg: Message) -> List[Tuple[Attachment, Optional[str], PutItem]]:
+        """Pick the destination of every attachment that is not saved already."""
+        uploads = []
+        from_addr = msg.from_address.lower()
+        for attachment in msg.attachments:
+            digest = self.__digest(attachment) if self.__deduplicate else None
+            save_path = get_save_path(from_addr, msg.subject, attachment.filename, digest,
+                                      self.__router)
             destination = f"{self.__base_path}/{save_path}"
-            self.__storage.put(key=destination, data=attachment.data, metadata=metadata)
-            logger.info(f"File '{attachment.filename}' saved at '{destination}'")
+            if digest:
+                indexed = self.__get_indexed_attachment(digest)
+                if indexed:
+                    self.__record_alias(digest, msg, attachment, destination)
+                    logger.info(f"File '{attachment.filename}' already saved at '{indexed['key']}'")
+                    continue
 
-    def __download_attachment(self, message_id: str, attachment_id: str, user_id='me'):
-        attachment_resp = self.__gmail.users().messages().attachments().get(
+            metadata = attachment_metadata(msg, attachment)
+            if digest:
+                metadata['sha256'] = digest
+            uploads.append((attachment, digest, PutItem(
+                key=destination,
+                data=attachment.data,
+                # Decode and upload chunk by chunk instead of materializing the attachment
+                stream=(self.__instrumentation.timed_chunks('decode', attachment.iter_data())
+                        if attachment.data is None else None),
+                metadata=metadata,
+                content_type=attachment.mime_type,
+            )))
+        return uploads
+
+    def __upload(self, uploads: List[Tuple[Attachment, Optional[str], PutItem]]) -> Dict[str, Exception]:
+        """
+        Upload the planned attachments, concurrently when there are several.
+
+        Streamed attachments are decoded while they upload, so the time of the
+        `storage.put` stage includes the `decode` stage.
+        """
+        if not uploads:
+            return {}
+        with self.__instrumentation.span('storage.put'):
+            if len(uploads) > 1:
+                return self.__storage.put_many([item for _, _, item in uploads])
+            failures = {}
+            for _, _, item in uploads:
+                try:
+                    if item.stream is None:
+                        self.__storage.put(key=item.key, data=item.data, metadata=item.metadata,
+                                           content_type=item.content_type)
+                    else:
+                        self.__storage.put_stream(key=item.key, stream=item.stream,
+                                                  metadata=item.metadata,
+                                                  content_type=item.content_type)
+                except Exception as e:
+                    failures[item.key] = e
+            return failures
+
+    def __complete_uploads(self, msg: Message,
+                           uploads: List[Tuple[Attachment, Optional[str], PutItem]],
+                           failures: Dict[str, Exception]) -> None:
+        """Record the attachments of `msg` that were uploaded and raise if any failed."""
+        failed = []
+        for attachment, digest, item in uploads:
+            if item.key in failures:
+                self.__instrumentation.count('attachments.failed')
+                failed.append(f"{item.key}: {str(failures[item.key])}")
+                continue
+            self.__instrumentation.count('attachments.saved')
+            if digest:
+                self.__index_attachment(digest, item.key, msg, attachment)
+            if self.__ledger and attachment.part_id and len(msg.attachments) > 1:
+                self.__ledger.mark_attachment_saved(msg.id, attachment.part_id)
+            logger.info(f"File '{attachment.filename}' saved at '{item.key}'")
+        if failed:
+            raise RuntimeError(f"Failed to save {len(failed)} attachments: {'; '.join(failed)}")
+
+        if self.__ledger:
+            self.__ledger.mark_processed(msg.id)
+        self.__instrumentation.count('messages.processed')
+
+    def __save_message_attachments(self, msg: Message) -> None:
+        """Save message attachments based on sender and subject."""
+        uploads = self.__plan_uploads(msg)
+        self.__complete_uploads(msg, uploads, self.__upload(uploads))
+
+    def __fetch_attachment_data(self, message_id: str, attachment_id: str, user_id='me') -> str:
+        """Fetch the URL-safe base64 encoded content of an attachment."""
+        attachment_resp = self.__execute(self.__gmail.users().messages().attachments().get(
             userId=user_id,
             messageId=message_id,
             id=attachment_id,
-        ).execute()
-        return base64.urlsafe_b64decode(attachment_resp.get('data'))
+        ), 'attachments.get')
+        data = attachment_resp.get('data')
+        self.__instrumentation.count('bytes.downloaded', len(data or ''))
+        return data
 
-    def __extract_attachment_info(self, message: Dict) -> List[Dict]:
-        attachments = []
+    def __download_attachment(self, message_id: str, attachment_id: str, user_id='me'):
+        return base64.urlsafe_b64decode(
+            self.__fetch_attachment_data(message_id, attachment_id, user_id)
+        )
 
-        def traverse_parts(parts):
-            for part in parts:
-                if part.get('body', {}).get('attachmentId'):
-                    attachment_id = part['body']['attachmentId']
-                    attachments.append({
-                        'filename': part.get('filename', ''),
-                        'mimeType': part.get('mimeType', ''),
-                        'attachmentId': attachment_id,
-                    })
+    def __execute_batch(self,
+                        requests: Dict[str, HttpRequest],
+                        operation: str,
+                        batch_size: Optional[int] = None) -> Dict[str, Tuple[Dict, Exception]]:
+        """
+        Execute Gmail API calls in batch requests of at most `batch_size` calls each.
 
-                # Recursively check if there are nested parts
-                if part.get('parts'):
-                    traverse_parts(part['parts'])
+        Parameters:
+        - requests (Dict[str, HttpRequest]): Requests keyed by a unique request ID.
+        - operation (str): Counts the calls as this operation and times each batch request
+          as `{operation}.batch`.
+        - batch_size (int): Calls per batch request, defaults to the `batch_size` of the sync.
 
-        # Start the traversal with the top-level parts
-        if message.get('payload', {}).get('parts'):
-            traverse_parts(message['payload']['parts'])
+        Returns:
+        Dict[str, Tuple[Dict, Exception]]: The response and the exception of each request,
+        keyed by request ID. Exactly one of them is set.
+        """
+        results = {}
 
-        return attachments
+        def callback(request_id, response, exception):
+            results[request_id] = (response, exception)
+
+        batch_size = batch_size or self.__batch_size
+        request_ids = list(requests)
+        attempt = 0
+        while True:
+            retry = []
+            for i in range(0, len(request_ids), batch_size):
+                chunk = request_ids[i:i + batch_size]
+                batch = self.__gmail.new_batch_http_request(callback=callback)
+                for request_id in chunk:
+                    batch.add(requests[request_id], request_id=request_id)
+                self.__instrumentation.count(f'api_calls.{operation}', len(chunk))
+                try:
+                    self.__execute(batch, f'{operation}.batch',
+                                   units=GMAIL_QUOTA_UNITS[operation] * len(chunk))
+                except Exception as e:
+                    # The whole batch failed, report it against every call that has no result
+                    for request_id in chunk:
+                        results.setdefault(request_id, (None, e))
+                    continue
+                # Calls throttled inside a batch fail on their own and are sent again together
+                retry.extend(request_id for request_id in chunk
+                             if is_retryable(results.get(request_id, (None, None))[1]))
+
+            if not retry or attempt >= self.__scheduler.max_retries:
+                return results
+            self.__scheduler.on_throttled()
+            self.__scheduler.backoff(attempt)
+            attempt += 1
+            request_ids = retry
+
+    def __defer_attachments(self, msg_id: str, attachment_info: List[Dict]) -> None:
+        result = self.__state_store.set_documents({self.__deferred_doc_prefix + msg_id: {
+            'messageId': msg_id,
+            'attachments': [{
+                'partId': info['partId'],
+                'filename': info['filename'],
+                'size': info['size'],
+            } for info in attachment_info],
+        }})
+        if result.status is WriteResult.Status.FAILED:
+            raise RuntimeError(f"Failed to defer attachments of {msg_id}: {result.message}")
+        self.__instrumentation.count('attachments.deferred', len(attachment_info))
+
+    def __filter_attachment_info(self, msg_id: str, message_resp: Dict,
+                                 attachment_info: List[Dict]) -> List[Dict]:
+        """
+        Keep the attachments the filter of their route accepts, before downloading any.
+        Oversized attachments are queued when deferring them.
+        """
+        sender = (parse_address(get_header(message_resp, 'From')) or '').lower()
+        attachment_filter = (self.__router or DEFAULT_ROUTER).attachment_filter(
+            sender, get_header(message_resp, 'Subject')) or self.__attachment_filter
+        if not attachment_filter:
+            return attachment_info
+
+        selected, deferred = [], []
+        for info in attachment_info:
+            if attachment_filter.accepts(info['filename'], info['mimeType'], info['size']):
+                selected.append(info)
+            elif self.__defer_oversized and attachment_filter.is_oversized(info['size']) \
+                    and attachment_filter.matches(info['filename'], info['mimeType']):
+                deferred.append(info)
+            else:
+                self.__instrumentation.count('attachments.filtered')
+        if deferred:
+            self.__defer_attachments(msg_id, deferred)
+        return selected
+
+    def __pending_attachment_info(self, msg_id: str, message_resp: Dict) -> List[Dict]:
+        """
+        Attachment info of a message, without the attachments the ledger has saved and
+        the ones filtered out.
+        """
+        attachment_info = extract_attachment_info(message_resp)
+        if self.__ledger:
+            saved = self.__ledger.saved_attachments(msg_id)
+            attachment_info = [info for info in attachment_info if info['partId'] not in saved]
+        return self.__filter_attachment_info(msg_id, message_resp, attachment_info)
+
+    def __download(self, msg_id: str, info: Dict) -> Attachment:
+        return Attachment(
+            id=info['attachmentId'],
+            filename=info['filename'],
+            mime_type=info['mimeType'],
+            encoded_data=self.__fetch_attachment_data(msg_id, attachment_id=info['attachmentId']),
+            part_id=info['partId'],
+        )
 
     def get_message(self, msg_id: str) -> Message:
-        message_resp = self.__gmail.users().messages().get(userId='me', id=msg_id).execute()
-        headers = message_resp.get('payload', {}).get('headers')
-        subject = next((item['value'] for item in headers if item['name'] == 'Subject'), None)
-        sender = next((item['value'] for item in headers if item['name'] == 'From'), None)
-        sender_found = ADDRESS_PATTERN.search(sender)
-        attachment_info = self.__extract_attachment_info(message_resp)
-        attachments = []
-        for attachment in attachment_info:
-            data = self.__download_attachment(
-                msg_id, attachment_id=attachment['attachmentId'],
-                user_id='me'
+        message_resp = self.__execute(
+            self.__gmail.users().messages().get(userId='me', id=msg_id), 'messages.get'
+        )
+        attachment_info = self.__pending_attachment_info(msg_id, message_resp)
+        return parse_message(msg_id, message_resp, self.__download_all(msg_id, attachment_info))
+
+    def __download_all(self, msg_id: str, attachment_info: List[Dict]) -> List[Attachment]:
+        if self.__attachment_pool and len(attachment_info) > 1:
+            return list(self.__attachment_pool.map(lambda info: self.__download(msg_id, info),
+                                                   attachment_info))
+        return [self.__download(msg_id, info) for info in attachment_info]
+
+    def process_deferred(self) -> int:
+        """
+        Download and save the attachments deferred for being oversized.
+
+        Each message is fetched again, as Gmail attachment IDs don't outlive the message
+        resource they came with. Attachments leave the queue once saved, or when their
+        message was deleted.
+
+        Returns:
+        int: Number of attachments saved.
+        """
+        self.__refresh_credentials_if_expired()
+        saved = 0
+        for doc_id, deferred in self.__state_store.get_documents_by_prefix(
+                self.__deferred_doc_prefix).items():
+            msg_id = deferred['messageId']
+            parts = {attachment['partId'] for attachment in deferred['attachments']}
+            try:
+                message_resp = self.__execute(
+                    self.__gmail.users().messages().get(userId='me', id=msg_id), 'messages.get'
+                )
+                attachment_info = [info for info in extract_attachment_info(message_resp)
+                                   if info['partId'] in parts]
+                msg = parse_message(msg_id, message_resp,
+                                    self.__download_all(msg_id, attachment_info))
+                self.__save_message_attachments(msg)
+                saved += len(msg.attachments)
+            except HttpError as e:
+                if e.status_code != 404:
+                    logger.error(f"Failed to save deferred attachments of {msg_id}: {str(e)}")
+                    continue
+                logger.warning(f"Message {msg_id} of deferred attachments no longer exists")
+            except Exception as e:
+                logger.error(f"Failed to save deferred attachments of {msg_id}: {str(e)}")
+                continue
+            self.__state_store.delete_document_by_id(doc_id)
+        return saved
+
+    def get_messages(self, msg_ids: List[str]) -> Dict[str, Union[Message, Exception]]:
+        """
+        Fetch messages and their attachments using Gmail batch requests.
+
+        Parameters:
+        - msg_ids (List[str]): IDs of the messages to fetch.
+
+        Returns:
+        Dict[str, Union[Message, Exception]]: The message, or the exception that prevented
+        fetching it, keyed by message ID.
+        """
+        messages = self.__gmail.users().messages()
+        message_results = self.__execute_batch({
+            msg_id: messages.get(userId='me', id=msg_id) for msg_id in msg_ids
+        }, 'messages.get')
+
+        results = {}
+        attachment_requests = {}
+        attachment_info = {}
+        for msg_id in msg_ids:
+            message_resp, exception = message_results[msg_id]
+            if exception:
+                results[msg_id] = exception
+                continue
+            attachment_info[msg_id] = self.__pending_attachment_info(msg_id, message_resp)
+            for i, attachment in enumerate(attachment_info[msg_id]):
+                attachment_requests[f"{msg_id}:{i}"] = messages.attachments().get(
+                    userId='me',
+                    messageId=msg_id,
+                    id=attachment['attachmentId'],
+                )
+
+        attachment_results = self.__execute_batch(attachment_requests, 'attachments.get')
+        for msg_id, info in attachment_info.items():
+            try:
+                attachments = []
+                for i, attachment in enumerate(info):
+                    attachment_resp, exception = attachment_results[f"{msg_id}:{i}"]
+                    if exception:
+                        raise exception
+                    self.__instrumentation.count('bytes.downloaded',
+                                                 len(attachment_resp.get('data') or ''))
+                    attachments.append(Attachment(
+                        id=attachment['attachmentId'],
+                        filename=attachment['filename'],
+                        mime_type=attachment['mimeType'],
+                        encoded_data=attachment_resp.get('data'),
+                        part_id=attachment['partId'],
+                    ))
+                results[msg_id] = parse_message(
+                    msg_id, message_results[msg_id][0], attachments
+                )
+            except Exception as e:
+                results[msg_id] = e
+        return results
+
+    def __select_messages(self, msg_ids: List[str]) -> List[str]:
+        """
+        First phase of the two-phase fetch: the messages the filter accepts, judged by
+        metadata fetched in batches.
+
+        Messages whose metadata could not be fetched are kept, so fetching them in full
+        reports the error. Messages the ledger has processed are kept without a fetch.
+        """
+        pending = [msg_id for msg_id in msg_ids
+                   if not (self.__ledger and self.__ledger.is_processed(msg_id))]
+        if not pending:
+            return msg_ids
+        messages = self.__gmail.users().messages()
+        metadata = self.__execute_batch({
+            msg_id: messages.get(userId='me', id=msg_id, format='metadata',
+                                 metadataHeaders=METADATA_HEADERS, fields=METADATA_FIELDS)
+            for msg_id in pending
+        }, 'messages.get', batch_size=self.__batch_size or METADATA_BATCH_SIZE)
+
+        selected = []
+        for msg_id in msg_ids:
+            message_resp, exception = metadata.get(msg_id, (None, None))
+            if message_resp is not None and exception is None \
+                    and not self.__message_filter.accepts(message_resp, self.__router):
+                self.__instrumentation.count('messages.filtered')
+                logger.debug(f"Message {msg_id} is skipped by the message filter")
+                continue
+            selected.append(msg_id)
+        return selected
+
+    def __process_message(self, msg_id: str) -> None:
+        try:
+            if self.__ledger and self.__ledger.is_processed(msg_id):
+                self.__instrumentation.count('messages.skipped')
+                logger.info(f"Message {msg_id} is already processed")
+                return
+            msg = self.get_message(msg_id)
+            self.__save_message_attachments(msg)
+        except Exception as e:
+            self.__instrumentation.count('messages.failed')
+            logger.error(f"Failed to process message {msg_id}: {str(e)}")
+
+    def __process_thread(self, thread_id: str, msg_ids: List[str]) -> None:
+        """Process messages of one thread from a single threads.get response."""
+        if self.__ledger:
+            pending = [msg_id for msg_id in msg_ids if not self.__ledger.is_processed(msg_id)]
+            self.__instrumentation.count('messages.skipped', len(msg_ids) - len(pending))
+            msg_ids = pending
+            if not msg_ids:
+                return
+        try:
+            thread_resp = self.__execute(
+                self.__gmail.users().threads().get(userId='me', id=thread_id), 'threads.get'
+            )
+        except Exception as e:
+            self.__instrumentation.count('messages.failed', len(msg_ids))
+            logger.error(f"Failed to process thread {thread_id} of messages {msg_ids}: {str(e)}")
+            return
+
+        message_resps = {message['id']: message for message in thread_resp.get('messages', [])}
+        for msg_id in msg_ids:
+            try:
+                if msg_id not in message_resps:
+                    raise RuntimeError(f"Message not found in thread {thread_id}")
+                attachment_info = self.__pending_attachment_info(msg_id, message_resps[msg_id])
+                msg = parse_message(msg_id, message_resps[msg_id],
+                                    self.__download_all(msg_id, attachment_info))
+                self.__save_message_attachments(msg)
+            except Exception as e:
+                self.__instrumentation.count('messages.failed')
+                logger.error(f"Failed to process message {msg_id}: {str(e)}")
+
+    def __process_batch(self, msg_ids: List[str]) -> None:
+        if self.__ledger:
+            msg_ids = [msg_id for msg_id in msg_ids if not self.__ledger.is_processed(msg_id)]
+            if not msg_ids:
+                return
+        results = self.get_messages(msg_ids)
+        planned = {}
+        for msg_id, msg in results.items():
+            try:
+                if isinstance(msg, Exception):
+                    raise msg
+                planned[msg_id] = (msg, self.__plan_uploads(msg))
+            except Exception as e:
+                self.__instrumentation.count('messages.failed')
+                logger.error(f"Failed to process message {msg_id}: {str(e)}")
+
+        # The attachments of the whole batch are uploaded together
+        failures = self.__upload([upload for _, uploads in planned.values() for upload in uploads])
+        for msg_id, (msg, uploads) in planned.items():
+            try:
+                self.__complete_uploads(msg, uploads, failures)
+            except Exception as e:
+                self.__instrumentation.count('messages.failed')
+                logger.error(f"Failed to process message {msg_id}: {str(e)}")
+
+    def __process_messages(self, msg_ids: List[str],
+                           thread_ids: Optional[Dict[str, str]] = None) -> None:
+        if self.__ledger and len(msg_ids) > 1:
+            self.__ledger.prefetch(msg_ids)
+        if self.__message_filter and msg_ids:
+            msg_ids = self.__select_messages(msg_ids)
+
+        tasks = []
+        if self.__fetch_threads and thread_ids:
+            threads: Dict[str, List[str]] = {}
+            for msg_id in msg_ids:
+                threads.setdefault(thread_ids.get(msg_id) or msg_id, []).append(msg_id)
+            # A thread costs twice the quota of a message, so lone messages are fetched alone
+            msg_ids = [ids[0] for ids in threads.values() if len(ids) == 1]
+            tasks = [partial(self.__process_thread, thread_id, ids)
+                     for thread_id, ids in threads.items() if len(ids) > 1]
+        if self.__batch_size:
+            tasks += [partial(self.__process_batch, msg_ids[i:i + self.__batch_size])
+                      for i in range(0, len(msg_ids), self.__batch_size)]
+        else:
+            tasks += [partial(self.__process_message, msg_id) for msg_id in msg_ids]
+
+        if self.__max_workers > 1 and len(tasks) > 1:
+            # Messages get a pool of their own so their attachment downloads can't starve it
+            with ThreadPoolExecutor(max_workers=self.__max_workers,
+                                    thread_name_prefix='gmail-sync-messages') as pool:
+                list(pool.map(lambda task: task(), tasks))
+        else:
+            for task in tasks:
+                task()
+
+    def __iter_history_pages(self,
+                             start_history_id: str,
+                             label_id: str,
+                             history_types: List[str],
+                             page_token: Optional[str] = None) -> Iterator[HistoryPage]:
+        """
+        Lazily walk every page of the Gmail history starting at `start_history_id`.
+
+        Parameters:
+        - start_history_id (str): History ID to list changes from.
+        - label_id (str): Only return history of messages with this label, or all if None.
+        - history_types (List[str]): History types to return.
+        - page_token (str): Page to start from when resuming an interrupted walk.
+
+        Yields:
+        HistoryPage: The unique message IDs of a page, in the order they appear.
+        """
+        while True:
+            params = {
+                'userId': 'me',
+                'startHistoryId': start_history_id,
+                'historyTypes': history_types,
+            }
+            if label_id:
+                params['labelId'] = label_id
+            if page_token:
+                params['pageToken'] = page_token
+            history_resp = self.__execute(self.__gmail.users().history().list(**params),
+                                          'history.list')
+
+            # Message IDs in the order they appear, mapped to their thread ID
+            msg_ids = {}
+            for entry in history_resp.get('history', []):
+                for message_resp in entry.get('messages', []):
+                    msg_ids[message_resp['id']] = message_resp.get('threadId')
+
+            page_token = history_resp.get('nextPageToken')
+            yield HistoryPage(
+                msg_ids=list(msg_ids),
+                history_id=history_resp.get('historyId'),
+                next_page_token=page_token,
+                thread_ids={msg_id: thread_id for msg_id, thread_id in msg_ids.items() if thread_id},
+                history=history_resp.get('history', []),
             )
-            attachments.append(Attachment(
-                id=attachment['attachmentId'],
-                filename=attachment['filename'],
-                mime_type=attachment['mimeType'],
-                data=data
+            if not page_token:
+                return
+
+    def __scan_shard(self, doc_id: str, query: str) -> int:
+        """
+        Process every message matched by `query`, checkpointing the page token in `doc_id`.
+
+        Returns:
+        int: Number of messages processed by this call.
+        """
+        shard = self.__find_document(doc_id) or {}
+        if shard.get('query') != query:
+            shard = {'query': query, 'done': False}
+        if shard['done']:
+            return 0
+
+        processed = 0
+        while True:
+            params = {'userId': 'me', 'q': query, 'maxResults': GMAIL_MAX_LIST_RESULTS}
+            if shard.get('pageToken'):
+                params['pageToken'] = shard['pageToken']
+            list_resp = self.__execute(self.__gmail.users().messages().list(**params),
+                                       'messages.list')
+
+            msg_ids = [message['id'] for message in list_resp.get('messages', [])]
+            self.__process_messages(msg_ids, {message['id']: message['threadId']
+                                              for message in list_resp.get('messages', [])
+                                              if message.get('threadId')})
+            processed += len(msg_ids)
+
+            page_token = list_resp.get('nextPageToken')
+            shard = {'query': query, 'done': not page_token,
+                     'updatedTime': int(datetime.now().strftime('%s'))}
+            if page_token:
+                shard['pageToken'] = page_token
+            self.__state_store.set_document_by_id(id=doc_id, data=shard)
+            if not page_token:
+                return processed
+
+    def backfill(self,
+                 query: str,
+                 start_date: date,
+                 end_date: date,
+                 shard_days: int = 30,
+                 backfill_id: Optional[str] = None) -> SyncResult:
+        """
+        Save the attachments of past messages matched by a Gmail search query.
+
+        The range from `start_date` up to, but excluding, `end_date` is split into date
+        shards that are scanned with `messages.list` by up to `max_workers` threads. The page
+        token of each shard is checkpointed, so running the same backfill again resumes
+        where it stopped and skips finished shards.
+
+        Parameters:
+        - query (str): Gmail search query, e.g. 'from:statement@centralthe1card.com'.
+        - start_date (date): First day to backfill.
+        - end_date (date): Day after the last day to backfill.
+        - shard_days (int): Number of days per shard, defaults to 30.
+        - backfill_id (str): Names the checkpoints of this backfill, defaults to a hash of
+          `query`.
+
+        Returns:
+        SyncResult: The messages processed by this run and the stats, with no history ID.
+
+        Raises:
+        - RuntimeError: If any shard failed; its checkpoint is kept for the next run.
+        """
+        if shard_days < 1:
+            raise ValueError("shard_days must be at least 1")
+        self.__refresh_credentials_if_expired()
+        backfill_id = backfill_id or hashlib.sha1(query.encode()).hexdigest()[:12]
+
+        shards = []
+        after = start_date
+        while after < end_date:
+            before = min(after + timedelta(days=shard_days), end_date)
+            shards.append((
+                f"{self.__sync_state_doc_id}_backfill_{backfill_id}_{after:%Y%m%d}_{before:%Y%m%d}",
+                f"{query} after:{after:%Y/%m/%d} before:{before:%Y/%m/%d}",
             ))
+            after = before
+        logger.info(f"Backfilling '{query}' from {start_date} to {end_date} in {len(shards)} shards")
+        return self.__instrumented(lambda: self.__scan_shards(shards), query=query,
+                                   shards=len(shards))
 
-        return Message(
-            id=msg_id,
-            thread_id=message_resp.get('threadId'),
-            subject=subject,
-            from_address=sender_found.group(sender_found.lastindex) if sender_found else sender,
-            recieved_date=int(message_resp.get('internalDate')),
-            attachments=attachments
-        )
+    def __scan_shards(self, shards: List[Tuple[str, str]]) -> SyncResult:
+        def scan(shard):
+            try:
+                return self.__scan_shard(*shard)
+            except Exception as e:
+                logger.error(f"Failed to backfill '{shard[1]}': {str(e)}")
+                return None
+
+        if self.__max_workers > 1 and len(shards) > 1:
+            with ThreadPoolExecutor(max_workers=self.__max_workers,
+                                    thread_name_prefix='gmail-sync-backfill') as pool:
+                results = list(pool.map(scan, shards))
+        else:
+            results = [scan(shard) for shard in shards]
+
+        failed = results.count(None)
+        if failed:
+            raise RuntimeError(f"{failed} of {len(shards)} backfill shards failed, "
+                               + "run the backfill again to resume them")
+        return self.__sync_result(None)
 
     def sync(self,
              label_id: str = 'INBOX',
              history_types: List[str] = ["messageAdded", "labelAdded"],
-             start_history_id: str = None) -> None:
+             start_history_id: str = None) -> Optional[SyncResult]:
+        """
+        Save the attachments of the messages added since the last sync.
+
+        The counters and stage timings of the sync are exported by the instrumentation
+        and returned in the result.
+
+        Parameters:
+        - label_id (str): Only sync messages with this label, defaults to 'INBOX'.
+        - history_types (List[str]): History types to sync.
+        - start_history_id (str): History ID to sync from, defaults to the stored sync state.
+
+        Returns:
+        SyncResult: The new history ID, None if data was already up-to-date, and the stats.
+        None if the history could not be fetched.
+        """
+        return self.__instrumented(
+            lambda: self.__sync_history(label_id, history_types, start_history_id),
+            labelId=label_id,
+        )
+
+    def __instrumented(self, run: Callable[[], Optional[SyncResult]],
+                       **fields) -> Optional[SyncResult]:
+        """
+        Run a sync with fresh stats, then export them along with `fields`. Syncs of an
+        instance wait for each other, or one would reset the stats of another.
+        """
+        with self.__sync_lock:
+            # Stats cover a single sync, so they describe the latest one
+            self.__instrumentation.reset()
+            result = None
+            try:
+                with self.__instrumentation.span('sync'):
+                    result = run()
+                return result
+            finally:
+                stats = self.__instrumentation.export(
+                    **fields,
+                    historyId=result.history_id if result else None,
+                    succeeded=result is not None,
+                )
+                if result:
+                    result.stats = stats
 
+    def __sync_result(self, history_id: Optional[str], in_progress: bool = False) -> SyncResult:
+        counter = self.__instrumentation.counter
+        return SyncResult(
+            history_id=history_id,
+            in_progress=in_progress,
+            messages=counter('messages.processed'),
+            failed_messages=counter('messages.failed'),
+            attachments=counter('attachments.saved'),
+            bytes_downloaded=counter('bytes.downloaded'),
+            retries=counter('api_calls.retries'),
+        )
+
+    def __sync_history(self,
+                       label_id: str,
+                       history_types: List[str],
+                       start_history_id: Optional[str]) -> Optional[SyncResult]:
+        self.__refresh_credentials_if_expired()
+
+        page_token = None
         if not start_history_id:
-            start_history_id = self.__get_last_history_id()
+            last_state = self.__get_last_sync_state()
+            start_history_id, page_token = last_state.historyId, last_state.pageToken
 
         logger.info(f"Syncing Gmail from {start_history_id} with "
-                    + f"label_id={label_id}, history_types={history_types}")
+                    + f"label_id={label_id}, history_types={history_types}"
+                    + (f", resuming from page {page_token}" if page_token else ""))
 
-        try:
-            history_resp = self.__gmail.users().history().list(
-                userId='me',
-                startHistoryId=start_history_id,
-                labelId=label_id,
-                historyTypes=history_types
-            ).execute()
-        except Exception as e:
-            logger.error(f"Failed to fetch Gmail history: {str(e)}")
-            return
+        pages = self.__iter_history_pages(start_history_id, label_id, history_types, page_token)
+        has_history = bool(page_token)
+        next_history_id = None
+        while True:
+            try:
+                page = next(pages, None)
+            except Exception as e:
+                logger.error(f"Failed to fetch Gmail history: {str(e)}")
+                return
+            if not page:
+                break
 
-        if 'history' in history_resp:
-            next_history_id = history_resp['historyId']
-            msg_ids = set()
-            for entry in history_resp['history']:
-                for message_resp in entry['messages']:
-                    msg_ids.add(message_resp['id'])
-
-            for msg_id in msg_ids:
-                try:
-                    msg = self.get_message(msg_id)
-                    self.__save_message_attachments(msg)
-                except Exception as e:
-                    logger.error(f"Failed to process message {msg_id}: {str(e)}")
+            next_history_id = page.history_id
+            if page.msg_ids:
+                has_history = True
+                self.__process_messages(page.msg_ids, page.thread_ids)
+            if page.next_page_token:
+                # Checkpoint so an interrupted walk resumes from the next page
+                has_history = True
+                self.__save_history_id(start_history_id, page_token=page.next_page_token)
 
+        if has_history:
             self.__save_history_id(next_history_id)
-            return "{ \"history_id\": \"" + next_history_id + "\"}"
         else:
+            next_history_id = None
+            logger.info("Data is already up-to-date")
+        return self.__sync_result(next_history_id)
+
+    def __label_state_doc_id(self, label_id: str) -> str:
+        return f"{self.__sync_state_doc_id}_{label_id}"
+
+    def __label_pipeline(self, label_id: str, prefix: str) -> 'GmailSync':
+        """GmailSync saving under `prefix`, sharing the clients, quota and stats of this one."""
+        key = (label_id, prefix)
+        if key not in self.__pipelines:
+            pipeline = GmailSync(
+                state_store=self.__state_store,
+                storage=self.__storage,
+                gmail_client=self.__gmail,
+                credentials=self.__credentials,
+                base_path='/'.join(path for path in (self.__base_path, prefix.strip('/')) if path),
+                credentials_cache_path=self.__credentials_cache_path,
+                credentials_doc_id=self.__credentials_doc_id,
+                sync_state_doc_id=self.__label_state_doc_id(label_id),
+                batch_size=self.__batch_size,
+                max_workers=self.__max_workers,
+                deduplicate=self.__deduplicate,
+                # A message, or content, saved for one label still has to be saved for the others
+                dedup_doc_prefix=f"{self.__dedup_doc_prefix}{label_id}_",
+                ledger=self.__ledger.scoped(label_id) if self.__ledger else None,
+                router=self.__router,
+                instrumentation=self.__instrumentation,
+                scheduler=self.__scheduler,
+                message_filter=self.__message_filter,
+                attachment_filter=self.__attachment_filter,
+                defer_oversized=self.__defer_oversized,
+                fetch_threads=self.__fetch_threads,
+            )
+            self.__pipelines[key] = pipeline
+        return self.__pipelines[key]
+
+    def sync_labels(self,
+                    label_paths: Dict[str, str],
+                    history_types: List[str] = ["messageAdded", "labelAdded"]
+                    ) -> Optional[SyncResult]:
+        """
+        Sync several labels with a single walk of the unfiltered history.
+
+        Messages are routed to the labels they were added with, or that were added to them,
+        and saved under the storage prefix of each label. Every label keeps its own sync state,
+        so a label added later is synced from the single-label sync state and only gets the
+        history it has not seen.
+
+        Parameters:
+        - label_paths (Dict[str, str]): Storage prefix, relative to the base path, of each
+          label ID to sync.
+        - history_types (List[str]): History types to sync.
+
+        Returns:
+        SyncResult: The new history ID, None if data was already up-to-date, and the stats.
+        None if the history could not be fetched.
+        """
+        if not label_paths:
+            raise ValueError("label_paths must name at least one label")
+        return self.__instrumented(lambda: self.__sync_label_history(label_paths, history_types),
+                                   labelIds=sorted(label_paths))
+
+    def __sync_label_history(self,
+                             label_paths: Dict[str, str],
+                             history_types: List[str]) -> Optional[SyncResult]:
+        self.__refresh_credentials_if_expired()
+
+        pass_doc_id = f"{self.__sync_state_doc_id}_labels"
+        label_doc_ids = {label_id: self.__label_state_doc_id(label_id) for label_id in label_paths}
+        states = self.__state_store.get_documents_by_ids([pass_doc_id, *label_doc_ids.values()])
+        label_starts = {}
+        for label_id, doc_id in label_doc_ids.items():
+            # A label without a state of its own starts from the single-label sync state
+            state = states[doc_id] or {'historyId': self.__get_last_sync_state().historyId}
+            label_starts[label_id] = int(state['historyId'])
+        start_history_id = str(min(label_starts.values()))
+        checkpoint = states[pass_doc_id] or {}
+        resumed = checkpoint.get('historyId') == start_history_id
+        page_token = checkpoint.get('pageToken') if resumed else None
+
+        logger.info(f"Syncing Gmail from {start_history_id} with labels {sorted(label_paths)}, "
+                    + f"history_types={history_types}"
+                    + (f", resuming from page {page_token}" if page_token else ""))
+
+        pages = self.__iter_history_pages(start_history_id, None, history_types, page_token)
+        has_history = bool(page_token)
+        next_history_id = None
+        while True:
+            try:
+                page = next(pages, None)
+            except Exception as e:
+                logger.error(f"Failed to fetch Gmail history: {str(e)}")
+                return
+            if not page:
+                break
+
+            next_history_id = page.history_id
+            has_history = has_history or bool(page.history)
+            for label_id, msg_ids in split_by_label(page.history, label_starts).items():
+                self.__instrumentation.count(f'messages.label.{label_id}', len(msg_ids))
+                pipeline = self.__label_pipeline(label_id, label_paths[label_id])
+                pipeline.__process_messages(msg_ids, page.thread_ids)
+            if page.next_page_token:
+                # Checkpoint so an interrupted walk resumes from the next page
+                has_history = True
+                self.__save_history_id(start_history_id, page_token=page.next_page_token,
+                                       doc_id=pass_doc_id)
+
+        if not has_history:
             logger.info("Data is already up-to-date")
-            return "Data is already up-to-date"
+            return self.__sync_result(None)
+
+        updated_time = int(datetime.now().strftime('%s'))
+        result = self.__state_store.set_documents({
+            doc_id: {'historyId': next_history_id, 'updatedTime': updated_time}
+            for doc_id in label_doc_ids.values()
+        })
+        if result.status is WriteResult.Status.FAILED:
+            raise RuntimeError(f"Failed to save the label sync states: {result.message}")
+        self.__save_history_id(next_history_id, doc_id=pass_doc_id)
+        return self.__sync_result(next_history_id)
+
+    def __find_document(self, doc_id: str, use_cache: bool = True) -> Optional[Dict]:
+        try:
+            return self.__state_store.get_document_by_id(doc_id, use_cache=use_cache)
+        except RuntimeError:
+            return None
+
+    def __shard_doc_id(self, index: int) -> str:
+        return f"{self.__sync_state_doc_id}_shard_{index}"
+
+    def __write_shards(self, start_history_id: str, msg_ids: List[str], first_shard: int,
+                       shard_size: int) -> int:
+        """
+        Write `msg_ids` as shards numbered from `first_shard`, in one batched write.
+
+        Returns:
+        int: Number of the next shard.
+        """
+        shards = {
+            self.__shard_doc_id(first_shard + i // shard_size): {
+                'startHistoryId': start_history_id,
+                'msgIds': msg_ids[i:i + shard_size],
+                'done': False,
+            }
+            for i in range(0, len(msg_ids), shard_size)
+        }
+        if shards:
+            result = self.__state_store.set_documents(shards)
+            if result.status is WriteResult.Status.FAILED:
+                raise RuntimeError(f"Failed to write shards: {result.message}")
+        return first_shard + len(shards)
+
+    def __plan_window(self,
+                      start_history_id: str,
+                      label_id: str,
+                      history_types: List[str],
+                      owner: str,
+                      shard_size: int,
+                      lease_seconds: float) -> Optional[Dict]:
+        """
+        Split the history after `start_history_id` into shards of message IDs.
+
+        Only the owner of the planner lease walks the history. Shard documents are written
+        as soon as they are complete, so only a page and one partial shard of message IDs are
+        held in memory, and before the window document that points at them, so workers
+        never see a window with missing shards.
+
+        Returns:
+        Dict: The window, or None if another instance is planning it.
+        """
+        window_doc_id = f"{self.__sync_state_doc_id}_window"
+        planner_lease_id = f"{self.__sync_state_doc_id}_planner_lease"
+        if not self.__state_store.acquire_lease(planner_lease_id, owner, lease_seconds):
+            return None
+        try:
+            # Another planner may have published the window while we waited
+            window = self.__find_document(window_doc_id, use_cache=False)
+            if window and window['startHistoryId'] == start_history_id:
+                return window
+
+            end_history_id, msg_ids, shards = None, [], 0
+            for page in self.__iter_history_pages(start_history_id, label_id, history_types):
+                end_history_id = page.history_id
+                msg_ids.extend(page.msg_ids)
+                # Another planner takes over an expired lease, and its shards must not be
+                # overwritten with ones whose `done` flags are reset
+                if not self.__state_store.acquire_lease(planner_lease_id, owner, lease_seconds):
+                    raise RuntimeError("Lost the planner lease while walking the history")
+                # Complete shards are written as the walk goes, the rest waits for the next page
+                complete = len(msg_ids) - len(msg_ids) % shard_size
+                shards = self.__write_shards(start_history_id, msg_ids[:complete], shards,
+                                             shard_size)
+                msg_ids = msg_ids[complete:]
+            shards = self.__write_shards(start_history_id, msg_ids, shards, shard_size)
+
+            window = {'startHistoryId': start_history_id, 'endHistoryId': end_history_id,
+                      'shards': shards}
+            if shards:
+                self.__state_store.set_document_by_id(id=window_doc_id, data=window)
+            return window
+        finally:
+            self.__state_store.release_lease(planner_lease_id, owner)
+
+    def __process_leased(self, msg_ids: List[str], lease_id: str, owner: str,
+                         lease_seconds: float) -> bool:
+        """
+        Process `msg_ids` a batch or a round of workers at a time, renewing the lease before
+        each one after the first.
+
+        Returns:
+        bool: Whether the lease was kept, False if processing stopped because it was lost.
+        """
+        step = max(self.__batch_size, self.__max_workers)
+        for i in range(0, len(msg_ids), step):
+            if i and not self.__state_store.acquire_lease(lease_id, owner, lease_seconds):
+                return False
+            self.__process_messages(msg_ids[i:i + step])
+        return True
+
+    def __process_shards(self, window: Dict, owner: str, lease_seconds: float) -> int:
+        """
+        Process every shard of `window` that is neither done nor leased by another instance.
+
+        Returns:
+        int: Number of shards left to other instances.
+        """
+        # Start at a random shard so instances woken by the same notification spread out
+        offset = random.randrange(window['shards'])
+        shard_doc_ids = [self.__shard_doc_id((offset + i) % window['shards'])
+                         for i in range(window['shards'])]
+        shards = self.__state_store.get_documents_by_ids(shard_doc_ids)
+        pending = 0
+        for shard_doc_id in shard_doc_ids:
+            lease_id = f"{shard_doc_id}_lease"
+            if shards[shard_doc_id].get('done'):
+                continue
+            if not self.__state_store.acquire_lease(lease_id, owner, lease_seconds):
+                pending += 1
+                continue
+            try:
+                # Another instance may have finished it since it was read above
+                shard = self.__state_store.get_document_by_id(shard_doc_id, use_cache=False)
+                if shard['startHistoryId'] == window['startHistoryId'] and not shard['done']:
+                    if not self.__process_leased(shard['msgIds'], lease_id, owner, lease_seconds):
+                        logger.warning(f"Lost the lease of {shard_doc_id} to another instance")
+                        pending += 1
+                        continue
+                    self.__state_store.set_document_by_id(id=shard_doc_id,
+                                                          data={**shard, 'done': True})
+            finally:
+                self.__state_store.release_lease(lease_id, owner)
+        return pending
+
+    def sync_sharded(self,
+                     label_id: str = 'INBOX',
+                     history_types: List[str] = ["messageAdded", "labelAdded"],
+                     owner: Optional[str] = None,
+                     shard_size: int = 50,
+                     lease_seconds: float = 300) -> Optional[SyncResult]:
+        """
+        Sync with any number of instances sharing the same history window.
+
+        One instance walks the history and splits its messages into shards, every
+        instance then claims shards through leases in the StateManager, and whichever
+        instance sees all shards done advances the sync state with a compare-and-set so it
+        moves exactly once.
+
+        Parameters:
+        - label_id (str): Only sync messages with this label, defaults to 'INBOX'.
+        - history_types (List[str]): History types to sync.
+        - owner (str): Lease owner name of this instance, defaults to hostname, process ID
+          and a random suffix.
+        - shard_size (int): Number of messages per shard, defaults to 50.
+        - lease_seconds (float): How long a lease is held before other instances may take
+          it over, defaults to 300. It is renewed between the batches of a shard, so it must
+          outlast processing one batch, or one message per worker without batching.
+
+        Returns:
+        SyncResult: The new history ID, None if data was already up-to-date or other
+        instances are still syncing the window, and the stats. None if the history could not
+        be fetched.
+        """
+        owner = owner or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        return self.__instrumented(
+            lambda: self.__sync_window(label_id, history_types, owner, shard_size, lease_seconds),
+            labelId=label_id,
+            owner=owner,
+        )
+
+    def __sync_window(self,
+                      label_id: str,
+                      history_types: List[str],
+                      owner: str,
+                      shard_size: int,
+                      lease_seconds: float) -> Optional[SyncResult]:
+        self.__refresh_credentials_if_expired()
+
+        start_history_id = self.__get_last_sync_state().historyId
+        window = self.__find_document(f"{self.__sync_state_doc_id}_window")
+        if not window or window['startHistoryId'] != start_history_id:
+            try:
+                window = self.__plan_window(start_history_id, label_id, history_types, owner,
+                                            shard_size, lease_seconds)
+            except Exception as e:
+                logger.error(f"Failed to plan the history window: {str(e)}")
+                return
+        if window is None:
+            logger.info("Another instance is planning the history window")
+            return self.__sync_result(None, in_progress=True)
+        if not window['shards']:
+            logger.info("Data is already up-to-date")
+            return self.__sync_result(None)
+
+        pending = self.__process_shards(window, owner, lease_seconds)
+        if pending:
+            logger.info(f"{pending} shards are being processed by other instances")
+            return self.__sync_result(None, in_progress=True)
+
+        end_history_id = window['endHistoryId']
+        advanced = self.__state_store.compare_and_set(
+            self.__sync_state_doc_id,
+            {'historyId': start_history_id},
+            {'historyId': end_history_id, 'updatedTime': int(datetime.now().strftime('%s'))}
+        )
+        if advanced:
+            logger.info(f"Advanced sync state from {start_history_id} to {end_history_id}")
+        return self.__sync_result(end_history_id)
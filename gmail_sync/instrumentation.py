@@ -0,0 +1,174 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the histogram buckets, from a cached read to a slow upload
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Distribution of observed values in fixed buckets, with exact count, sum, min and max."""
+
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last count is for values above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the `q` quantile, or the maximum above them."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> Dict:
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+        }
+
+
+class Exporter(ABC):
+    """Receives the stats of every sync, e.g. to forward them to a metrics backend."""
+
+    @abstractmethod
+    def export(self, stats: Dict) -> None:
+        pass
+
+
+class LoggingExporter(Exporter):
+    """Logs the stats as a single JSON line, for log-based metrics."""
+
+    def __init__(self, event: str = 'gmail_sync_stats', level: int = logging.INFO):
+        self.__event = event
+        self.__level = level
+
+    def export(self, stats: Dict) -> None:
+        logger.log(self.__level, json.dumps({'event': self.__event, **stats}, default=str))
+
+
+class Instrumentation:
+    """
+    Thread-safe counters and per-stage timing histograms.
+
+    Stages are timed with `span`, which records the duration in the histogram of the stage,
+    and `export` hands a snapshot to every exporter attached.
+    """
+
+    def __init__(self, exporters: Optional[List[Exporter]] = None):
+        """
+        Initialization of Instrumentation class.
+
+        Parameters:
+        - exporters (List[Exporter]): Exporters receiving the stats, defaults to None which
+          logs them as JSON.
+        """
+        self.__exporters = list(exporters) if exporters is not None else [LoggingExporter()]
+        self.__lock = threading.Lock()
+        self.__counters: Dict[str, int] = {}
+        self.__histograms: Dict[str, Histogram] = {}
+
+    def add_exporter(self, exporter: Exporter) -> None:
+        with self.__lock:
+            self.__exporters.append(exporter)
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        with self.__lock:
+            if name not in self.__histograms:
+                self.__histograms[name] = Histogram()
+            self.__histograms[name].observe(value)
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Time the enclosed block as one observation of stage `name`, failed or not."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def timed_chunks(self, name: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        Time producing `chunks` as one observation of stage `name`, once they are consumed,
+        and count their bytes in `{name}.bytes`. Time spent by the consumer is left out.
+        """
+        elapsed, size = 0.0, 0
+        iterator = iter(chunks)
+        while True:
+            started = time.perf_counter()
+            chunk = next(iterator, None)
+            elapsed += time.perf_counter() - started
+            if chunk is None:
+                break
+            size += len(chunk)
+            yield chunk
+        self.observe(name, elapsed)
+        self.count(f'{name}.bytes', size)
+
+    def counter(self, name: str) -> int:
+        with self.__lock:
+            return self.__counters.get(name, 0)
+
+    def snapshot(self) -> Dict:
+        with self.__lock:
+            return {
+                'counters': dict(sorted(self.__counters.items())),
+                'spans': {name: histogram.snapshot()
+                          for name, histogram in sorted(self.__histograms.items())},
+            }
+
+    def reset(self) -> None:
+        with self.__lock:
+            self.__counters.clear()
+            self.__histograms.clear()
+
+    def export(self, **fields) -> Dict:
+        """
+        Send a snapshot along with `fields` to every exporter.
+
+        An exporter that fails is logged and skipped, so it never fails the sync.
+
+        Returns:
+        Dict: The stats exported.
+        """
+        stats = {**fields, **self.snapshot()}
+        with self.__lock:
+            exporters = list(self.__exporters)
+        for exporter in exporters:
+            try:
+                exporter.export(stats)
+            except Exception as e:
+                logger.warning(f"Failed to export stats with {type(exporter).__name__}: {str(e)}")
+        return stats
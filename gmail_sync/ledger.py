@@ -0,0 +1,112 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from state_manager import StateManager
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessedLedger:
+    """
+    Ledger of the messages and attachments that were already saved.
+
+    Completed messages are remembered in memory, so on a warm instance they are skipped
+    without reading the StateManager. Attachments are keyed by their MIME part ID because
+    Gmail hands out a different `attachmentId` every time a message is fetched.
+    """
+
+    def __init__(self, state_store: StateManager, doc_prefix: str = 'processed_'):
+        """
+        Initialization of ProcessedLedger class.
+
+        Parameters:
+        - state_store (StateManager): An instance of StateManager to keep the ledger in.
+        - doc_prefix (str): Document ID prefix of ledger entries, defaults to 'processed_'.
+        """
+        self.__state_store = state_store
+        self.__doc_prefix = doc_prefix
+        self.__processed: Set[str] = set()
+        self.__saved_attachments: Dict[str, Set[str]] = {}
+        # Unfinished messages whose entry was just read by `prefetch`
+        self.__prefetched: Set[str] = set()
+        self.__lock = threading.Lock()
+
+    def scoped(self, name: str) -> 'ProcessedLedger':
+        """A separate ledger kept in the same StateManager, for another pipeline."""
+        return ProcessedLedger(self.__state_store, doc_prefix=f"{self.__doc_prefix}{name}_")
+
+    def __get_entry(self, msg_id: str) -> Optional[Dict]:
+        try:
+            return self.__state_store.get_document_by_id(self.__doc_prefix + msg_id)
+        except RuntimeError:
+            return None
+
+    def __set_entry(self, msg_id: str, completed: bool, saved_attachments: Set[str]) -> None:
+        self.__state_store.set_document_by_id(
+            id=self.__doc_prefix + msg_id,
+            data={
+                'gmailMessageID': msg_id,
+                'completed': completed,
+                'attachments': sorted(saved_attachments),
+                'updatedTime': int(datetime.now().strftime('%s')),
+            }
+        )
+
+    def __load_entry(self, msg_id: str, entry: Optional[Dict]) -> bool:
+        entry = entry or {}
+        with self.__lock:
+            if entry.get('completed'):
+                self.__processed.add(msg_id)
+                return True
+            self.__saved_attachments[msg_id] = set(entry.get('attachments', []))
+        return False
+
+    def prefetch(self, msg_ids: List[str]) -> None:
+        """Read the entries of several messages in one call ahead of `is_processed`."""
+        unknown = [msg_id for msg_id in msg_ids if msg_id not in self.__processed]
+        if not unknown:
+            return
+        entries = self.__state_store.get_documents_by_ids(
+            [self.__doc_prefix + msg_id for msg_id in unknown]
+        )
+        for msg_id in unknown:
+            if not self.__load_entry(msg_id, entries[self.__doc_prefix + msg_id]):
+                with self.__lock:
+                    self.__prefetched.add(msg_id)
+
+    def is_processed(self, msg_id: str) -> bool:
+        """Check whether all attachments of a message were saved."""
+        if msg_id in self.__processed:
+            return True
+        with self.__lock:
+            if msg_id in self.__prefetched:
+                self.__prefetched.discard(msg_id)
+                return False
+
+        return self.__load_entry(msg_id, self.__get_entry(msg_id))
+
+    def saved_attachments(self, msg_id: str) -> Set[str]:
+        """Part IDs of the attachments of a partially processed message that were saved."""
+        with self.__lock:
+            saved = self.__saved_attachments.get(msg_id)
+        if saved is None:
+            saved = set((self.__get_entry(msg_id) or {}).get('attachments', []))
+            with self.__lock:
+                self.__saved_attachments[msg_id] = saved
+        return set(saved)
+
+    def mark_attachment_saved(self, msg_id: str, part_id: str) -> None:
+        with self.__lock:
+            saved = self.__saved_attachments.setdefault(msg_id, set())
+            saved.add(part_id)
+            saved = set(saved)
+        self.__set_entry(msg_id, completed=False, saved_attachments=saved)
+
+    def mark_processed(self, msg_id: str) -> None:
+        with self.__lock:
+            saved = self.__saved_attachments.pop(msg_id, set())
+            self.__processed.add(msg_id)
+        self.__set_entry(msg_id, completed=True, saved_attachments=saved)
@@ -1,23 +1,29 @@
 import json
 import logging
 import os
+import tempfile
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional
 
 import functions_framework
-from google_auth_oauthlib.flow import Flow
-from google.cloud import error_reporting
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials as OAuth2Credentials
-from googleapiclient.discovery import build
 
-from state_manager import FirestoreStateManager
-from storage_manager import GoogleCloudStorageManager
-from gmail_sync import GmailSync
+# Every handler is deployed from this module but only needs some of the Google client
+# libraries, so they are imported when first used to keep cold starts short.
+if TYPE_CHECKING:
+    from accounts import Account, MultiAccountSync
+    from google.cloud import error_reporting
+    from state_manager import FirestoreStateManager
+    from storage_manager import StorageManager
+    from gmail_sync import GmailSync
+    from notifications import NotificationCoalescer
+    from routing import Router
 
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 logging.basicConfig(level=LOG_LEVEL)
 
 FIRESTORE_DB = os.environ.get('FIRESTORE_DB', 'default')
 FIRESTORE_COLLECTION = os.environ.get('FIRESTORE_COLLECTION', 'gmail_sync')
+FIRESTORE_CACHE_TTL_SECONDS = float(os.environ.get('FIRESTORE_CACHE_TTL_SECONDS', '0'))
 SERVICE_ACCOUNT_KEY_FILE = os.environ.get('SERVICE_ACCOUNT_KEY_FILE')
 GMAIL_LABEL_ID = os.environ.get('GMAIL_LABEL_ID')
 GMAIL_NOTIFICATIONS_TOPIC = os.environ.get('GMAIL_NOTIFICATIONS_TOPIC')
@@ -29,44 +35,363 @@ GOOGLE_CREDENTIALS_DOCUMENT_ID = os.environ.get('GOOGLE_CREDENTIALS_DOCUMENT_ID'
                                                 'google_credentials')
 DESTINATION_BUCKET_NAME = os.environ.get('DESTINATION_BUCKET_NAME')
 DESTINATION_BASE_PATH = os.environ.get('DESTINATION_BASE_PATH')
+# Saves attachments under this local directory instead of the bucket, to run offline
+LOCAL_STORAGE_PATH = os.environ.get('LOCAL_STORAGE_PATH')
+STORAGE_UPLOAD_WORKERS = int(os.environ.get('STORAGE_UPLOAD_WORKERS', '8'))
+STORAGE_CONNECTION_POOL_SIZE = int(os.environ.get('STORAGE_CONNECTION_POOL_SIZE', '0')) or None
 SYNC_STATE_DOCUMENT_ID = os.environ.get('SYNC_STATE_DOCUMENT_ID')
+GMAIL_BATCH_SIZE = int(os.environ.get('GMAIL_BATCH_SIZE', '0'))
+GMAIL_SYNC_MAX_WORKERS = int(os.environ.get('GMAIL_SYNC_MAX_WORKERS', '1'))
+GMAIL_SYNC_DEDUPLICATE = os.environ.get('GMAIL_SYNC_DEDUPLICATE', 'false').lower() == 'true'
+GMAIL_SYNC_TRACK_PROCESSED = os.environ.get('GMAIL_SYNC_TRACK_PROCESSED',
+                                            'false').lower() == 'true'
+# Only useful when the function serves concurrent requests, see NotificationCoalescer
+GMAIL_SYNC_DEBOUNCE_SECONDS = float(os.environ.get('GMAIL_SYNC_DEBOUNCE_SECONDS', '0'))
+GMAIL_ROUTING_DOCUMENT_ID = os.environ.get('GMAIL_ROUTING_DOCUMENT_ID')
+GMAIL_ROUTING_OBJECT_KEY = os.environ.get('GMAIL_ROUTING_OBJECT_KEY')
+GMAIL_ROUTING_REFRESH_SECONDS = float(os.environ.get('GMAIL_ROUTING_REFRESH_SECONDS', '60'))
+GMAIL_SYNC_SHARDED = os.environ.get('GMAIL_SYNC_SHARDED', 'false').lower() == 'true'
+GMAIL_SYNC_SHARD_SIZE = int(os.environ.get('GMAIL_SYNC_SHARD_SIZE', '50'))
+GMAIL_SYNC_LEASE_SECONDS = float(os.environ.get('GMAIL_SYNC_LEASE_SECONDS', '300'))
+# Share of the per-user Gmail quota of 250 units per second this function may use
+GMAIL_QUOTA_UNITS_PER_SECOND = float(os.environ.get('GMAIL_QUOTA_UNITS_PER_SECOND', '250'))
+GMAIL_MAX_CONCURRENCY = int(os.environ.get('GMAIL_MAX_CONCURRENCY', '0')) or GMAIL_SYNC_MAX_WORKERS * 2
+GMAIL_MAX_RETRIES = int(os.environ.get('GMAIL_MAX_RETRIES', '5'))
+# Messages are fetched in full only if their metadata passes these filters, when any is set
+GMAIL_FETCH_SENDERS = [s.strip() for s in os.environ.get('GMAIL_FETCH_SENDERS', '').split(',') if s.strip()]
+GMAIL_FETCH_LABEL_IDS = [s.strip() for s in os.environ.get('GMAIL_FETCH_LABEL_IDS', '').split(',') if s.strip()]
+GMAIL_FETCH_MAX_BYTES = int(os.environ.get('GMAIL_FETCH_MAX_BYTES', '0')) or None
+GMAIL_FETCH_ROUTED_ONLY = os.environ.get('GMAIL_FETCH_ROUTED_ONLY', 'false').lower() == 'true'
+# Attachments downloaded when their routing rule has no filter of its own, when any is set
+GMAIL_ATTACHMENT_MIME_TYPES = [s.strip() for s in os.environ.get('GMAIL_ATTACHMENT_MIME_TYPES', '').split(',')
+                               if s.strip()]
+GMAIL_ATTACHMENT_FILENAMES = [s.strip() for s in os.environ.get('GMAIL_ATTACHMENT_FILENAMES', '').split(',')
+                              if s.strip()]
+GMAIL_ATTACHMENT_MIN_BYTES = int(os.environ.get('GMAIL_ATTACHMENT_MIN_BYTES', '0')) or None
+GMAIL_ATTACHMENT_MAX_BYTES = int(os.environ.get('GMAIL_ATTACHMENT_MAX_BYTES', '0')) or None
+GMAIL_DEFER_OVERSIZED_ATTACHMENTS = os.environ.get('GMAIL_DEFER_OVERSIZED_ATTACHMENTS',
+                                                   'false').lower() == 'true'
+GMAIL_FETCH_THREADS = os.environ.get('GMAIL_FETCH_THREADS', 'false').lower() == 'true'
+# Labels synced together from one history walk, as "labelId:prefix,...", instead of GMAIL_LABEL_ID
+GMAIL_LABEL_PATHS = dict(
+    (label_path.split(':', 1) + [''])[:2]
+    for label_path in (s.strip() for s in os.environ.get('GMAIL_LABEL_PATHS', '').split(','))
+    if label_path
+)
+# Registry of the accounts synced by sync_accounts_handler, and how many sync at once. The
+# OAuth consent of an account is requested with a state of "account:{id}", and the other
+# token and watch handlers take the account as an `account` query parameter
+ACCOUNT_STATE_PREFIX = 'account:'
+GMAIL_ACCOUNTS_DOCUMENT_ID = os.environ.get('GMAIL_ACCOUNTS_DOCUMENT_ID', 'gmail_accounts')
+GMAIL_ACCOUNTS_MAX_WORKERS = int(os.environ.get('GMAIL_ACCOUNTS_MAX_WORKERS', '4'))
 
 
-@functions_framework.http
-def download_attachments_handler(request):
-    reporting_client = error_reporting.Client()
-    try:
-        state_store = FirestoreStateManager(
-            database=FIRESTORE_DB,
-            collection=FIRESTORE_COLLECTION,
-            service_account_file=SERVICE_ACCOUNT_KEY_FILE,
+# Clients kept for the life of a warm instance, so each request skips the setup cost
+_clients: Dict[str, Any] = {}
+_clients_lock = threading.RLock()
+
+
+def _get_client(name: str, factory: Callable[[], Any]) -> Any:
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+
+def _evict_client(name: str) -> None:
+    with _clients_lock:
+        client = _clients.pop(name, None)
+    # Release what the client holds, e.g. the download threads of a GmailSync
+    if hasattr(client, 'close'):
+        client.close()
+
+
+def get_reporting_client() -> 'error_reporting.Client':
+    def create_reporting_client():
+        from google.cloud import error_reporting
+        return error_reporting.Client()
+    return _get_client('error_reporting', create_reporting_client)
+
+
+def get_state_store() -> 'FirestoreStateManager':
+    from state_manager import FirestoreStateManager
+    return _get_client('state_store', lambda: FirestoreStateManager(
+        database=FIRESTORE_DB,
+        collection=FIRESTORE_COLLECTION,
+        service_account_file=SERVICE_ACCOUNT_KEY_FILE,
+        cache_ttl_seconds=FIRESTORE_CACHE_TTL_SECONDS,
+    ))
+
+
+def get_storage() -> 'StorageManager':
+    if LOCAL_STORAGE_PATH:
+        from storage_manager import LocalFileStorageManager
+        return _get_client('storage', lambda: LocalFileStorageManager(LOCAL_STORAGE_PATH))
+
+    from storage_manager import GoogleCloudStorageManager
+    return _get_client('storage', lambda: GoogleCloudStorageManager(
+        bucket=DESTINATION_BUCKET_NAME,
+        service_account_file=SERVICE_ACCOUNT_KEY_FILE,
+        max_workers=STORAGE_UPLOAD_WORKERS,
+        pool_size=STORAGE_CONNECTION_POOL_SIZE,
+    ))
+
+
+def get_router() -> 'Router':
+    def create_router():
+        from routing import Router, StateManagerRoutingSource, StorageRoutingSource
+
+        source = None
+        if GMAIL_ROUTING_DOCUMENT_ID:
+            source = StateManagerRoutingSource(get_state_store(), GMAIL_ROUTING_DOCUMENT_ID)
+        elif GMAIL_ROUTING_OBJECT_KEY:
+            source = StorageRoutingSource(get_storage(), GMAIL_ROUTING_OBJECT_KEY)
+        return Router(source, refresh_seconds=GMAIL_ROUTING_REFRESH_SECONDS)
+    return _get_client('router', create_router)
+
+
+def _create_gmail_sync(base_path: str,
+                       credentials_doc_id: str,
+                       sync_state_doc_id: str,
+                       doc_prefix: str = '',
+                       credentials_cache_path: str = 'token.json') -> 'GmailSync':
+    """GmailSync of one mailbox, with stats and a quota scheduler of its own."""
+    from gmail_sync import GmailSync, MessageFilter
+    from instrumentation import Instrumentation
+    from ledger import ProcessedLedger
+    from routing import AttachmentFilter
+    from scheduler import QuotaScheduler
+
+    state_store = get_state_store()
+    instrumentation = Instrumentation()
+    message_filter = None
+    if GMAIL_FETCH_SENDERS or GMAIL_FETCH_LABEL_IDS or GMAIL_FETCH_MAX_BYTES \
+            or GMAIL_FETCH_ROUTED_ONLY:
+        message_filter = MessageFilter(
+            senders=GMAIL_FETCH_SENDERS or None,
+            label_ids=GMAIL_FETCH_LABEL_IDS or None,
+            max_size=GMAIL_FETCH_MAX_BYTES,
+            routed_only=GMAIL_FETCH_ROUTED_ONLY,
         )
-        gcs_store = GoogleCloudStorageManager(
-            bucket=DESTINATION_BUCKET_NAME,
-            service_account_file=SERVICE_ACCOUNT_KEY_FILE,
+    attachment_filter = None
+    if GMAIL_ATTACHMENT_MIME_TYPES or GMAIL_ATTACHMENT_FILENAMES \
+            or GMAIL_ATTACHMENT_MIN_BYTES or GMAIL_ATTACHMENT_MAX_BYTES:
+        attachment_filter = AttachmentFilter(
+            mime_types=GMAIL_ATTACHMENT_MIME_TYPES or None,
+            filenames=GMAIL_ATTACHMENT_FILENAMES or None,
+            min_size=GMAIL_ATTACHMENT_MIN_BYTES,
+            max_size=GMAIL_ATTACHMENT_MAX_BYTES,
         )
-        gmail_sync = GmailSync(
-            state_store=state_store,
-            storage=gcs_store,
-            base_path=DESTINATION_BASE_PATH,
-            credentials_doc_id=GOOGLE_CREDENTIALS_DOCUMENT_ID,
-            sync_state_doc_id=SYNC_STATE_DOCUMENT_ID
+    return GmailSync(
+        state_store=state_store,
+        storage=get_storage(),
+        base_path=base_path,
+        credentials_cache_path=credentials_cache_path,
+        credentials_doc_id=credentials_doc_id,
+        sync_state_doc_id=sync_state_doc_id,
+        batch_size=GMAIL_BATCH_SIZE,
+        max_workers=GMAIL_SYNC_MAX_WORKERS,
+        deduplicate=GMAIL_SYNC_DEDUPLICATE,
+        dedup_doc_prefix=f'attachment_sha256_{doc_prefix}',
+        ledger=ProcessedLedger(state_store, doc_prefix=f'processed_{doc_prefix}')
+        if GMAIL_SYNC_TRACK_PROCESSED else None,
+        router=get_router(),
+        instrumentation=instrumentation,
+        scheduler=QuotaScheduler(
+            units_per_second=GMAIL_QUOTA_UNITS_PER_SECOND,
+            max_concurrency=GMAIL_MAX_CONCURRENCY,
+            max_retries=GMAIL_MAX_RETRIES,
+            instrumentation=instrumentation,
+        ),
+        message_filter=message_filter,
+        attachment_filter=attachment_filter,
+        defer_oversized=GMAIL_DEFER_OVERSIZED_ATTACHMENTS,
+        fetch_threads=GMAIL_FETCH_THREADS,
+    )
+
+
+def get_gmail_sync() -> 'GmailSync':
+    return _get_client('gmail_sync', lambda: _create_gmail_sync(
+        base_path=DESTINATION_BASE_PATH,
+        credentials_doc_id=GOOGLE_CREDENTIALS_DOCUMENT_ID,
+        sync_state_doc_id=SYNC_STATE_DOCUMENT_ID,
+    ))
+
+
+def get_multi_account_sync() -> 'MultiAccountSync':
+    def create_multi_account_sync():
+        from accounts import AccountRegistry, MultiAccountSync
+
+        return MultiAccountSync(
+            AccountRegistry(get_state_store(), GMAIL_ACCOUNTS_DOCUMENT_ID),
+            # Ledger and content index entries are kept apart, so accounts never share files
+            create_sync=lambda account: _create_gmail_sync(
+                base_path='/'.join(path for path in (DESTINATION_BASE_PATH, account.base_path) if path),
+                credentials_doc_id=account.credentials_doc_id,
+                sync_state_doc_id=account.sync_state_doc_id,
+                doc_prefix=f'{account.account_id}_',
+                # Each account caches its own token, or they would all use the first one cached
+                credentials_cache_path=os.path.join(tempfile.gettempdir(),
+                                                    f'token_{account.account_id}.json'),
+            ),
+            max_workers=GMAIL_ACCOUNTS_MAX_WORKERS,
+            debounce_seconds=GMAIL_SYNC_DEBOUNCE_SECONDS,
+        )
+    return _get_client('multi_account_sync', create_multi_account_sync)
+
+
+def _get_account(request) -> Optional['Account']:
+    """
+    Account a request is about, named by its `account` query parameter, or by an OAuth
+    `state` of 'account:{id}' on the consent redirect. None for the single mailbox.
+    """
+    state = request.args.get('state') or ''
+    account_id = request.args.get('account') or (
+        state[len(ACCOUNT_STATE_PREFIX):] if state.startswith(ACCOUNT_STATE_PREFIX) else None)
+    if not account_id:
+        return None
+    account = get_multi_account_sync().registry.get(account_id)
+    if not account:
+        raise ValueError(f"No account is registered with ID {account_id}")
+    return account
+
+
+def get_coalescer() -> 'NotificationCoalescer':
+    from notifications import NotificationCoalescer
+    return _get_client('coalescer', lambda: NotificationCoalescer(
+        debounce_seconds=GMAIL_SYNC_DEBOUNCE_SECONDS,
+    ))
+
+
+def _sync():
+    if GMAIL_LABEL_PATHS:
+        result = get_gmail_sync().sync_labels(
+            label_paths=GMAIL_LABEL_PATHS,
+            history_types=GMAIL_HISTORY_TYPES,
+        )
+    elif GMAIL_SYNC_SHARDED:
+        result = get_gmail_sync().sync_sharded(
+            label_id=GMAIL_LABEL_ID,
+            history_types=GMAIL_HISTORY_TYPES,
+            shard_size=GMAIL_SYNC_SHARD_SIZE,
+            lease_seconds=GMAIL_SYNC_LEASE_SECONDS,
         )
-        return gmail_sync.sync(
+    else:
+        result = get_gmail_sync().sync(
             label_id=GMAIL_LABEL_ID,
             history_types=GMAIL_HISTORY_TYPES,
         )
+    if result is None:
+        raise RuntimeError("Failed to sync Gmail history")
+    # A SyncResult is answered as JSON, without the stats that are logged already
+    return str(result)
+
+
+def _get_synced_history_id():
+    if GMAIL_LABEL_PATHS:
+        # The labels are synced to the history ID of their last walk, none before the first one
+        doc_id = f"{SYNC_STATE_DOCUMENT_ID}_labels"
+        state = get_state_store().get_documents_by_ids([doc_id])[doc_id]
+        return state['historyId'] if state else 0
+    return get_state_store().get_document_by_id(SYNC_STATE_DOCUMENT_ID)['historyId']
+
+
+@functions_framework.http
+def download_attachments_handler(request):
+    try:
+        from notifications import parse_notification
+
+        notification = parse_notification(request.get_json(silent=True))
+        if not notification:
+            # Requests are served concurrently, but the GmailSync they share syncs one at a time
+            return get_coalescer().run_now(_sync)
+
+        result = get_coalescer().run(
+            notification.history_id,
+            sync=_sync,
+            get_synced_history_id=_get_synced_history_id,
+        )
+        if result is None:
+            return f"History {notification.history_id} is already synced"
+        return result
     except Exception:
-        reporting_client.report_exception()
+        # Rebuild the client on the next request, e.g. after the credentials were revoked
+        _evict_client('gmail_sync')
+        get_reporting_client().report_exception()
+
+
+@functions_framework.http
+def backfill_handler(request):
+    try:
+        from datetime import date
+
+        body = request.get_json(silent=True) or {}
+        query = body.get('query')
+        if not query:
+            return "Query not found in the request body"
+        after = body.get('after')
+        if not after:
+            return "Start date `after` not found in the request body"
+        try:
+            start_date = date.fromisoformat(after)
+            end_date = date.fromisoformat(body.get('before') or date.today().isoformat())
+        except (TypeError, ValueError) as e:
+            return f"Invalid date in the request body, expected YYYY-MM-DD: {str(e)}"
+        return str(get_gmail_sync().backfill(
+            query=query,
+            start_date=start_date,
+            end_date=end_date,
+            shard_days=int(body.get('shardDays', 30)),
+        ))
+    except Exception:
+        get_reporting_client().report_exception()
+
+
+@functions_framework.http
+def deferred_attachments_handler(request):
+    try:
+        return f"{get_gmail_sync().process_deferred()} deferred attachments saved"
+    except Exception:
+        get_reporting_client().report_exception()
+
+
+@functions_framework.http
+def sync_accounts_handler(request):
+    try:
+        from notifications import parse_notification
+
+        multi_account_sync = get_multi_account_sync()
+        account_ids = (request.get_json(silent=True) or {}).get('accounts')
+        history_id = None
+        notification = parse_notification(request.get_json(silent=True))
+        if notification:
+            # Only the mailbox the notification is about needs a sync
+            account = multi_account_sync.registry.find_by_email(notification.email_address)
+            if not account:
+                return f"No account is registered for {notification.email_address}"
+            account_ids = [account.account_id]
+            history_id = notification.history_id
+
+        results = multi_account_sync.sync_all(history_types=GMAIL_HISTORY_TYPES,
+                                              account_ids=account_ids,
+                                              history_id=history_id)
+        failed = [result.account_id for result in results if not result.succeeded]
+        if failed:
+            get_reporting_client().report(f"Failed to sync Gmail accounts {failed}")
+        return json.dumps({result.account_id: result.to_dict() for result in results})
+    except Exception:
+        get_reporting_client().report_exception()
+
 
 @functions_framework.http
 def callback_handler(request):
-    reporting_client = error_reporting.Client()
     try:
         code = request.args.get('code')
         if not code:
             return "Code not found the request url"
 
+        from google_auth_oauthlib.flow import Flow
+
         flow = Flow.from_client_secrets_file(
             client_secrets_file=GOOGLE_CLIENT_SECRETS_FILE,
             scopes=GOOGLE_OAUTH_SCOPES,
@@ -74,59 +399,59 @@ def callback_handler(request):
         )
         flow.fetch_token(code=code)
         creds = flow.credentials
-        state_store = FirestoreStateManager(
-            database=FIRESTORE_DB,
-            collection=FIRESTORE_COLLECTION,
-            service_account_file=SERVICE_ACCOUNT_KEY_FILE,
-        )
+        account = _get_account(request)
+        state_store = get_state_store()
         status = state_store.set_document_by_id(
-            GOOGLE_CREDENTIALS_DOCUMENT_ID,
+            account.credentials_doc_id if account else GOOGLE_CREDENTIALS_DOCUMENT_ID,
             json.loads(creds.to_json())
         )
         return f"Successfully retrieved access token <br/>{status}"
 
     except Exception:
-        reporting_client.report_exception()
+        get_reporting_client().report_exception()
 
 
 @functions_framework.http
 def refresh_token_handler(request):
-    reporting_client = error_reporting.Client()
     try:
-        state_store = FirestoreStateManager(
-            database=FIRESTORE_DB,
-            collection=FIRESTORE_COLLECTION,
-            service_account_file=SERVICE_ACCOUNT_KEY_FILE,
-        )
-        creds_doc = state_store.get_document_by_id(GOOGLE_CREDENTIALS_DOCUMENT_ID)
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials as OAuth2Credentials
+
+        account = _get_account(request)
+        credentials_doc_id = account.credentials_doc_id if account else GOOGLE_CREDENTIALS_DOCUMENT_ID
+        state_store = get_state_store()
+        creds_doc = state_store.get_document_by_id(credentials_doc_id)
         creds = OAuth2Credentials.from_authorized_user_info(creds_doc)
         creds.refresh(Request())
         status = state_store.set_document_by_id(
-            GOOGLE_CREDENTIALS_DOCUMENT_ID,
+            credentials_doc_id,
             json.loads(creds.to_json())
         )
         return f"Token is successfully refreshed <br/>{status}"
     except Exception:
-        reporting_client.report_exception()
+        get_reporting_client().report_exception()
 
 
 @functions_framework.http
 def renew_watch_handler(request):
-    reporting_client = error_reporting.Client()
     try:
-        state_store = FirestoreStateManager(
-            database=FIRESTORE_DB,
-            collection=FIRESTORE_COLLECTION,
-            service_account_file=SERVICE_ACCOUNT_KEY_FILE,
+        from google.oauth2.credentials import Credentials as OAuth2Credentials
+        from googleapiclient.discovery import build
+
+        # An account is watched on its own label, notifications of its address sync it
+        account = _get_account(request)
+        state_store = get_state_store()
+        creds_doc = state_store.get_document_by_id(
+            account.credentials_doc_id if account else GOOGLE_CREDENTIALS_DOCUMENT_ID
         )
-        creds_doc = state_store.get_document_by_id(GOOGLE_CREDENTIALS_DOCUMENT_ID)
         creds = OAuth2Credentials.from_authorized_user_info(creds_doc)
-        gmail = build('gmail', 'v1', credentials=creds)
+        gmail = build('gmail', 'v1', credentials=creds,
+                      static_discovery=True, cache_discovery=False)
         watch_request = {
-            'labelIds': [GMAIL_LABEL_ID],
+            'labelIds': [account.label_id] if account else list(GMAIL_LABEL_PATHS) or [GMAIL_LABEL_ID],
             'topicName': GMAIL_NOTIFICATIONS_TOPIC,
             'labelFilterBehavior': 'INCLUDE'
         }
         return gmail.users().watch(userId='me', body=watch_request).execute()
     except Exception:
-        reporting_client.report_exception()
+        get_reporting_client().report_exception()
@@ -1,5 +1,7 @@
-from dataclasses import dataclass
-from typing import List
+import base64
+import json
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterator, List, Optional
 
 
 @dataclass
@@ -7,7 +9,23 @@ class Attachment:
     id: str
     filename: str | None
     mime_type: str | None
-    data: bytes
+    data: bytes | None = None
+    # URL-safe base64 content as returned by Gmail, decoded lazily by `iter_data`
+    encoded_data: str | None = None
+    part_id: str | None = None
+
+    def iter_data(self, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+        """Yield the decoded content in chunks of about `chunk_size` bytes."""
+        if self.data is not None:
+            for i in range(0, len(self.data), chunk_size):
+                yield self.data[i:i + chunk_size]
+            return
+
+        # Every 4 base64 characters decode to 3 bytes on their own
+        step = max(chunk_size // 3, 1) * 4
+        for i in range(0, len(self.encoded_data or ''), step):
+            chunk = self.encoded_data[i:i + step]
+            yield base64.urlsafe_b64decode(chunk + '=' * (-len(chunk) % 4))
 
 
 @dataclass
@@ -24,3 +42,37 @@ class Message:
 class WatchResult:
     history_id: str
     expiration: int
+
+
+@dataclass
+class HistoryPage:
+    msg_ids: List[str]
+    history_id: str
+    next_page_token: Optional[str]
+    # Thread ID of each message ID, when known
+    thread_ids: Dict[str, str] = field(default_factory=dict)
+    # The history records of the page as returned by Gmail
+    history: List[Dict] = field(default_factory=list)
+
+
+@dataclass
+class SyncResult:
+    # History ID the sync state was advanced to, or None if there was no new history
+    history_id: Optional[str]
+    messages: int = 0
+    failed_messages: int = 0
+    attachments: int = 0
+    bytes_downloaded: int = 0
+    # Gmail API calls sent again after being throttled or dropped
+    retries: int = 0
+    # Other instances are still syncing the history window, see GmailSync.sync_sharded
+    in_progress: bool = False
+    # Counters and per-stage timings, see Instrumentation.snapshot
+    stats: Dict = field(default_factory=dict)
+
+    @property
+    def up_to_date(self) -> bool:
+        return self.history_id is None and not self.in_progress
+
+    def __str__(self) -> str:
+        return json.dumps({k: v for k, v in asdict(self).items() if k != 'stats'})
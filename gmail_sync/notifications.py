@@ -0,0 +1,123 @@
+import base64
+import json
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, TypeVar
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+@dataclass
+class GmailNotification:
+    email_address: str
+    history_id: int
+
+
+def parse_notification(envelope: Optional[Dict]) -> Optional[GmailNotification]:
+    """
+    Decode the Gmail push notification carried by a Pub/Sub message.
+
+    Parameters:
+    - envelope (Dict): Body of the Pub/Sub push request or CloudEvent.
+
+    Returns:
+    GmailNotification: The notification, or None if the body does not carry one.
+    """
+    try:
+        data = json.loads(base64.b64decode(envelope['message']['data']))
+        return GmailNotification(
+            email_address=data.get('emailAddress'),
+            history_id=int(data['historyId']),
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        logger.warning(f"Request does not carry a Gmail notification: {str(e)}")
+        return None
+
+
+class NotificationCoalescer:
+    """
+    Runs one sync for a burst of Gmail notifications.
+
+    A sync started after a notification arrived covers the history it announces, so
+    notifications that arrive while a sync is waiting or running only need to wait for
+    it and can then return without syncing again.
+
+    Debouncing only gathers notifications that reach the same instance while it waits,
+    so it needs the function to serve concurrent requests; with one request at a time it
+    only delays the sync.
+    """
+
+    def __init__(self, debounce_seconds: float = 0.0):
+        """
+        Initialization of NotificationCoalescer class.
+
+        Parameters:
+        - debounce_seconds (float): How long to wait for the rest of a burst before
+          syncing, defaults to 0.
+        """
+        self.__debounce_seconds = debounce_seconds
+        self.__sync_lock = threading.Lock()
+        self.__lock = threading.Lock()
+        self.__latest_history_id = 0
+        self.__synced_history_id = 0
+
+    def is_synced(self, history_id: int) -> bool:
+        with self.__lock:
+            return history_id <= self.__synced_history_id
+
+    def run(self,
+            history_id: int,
+            sync: Callable[[], T],
+            get_synced_history_id: Callable[[], int]) -> Optional[T]:
+        """
+        Sync unless the history of the notification is already synced.
+
+        Parameters:
+        - history_id (int): History ID announced by the notification.
+        - sync (Callable): Runs the sync.
+        - get_synced_history_id (Callable): Reads the history ID of the stored sync state,
+          called only when this instance has not synced the notification itself.
+
+        Returns:
+        The result of `sync`, or None if the notification did not need a sync.
+        """
+        with self.__lock:
+            self.__latest_history_id = max(self.__latest_history_id, history_id)
+        if self.is_synced(history_id):
+            return None
+
+        with self.__sync_lock:
+            if self.is_synced(history_id):
+                return None
+            # Another instance or an earlier invocation may have synced past it already
+            synced_history_id = int(get_synced_history_id())
+            with self.__lock:
+                self.__synced_history_id = max(self.__synced_history_id, synced_history_id)
+            if self.is_synced(history_id):
+                return None
+
+            if self.__debounce_seconds:
+                time.sleep(self.__debounce_seconds)
+            return self.__sync(sync)
+
+    def run_now(self, sync: Callable[[], T]) -> T:
+        """
+        Sync without a notification, e.g. for a scheduled request, still one sync at a time
+        with the ones run for notifications.
+        """
+        with self.__sync_lock:
+            return self.__sync(sync)
+
+    def __sync(self, sync: Callable[[], T]) -> T:
+        # A sync covers every notification that arrived before it started
+        with self.__lock:
+            covered_history_id = self.__latest_history_id
+        result = sync()
+        with self.__lock:
+            self.__synced_history_id = max(self.__synced_history_id, covered_history_id)
+        return result
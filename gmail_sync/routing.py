@@ -0,0 +1,348 @@
+import fnmatch
+import json
+import logging
+import re
+import string
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from state_manager import StateManager
+from storage_manager import StorageManager
+
+
+logger = logging.getLogger(__name__)
+
+
+STATEMENT_DATE = r'\((?P<dom>\d\d)/(?P<month>\d\d)/(?P<year>\d{4})\)'
+DEFAULT_RULES = [
+    {
+        'from': 'statement@centralthe1card.com',
+        'subject': STATEMENT_DATE,
+        'path': 'centralthe1card/statement_date={year}-{month}-{dom}/{filename}',
+    },
+    {
+        'from': 'statement@firstchoicecard.com',
+        'subject': STATEMENT_DATE,
+        'path': 'firstchoicecard/statement_date={year}-{month}-{dom}/{filename}',
+    },
+]
+# Fields a path template may use besides the named groups of its subject pattern
+PATH_FIELDS = {'filename', 'sender', 'domain'}
+GROUP_REFERENCE = re.compile(r'\(\?P([<=])(\w+)')
+# Inline flags at the start of a subject, which apply to the whole of a combined regex
+GLOBAL_FLAGS = re.compile(r'^\(\?([aiLmsux]+)\)')
+
+
+@dataclass
+class AttachmentFilter:
+    """
+    Which attachment parts are downloaded, judged before downloading them.
+
+    MIME types and filenames are matched against glob patterns such as 'image/*' or
+    '*.pdf', case-insensitively; sizes are the part sizes Gmail reports, in bytes.
+    Unset conditions accept anything.
+    """
+    mime_types: Optional[List[str]] = None
+    filenames: Optional[List[str]] = None
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+
+    def matches(self, filename: Optional[str], mime_type: Optional[str]) -> bool:
+        """Whether the MIME type and filename are wanted, whatever the size."""
+        def any_match(value, patterns):
+            return patterns is None \
+                or any(fnmatch.fnmatch((value or '').lower(), p.lower()) for p in patterns)
+        return any_match(mime_type, self.mime_types) and any_match(filename, self.filenames)
+
+    def is_oversized(self, size: int) -> bool:
+        return self.max_size is not None and size > self.max_size
+
+    def accepts(self, filename: Optional[str], mime_type: Optional[str], size: int) -> bool:
+        return self.matches(filename, mime_type) and not self.is_oversized(size) \
+            and (self.min_size is None or size >= self.min_size)
+
+
+def parse_attachment_filter(config: Dict) -> Optional[AttachmentFilter]:
+    """
+    Build an AttachmentFilter from the `mimeTypes`, `filenames`, `minSize` and `maxSize`
+    keys of a config, or None if it has none of them.
+    """
+    if not {'mimeTypes', 'filenames', 'minSize', 'maxSize'} & set(config):
+        return None
+    for key in ('mimeTypes', 'filenames'):
+        if config.get(key) is not None and (not isinstance(config[key], list)
+                                            or not all(isinstance(p, str) for p in config[key])):
+            raise ValueError(f"`{key}` must be a list of glob patterns")
+    for key in ('minSize', 'maxSize'):
+        if config.get(key) is not None and not isinstance(config[key], int):
+            raise ValueError(f"`{key}` must be a number of bytes")
+    return AttachmentFilter(mime_types=config.get('mimeTypes'), filenames=config.get('filenames'),
+                            min_size=config.get('minSize'), max_size=config.get('maxSize'))
+
+
+@dataclass
+class RoutingRule:
+    index: int
+    sender: Optional[str]
+    subject: str
+    path: str
+    # Attachments of the messages this rule routes that are downloaded, None for all
+    attachments: Optional[AttachmentFilter] = None
+
+
+def scope_flags(subject: str) -> str:
+    """Turn inline flags at the start of `subject`, like '(?i)', into a group they are scoped to."""
+    flags = ''
+    found = GLOBAL_FLAGS.match(subject)
+    while found:
+        flags += found[1]
+        subject = subject[found.end():]
+        found = GLOBAL_FLAGS.match(subject)
+    return f"(?{flags}:{subject})" if flags else subject
+
+
+def parse_rule(index: int, rule: Dict) -> RoutingRule:
+    """
+    Validate a rule of the routing config.
+
+    A rule has a `path` template and optionally a `from` sender, which is an exact address,
+    a domain written as '*@example.com', or '*' for any sender, and a `subject` regex.
+    The template is formatted with the named groups of the regex and `filename`, `sender`
+    and `domain`, and named groups that did not match are empty. Inline flags at the start
+    of the regex, like '(?i)', only apply to the rule. The attachments downloaded can be
+    limited with `mimeTypes`, `filenames`, `minSize` and `maxSize`, see AttachmentFilter.
+    """
+    try:
+        path = rule['path']
+        pattern = re.compile(scope_flags(rule.get('subject') or ''))
+        attachments = parse_attachment_filter(rule)
+        # Checked on its own, so a rule never breaks the matchers it is combined into
+        RuleMatcher([RoutingRule(index=index, sender=None, subject=pattern.pattern, path=path)])
+    except (KeyError, TypeError, ValueError, re.error) as e:
+        raise ValueError(f"Invalid routing rule {index}: {str(e)}") from e
+
+    fields = {field.split('.')[0].split('[')[0]
+              for _, field, _, _ in string.Formatter().parse(path) if field}
+    unknown = fields - PATH_FIELDS - set(pattern.groupindex)
+    if unknown:
+        raise ValueError(f"Routing rule {index} uses unknown path fields: {sorted(unknown)}")
+
+    sender = (rule.get('from') or '*').strip().lower()
+    return RoutingRule(index=index, sender=None if sender == '*' else sender,
+                       subject=pattern.pattern, path=path, attachments=attachments)
+
+
+class RuleMatcher:
+    """
+    Matches a subject against several rules with a single combined regex.
+
+    Every alternative is anchored at the start and scans forward lazily, so the regex
+    engine tries the rules in order and the first rule that matches anywhere in the
+    subject wins, as if each was searched one after another. Named groups are prefixed
+    with the rule position to keep them apart; numbered backreferences are not supported.
+    """
+
+    def __init__(self, rules: List[RoutingRule]):
+        self.rules = rules
+        alternatives = []
+        for i, rule in enumerate(rules):
+            subject = GROUP_REFERENCE.sub(lambda m: f"(?P{m[1]}_r{i}_{m[2]}", rule.subject)
+            # Only the scan crosses line breaks, '.' in the rule keeps its own meaning
+            alternatives.append(f"(?:(?s:.*?)(?P<_r{i}>{subject}))")
+        self.__pattern = re.compile('|'.join(alternatives))
+
+    def match(self, subject: str) -> Optional[Tuple[RoutingRule, Dict[str, str]]]:
+        found = self.__pattern.match(subject)
+        if not found:
+            return None
+        # The group wrapping a rule closes after the groups inside it
+        i = int(found.lastgroup[2:])
+        prefix = f"_r{i}_"
+        # Optional groups that did not match format as empty path fields
+        groups = {name[len(prefix):]: value or '' for name, value in found.groupdict().items()
+                  if name.startswith(prefix)}
+        return self.rules[i], groups
+
+
+class CompiledRules:
+    """
+    Routing rules indexed by exact address and by domain.
+
+    Rules of an exact address come before rules of its domain, which come before rules for
+    any sender; within each the config order is kept. The candidate rules of every known
+    address and domain are compiled into one matcher up front.
+    """
+
+    def __init__(self, rules: List[Dict], version: Optional[str] = None):
+        self.version = version
+        parsed = [parse_rule(i, rule) for i, rule in enumerate(rules)]
+
+        exact: Dict[str, List[RoutingRule]] = {}
+        domains: Dict[str, List[RoutingRule]] = {}
+        any_sender = []
+        for rule in parsed:
+            if rule.sender is None:
+                any_sender.append(rule)
+            elif rule.sender.startswith(('*@', '@')):
+                domains.setdefault(rule.sender.split('@', 1)[1], []).append(rule)
+            else:
+                exact.setdefault(rule.sender, []).append(rule)
+
+        def matcher(candidates):
+            try:
+                return RuleMatcher(candidates) if candidates else None
+            except re.error as e:
+                raise ValueError(f"Routing rules {[rule.index for rule in candidates]} "
+                                 f"can't be combined: {str(e)}") from e
+
+        self.__by_domain = {domain: matcher(rules + any_sender)
+                            for domain, rules in domains.items()}
+        self.__by_address = {
+            address: matcher(rules + domains.get(address.rpartition('@')[2], []) + any_sender)
+            for address, rules in exact.items()
+        }
+        self.__fallback = matcher(any_sender)
+
+    def __match(self, from_addr: str, subject: str) -> Optional[Tuple[RoutingRule, Dict[str, str]]]:
+        matcher = self.__by_address.get(from_addr) \
+            or self.__by_domain.get(from_addr.rpartition('@')[2], self.__fallback)
+        return matcher.match(subject or '') if matcher else None
+
+    def matches(self, from_addr: str, subject: str) -> bool:
+        """Whether a rule routes the attachments of a message, whatever their filename."""
+        return self.__match(from_addr.lower(), subject) is not None
+
+    def attachment_filter(self, from_addr: str, subject: str) -> Optional[AttachmentFilter]:
+        """
+        Attachment filter of the rule routing a message, None if it has none or no rule
+        matches.
+        """
+        found = self.__match(from_addr.lower(), subject)
+        return found[0].attachments if found else None
+
+    def route(self, from_addr: str, subject: str, filename: str) -> Optional[str]:
+        """Path of an attachment relative to the base path, or None if no rule matches."""
+        from_addr = from_addr.lower()
+        found = self.__match(from_addr, subject)
+        if not found:
+            return None
+        rule, groups = found
+        return rule.path.format(filename=filename, sender=from_addr,
+                                domain=from_addr.rpartition('@')[2], **groups)
+
+
+class RoutingSource(ABC):
+
+    @abstractmethod
+    def fetch(self, known_version: Optional[str]) -> Optional[Dict]:
+        """
+        Read the routing config, a dict with `version` and `rules`, unless its version is
+        still `known_version`, in which case None is returned.
+        """
+        pass
+
+
+class StateManagerRoutingSource(RoutingSource):
+    """Routing config kept in a StateManager document with a `version` field."""
+
+    def __init__(self, state_store: StateManager, doc_id: str = 'routing_rules'):
+        self.__state_store = state_store
+        self.__doc_id = doc_id
+
+    def fetch(self, known_version: Optional[str]) -> Optional[Dict]:
+        config = self.__state_store.get_document_by_id(self.__doc_id)
+        if config.get('version') is not None and str(config['version']) == known_version:
+            return None
+        return config
+
+
+class StorageRoutingSource(RoutingSource):
+    """Routing config kept as a JSON object in storage, versioned by the object version."""
+
+    def __init__(self, storage: StorageManager, key: str):
+        self.__storage = storage
+        self.__key = key
+
+    def fetch(self, known_version: Optional[str]) -> Optional[Dict]:
+        # Only the object metadata is read until the version changes
+        version = self.__storage.stat(self.__key).version
+        if version == known_version:
+            return None
+        return dict(json.loads(self.__storage.get(self.__key)), version=version)
+
+
+class Router:
+    """
+    Routes attachments to save paths with rules compiled from a RoutingSource.
+
+    The source is checked at most once every `refresh_seconds`, and the rules are only
+    recompiled when the config version changed. If the config can't be read or is invalid,
+    the rules compiled last keep being used.
+    """
+
+    def __init__(self, source: Optional[RoutingSource] = None, refresh_seconds: float = 60.0):
+        """
+        Initialization of Router class.
+
+        Parameters:
+        - source (RoutingSource): Where the routing config is read from, defaults to None
+          which uses DEFAULT_RULES.
+        - refresh_seconds (float): Minimum time between version checks, defaults to 60.
+        """
+        self.__source = source
+        self.__refresh_seconds = refresh_seconds
+        self.__rules = CompiledRules(DEFAULT_RULES)
+        self.__checked_at: Optional[float] = None
+        self.__lock = threading.Lock()
+
+    @property
+    def version(self) -> Optional[str]:
+        return self.__rules.version
+
+    def refresh(self, force: bool = False) -> None:
+        if not self.__source:
+            return
+        with self.__lock:
+            now = time.monotonic()
+            if not force and self.__checked_at is not None \
+                    and now - self.__checked_at < self.__refresh_seconds:
+                return
+            # Other threads keep routing with the current rules while this one fetches
+            self.__checked_at = now
+            rules = self.__rules
+        try:
+            config = self.__source.fetch(rules.version)
+            if config is None:
+                return
+            version = config.get('version')
+            compiled = CompiledRules(config.get('rules', []),
+                                     version=None if version is None else str(version))
+        except Exception as e:
+            logger.error(f"Failed to load routing rules: {str(e)}")
+            return
+        with self.__lock:
+            # A concurrent forced refresh may have loaded newer rules meanwhile
+            if self.__rules is rules:
+                self.__rules = compiled
+                logger.info(f"Loaded routing rules version {version}")
+
+    def matches(self, from_addr: str, subject: str) -> bool:
+        """Whether a rule routes the attachments of a message, whatever their filename."""
+        self.refresh()
+        return self.__rules.matches(from_addr, subject)
+
+    def attachment_filter(self, from_addr: str, subject: str) -> Optional[AttachmentFilter]:
+        """
+        Attachment filter of the rule routing a message, None if it has none or no rule
+        matches.
+        """
+        self.refresh()
+        return self.__rules.attachment_filter(from_addr, subject)
+
+    def route(self, from_addr: str, subject: str, filename: str) -> Optional[str]:
+        """Path of an attachment relative to the base path, or None if no rule matches."""
+        self.refresh()
+        return self.__rules.route(from_addr, subject, filename)
@@ -0,0 +1,204 @@
+import logging
+import random
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, TypeVar
+
+from googleapiclient.errors import HttpError
+
+from instrumentation import Instrumentation
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Quota units charged by Gmail per call, see https://developers.google.com/gmail/api/reference/quota
+GMAIL_QUOTA_UNITS = {
+    'history.list': 2,
+    'messages.list': 5,
+    'messages.get': 5,
+    'attachments.get': 5,
+    'threads.get': 10,
+}
+# Gmail allows each user 250 quota units per second, as a moving average
+GMAIL_USER_UNITS_PER_SECOND = 250.0
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Gmail answers 403 rather than 429 when the per-user rate limit is exceeded
+RATE_LIMIT_REASONS = (b'rateLimitExceeded', b'userRateLimitExceeded')
+
+
+def is_throttled(error: Exception) -> bool:
+    """Whether `error` is Gmail asking to slow down, by rate limiting or being overloaded."""
+    if not isinstance(error, HttpError):
+        return False
+    if error.status_code == 403:
+        content = error.content or b''
+        return any(reason in content for reason in RATE_LIMIT_REASONS)
+    return error.status_code in RETRYABLE_STATUSES
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether the call that raised `error` may succeed when it is sent again."""
+    return is_throttled(error) or isinstance(error, (socket.timeout, ConnectionError))
+
+
+class QuotaScheduler:
+    """
+    Paces Gmail API calls to the quota of a user and retries the ones that were throttled.
+
+    Calls take their quota units from a token bucket refilled at `units_per_second`, so
+    bursts are smoothed out before Gmail rejects them. The number of calls in flight is
+    limited adaptively: it grows by one per limit's worth of successful calls and halves
+    whenever Gmail throttles, settling just below the concurrency Gmail accepts. Throttled
+    calls and dropped connections are retried with exponential backoff and full jitter.
+    """
+
+    def __init__(self,
+                 units_per_second: float = GMAIL_USER_UNITS_PER_SECOND,
+                 burst_units: Optional[float] = None,
+                 max_concurrency: int = 16,
+                 min_concurrency: int = 1,
+                 max_retries: int = 5,
+                 base_delay: float = 0.5,
+                 max_delay: float = 32.0,
+                 instrumentation: Optional[Instrumentation] = None):
+        """
+        Initialization of QuotaScheduler class.
+
+        Parameters:
+        - units_per_second (float): Quota units spent per second at most, defaults to the
+          per-user limit of Gmail.
+        - burst_units (float): Quota units that may be spent at once after being idle,
+          defaults to one second worth of units.
+        - max_concurrency (int): Upper bound of calls in flight, defaults to 16.
+        - min_concurrency (int): Lower bound the limit shrinks to when throttled, defaults to 1.
+        - max_retries (int): Retries of a call before its error is raised, defaults to 5.
+        - base_delay (float): Upper bound of the first backoff in seconds, doubling with each
+          retry, defaults to 0.5.
+        - max_delay (float): Upper bound of any backoff in seconds, defaults to 32.
+        - instrumentation (Instrumentation): Counts retries and throttled calls and times
+          waiting for quota, defaults to None.
+        """
+        if units_per_second <= 0:
+            raise ValueError("units_per_second must be positive")
+        if not 1 <= min_concurrency <= max_concurrency:
+            raise ValueError("min_concurrency must be between 1 and max_concurrency")
+
+        self.__rate = units_per_second
+        self.__capacity = burst_units or units_per_second
+        self.__tokens = self.__capacity
+        self.__updated = time.monotonic()
+        self.__bucket_lock = threading.Lock()
+        self.__max_concurrency = max_concurrency
+        self.__min_concurrency = min_concurrency
+        self.__limit = float(max_concurrency)
+        self.__in_flight = 0
+        self.__slots = threading.Condition()
+        self.__max_retries = max_retries
+        self.__base_delay = base_delay
+        self.__max_delay = max_delay
+        self.__instrumentation = instrumentation
+
+    @property
+    def concurrency(self) -> int:
+        """Current limit of calls in flight."""
+        with self.__slots:
+            return int(self.__limit)
+
+    @property
+    def max_retries(self) -> int:
+        return self.__max_retries
+
+    def __count(self, name: str) -> None:
+        if self.__instrumentation:
+            self.__instrumentation.count(name)
+
+    def acquire(self, units: float) -> None:
+        """Block until `units` quota units are available and take them."""
+        # A call costing more than the bucket holds, like a large batch, waits for a full
+        # bucket and is still charged in full: the bucket goes into debt, which the next
+        # calls wait off, so the rate holds whatever the size of the calls
+        needed = min(units, self.__capacity)
+        waited = 0.0
+        while True:
+            with self.__bucket_lock:
+                now = time.monotonic()
+                self.__tokens = min(self.__capacity,
+                                    self.__tokens + (now - self.__updated) * self.__rate)
+                self.__updated = now
+                if self.__tokens >= needed:
+                    self.__tokens -= units
+                    break
+                wait = (needed - self.__tokens) / self.__rate
+            time.sleep(wait)
+            waited += wait
+        if waited and self.__instrumentation:
+            self.__instrumentation.observe('quota.wait', waited)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Hold one of the calls in flight allowed by the current limit."""
+        with self.__slots:
+            while self.__in_flight >= int(self.__limit):
+                self.__slots.wait()
+            self.__in_flight += 1
+        try:
+            yield
+        finally:
+            with self.__slots:
+                self.__in_flight -= 1
+                self.__slots.notify_all()
+
+    def on_success(self) -> None:
+        with self.__slots:
+            if self.__limit < self.__max_concurrency:
+                self.__limit = min(self.__max_concurrency, self.__limit + 1 / self.__limit)
+                self.__slots.notify_all()
+
+    def on_throttled(self) -> None:
+        self.__count('api_calls.throttled')
+        with self.__slots:
+            limit = max(self.__min_concurrency, self.__limit / 2)
+            if int(limit) < int(self.__limit):
+                logger.info(f"Gmail is throttling, limiting concurrency to {int(limit)}")
+            self.__limit = limit
+
+    def backoff(self, attempt: int) -> None:
+        """Sleep before retry number `attempt`, counting from 0, and count the retry."""
+        self.__count('api_calls.retries')
+        time.sleep(random.uniform(0, min(self.__max_delay, self.__base_delay * 2 ** attempt)))
+
+    def execute(self, call: Callable[[], T], units: float) -> T:
+        """
+        Run `call` once its quota units are available, retrying it while it is throttled.
+
+        Parameters:
+        - call (Callable): Sends the request.
+        - units (float): Quota units the call costs, taken again on every retry.
+
+        Returns:
+        The result of `call`.
+
+        Raises:
+        The error of the last attempt, or any error that is not retryable.
+        """
+        attempt = 0
+        while True:
+            self.acquire(units)
+            try:
+                with self.slot():
+                    result = call()
+            except Exception as e:
+                if is_throttled(e):
+                    self.on_throttled()
+                if not is_retryable(e) or attempt >= self.__max_retries:
+                    raise
+                logger.warning(f"Retrying a throttled or failed Gmail call: {str(e)}")
+                self.backoff(attempt)
+                attempt += 1
+                continue
+            self.on_success()
+            return result
@@ -1,21 +1,32 @@
+import asyncio
+import copy
 from datetime import datetime
 import logging
+import threading
+import time
 from abc import ABC, abstractmethod
 from enum import Enum
 from dataclasses import dataclass
-from typing import Dict
+from typing import Callable, Dict, List, Optional, Tuple
 
-from google.cloud.firestore import Client as FirestoreClient
+from google.cloud.firestore import Client as FirestoreClient, transactional
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
 from google.oauth2.service_account import Credentials as ServiceAccountCredentials
 
 
 logger = logging.getLogger(__name__)
 
+# Firestore rejects batched writes of more than 500 operations
+FIRESTORE_MAX_BATCH_WRITES = 500
+
 
 @dataclass
 class SyncState:
     historyId: str
     updatedTime: int
+    # Set while a history walk is in progress, the walk resumes from this page
+    pageToken: Optional[str] = None
 
 
 @dataclass
@@ -25,47 +36,284 @@ class WriteResult:
         FAILED = 1
 
     status: Status
-    update_time: datetime
-    message: str
+    update_time: Optional[datetime] = None
+    message: str = ''
+
+
+def matches(document: Optional[Dict], expected: Optional[Dict]) -> bool:
+    """Check that `document` holds every field of `expected`, or is missing if it is None."""
+    if expected is None:
+        return document is None
+    return document is not None and all(document.get(k) == v for k, v in expected.items())
 
 
 class StateManager(ABC):
 
     @abstractmethod
-    def get_document_by_id(self, id: str) -> Dict:
+    def get_document_by_id(self, id: str, use_cache: bool = True) -> Dict:
+        """
+        Read a document, raising RuntimeError if it is missing.
+
+        Reads deciding what to do under a lease pass `use_cache=False`, so they see the
+        writes other instances made before the lease was taken.
+        """
+        pass
+
+    @abstractmethod
+    def set_document_by_id(self, id: str, data: Dict) -> WriteResult:
+        pass
+
+    def get_documents_by_ids(self, ids: List[str]) -> Dict[str, Optional[Dict]]:
+        """Read several documents, mapping the ID of each missing document to None."""
+        documents = {}
+        for id in ids:
+            try:
+                documents[id] = self.get_document_by_id(id)
+            except RuntimeError:
+                documents[id] = None
+        return documents
+
+    @abstractmethod
+    def get_documents_by_prefix(self, prefix: str) -> Dict[str, Dict]:
+        """Read every document whose ID starts with `prefix`, keyed by ID in ID order."""
+        pass
+
+    @abstractmethod
+    def delete_document_by_id(self, id: str) -> None:
+        """Delete a document, if it exists."""
+        pass
+
+    def set_documents(self, documents: Dict[str, Dict]) -> WriteResult:
+        """Replace several documents, keyed by ID."""
+        for id, data in documents.items():
+            result = self.set_document_by_id(id, data)
+            if result.status is WriteResult.Status.FAILED:
+                return result
+        return WriteResult(status=WriteResult.Status.SUCCESS, update_time=datetime.now(),
+                           message=f"{len(documents)} documents written")
+
+    def update_documents(self, updates: Dict[str, Dict]) -> WriteResult:
+        """Merge fields into several documents, keyed by ID, creating missing ones."""
+        try:
+            for id, fields in updates.items():
+                self.transact(id, lambda current, fields=fields: {**(current or {}), **fields})
+        except RuntimeError as e:
+            return WriteResult(status=WriteResult.Status.FAILED, message=str(e))
+        return WriteResult(status=WriteResult.Status.SUCCESS, update_time=datetime.now(),
+                           message=f"{len(updates)} documents updated")
+
+    @abstractmethod
+    def transact(self, id: str, update: Callable[[Optional[Dict]], Optional[Dict]]) -> Optional[Dict]:
+        """
+        Atomically read-modify-write a document.
+
+        `update` gets the current document, or None if it is missing, and returns the new
+        document, or None to leave it as is. It may be called again if the document
+        changed concurrently. Returns the document as left by the last call.
+        """
         pass
 
+    def compare_and_set(self, id: str, expected: Optional[Dict], data: Dict) -> bool:
+        """
+        Atomically replace a document with `data` if it still holds the fields of `expected`.
+        With `expected` None the document must not exist yet. Returns whether it was written.
+        """
+        written = False
+
+        def update(current):
+            nonlocal written
+            written = matches(current, expected)
+            return data if written else None
+
+        self.transact(id, update)
+        return written
+
+    def acquire_lease(self, id: str, owner: str, ttl_seconds: float) -> bool:
+        """
+        Take or renew the lease `id` for `owner` unless another owner holds an unexpired one.
+        Returns whether `owner` holds the lease.
+        """
+        acquired = False
+
+        def update(lease):
+            nonlocal acquired
+            now = time.time()
+            acquired = not lease or lease['owner'] == owner or lease['expiresAt'] <= now
+            return {'owner': owner, 'expiresAt': now + ttl_seconds} if acquired else None
+
+        self.transact(id, update)
+        return acquired
+
     @abstractmethod
+    def release_lease(self, id: str, owner: str) -> None:
+        """Give up the lease `id` if `owner` holds it."""
+        pass
+
+
+class InMemoryStateManager(StateManager):
+    """StateManager keeping documents in a dict, for tests and offline runs."""
+
+    def __init__(self, documents: Optional[Dict[str, Dict]] = None):
+        self.documents = copy.deepcopy(documents or {})
+        self.__lock = threading.RLock()
+
+    def get_document_by_id(self, id: str, use_cache: bool = True) -> Dict:
+        with self.__lock:
+            if id not in self.documents:
+                raise RuntimeError(f"Document `{id}` not found")
+            return copy.deepcopy(self.documents[id])
+
+    def get_documents_by_prefix(self, prefix: str) -> Dict[str, Dict]:
+        with self.__lock:
+            return {id: copy.deepcopy(data) for id, data in sorted(self.documents.items())
+                    if id.startswith(prefix)}
+
     def set_document_by_id(self, id: str, data: Dict) -> WriteResult:
+        with self.__lock:
+            self.documents[id] = copy.deepcopy(data)
+        return WriteResult(status=WriteResult.Status.SUCCESS, update_time=datetime.now(),
+                           message='')
+
+    def delete_document_by_id(self, id: str) -> None:
+        with self.__lock:
+            self.documents.pop(id, None)
+
+    def transact(self, id: str, update: Callable[[Optional[Dict]], Optional[Dict]]) -> Optional[Dict]:
+        with self.__lock:
+            data = update(copy.deepcopy(self.documents.get(id)))
+            if data is not None:
+                self.documents[id] = copy.deepcopy(data)
+            return copy.deepcopy(self.documents.get(id))
+
+    def release_lease(self, id: str, owner: str) -> None:
+        with self.__lock:
+            if self.documents.get(id, {}).get('owner') == owner:
+                del self.documents[id]
+
+
+class AsyncStateManager(ABC):
+
+    @abstractmethod
+    async def get_document_by_id(self, id: str) -> Dict:
         pass
 
+    @abstractmethod
+    async def set_document_by_id(self, id: str, data: Dict) -> WriteResult:
+        pass
+
+
+class ThreadedAsyncStateManager(AsyncStateManager):
+    """AsyncStateManager running the calls of a StateManager in worker threads."""
+
+    def __init__(self, state_store: StateManager):
+        self.__state_store = state_store
+
+    async def get_document_by_id(self, id: str) -> Dict:
+        return await asyncio.to_thread(self.__state_store.get_document_by_id, id)
+
+    async def set_document_by_id(self, id: str, data: Dict) -> WriteResult:
+        return await asyncio.to_thread(self.__state_store.set_document_by_id, id=id, data=data)
+
 
 class FirestoreStateManager(StateManager):
 
     def __init__(self,
                  collection: str,
                  database: str = 'default',
-                 service_account_file: str = None):
+                 service_account_file: str = None,
+                 cache_ttl_seconds: float = 0):
+        """
+        Initialization of FirestoreStateManager class.
 
+        Parameters:
+        - collection (str): Collection holding the documents.
+        - database (str): Firestore database, defaults to 'default'.
+        - service_account_file (str): Service account key file, defaults to None which
+          uses the application default credentials.
+        - cache_ttl_seconds (float): How long documents read are served from memory,
+          defaults to 0 which disables the cache. Writes through this instance invalidate
+          the cached copy, writes by other instances are seen once it expires.
+        """
         creds = None
         if service_account_file:
             creds = ServiceAccountCredentials.from_service_account_file(service_account_file)
         self.db = FirestoreClient(database=database, credentials=creds)
         self.collection = collection
+        self.__cache_ttl_seconds = cache_ttl_seconds
+        self.__cache: Dict[str, Tuple[float, Dict]] = {}
+        self.__cache_lock = threading.Lock()
+
+    def __get_cached(self, id: str) -> Optional[Dict]:
+        if not self.__cache_ttl_seconds:
+            return None
+        with self.__cache_lock:
+            expires_at, data = self.__cache.get(id, (0, None))
+            if expires_at <= time.monotonic():
+                self.__cache.pop(id, None)
+                return None
+        return copy.deepcopy(data)
+
+    def __cache_document(self, id: str, data: Dict) -> None:
+        if self.__cache_ttl_seconds:
+            with self.__cache_lock:
+                self.__cache[id] = (time.monotonic() + self.__cache_ttl_seconds,
+                                    copy.deepcopy(data))
+
+    def __invalidate(self, id: str) -> None:
+        with self.__cache_lock:
+            self.__cache.pop(id, None)
 
-    def get_document_by_id(self, id: str) -> Dict:
+    def get_document_by_id(self, id: str, use_cache: bool = True) -> Dict:
+        cached = self.__get_cached(id) if use_cache else None
+        if cached is not None:
+            return cached
         try:
-            doc_ref = self.db.collection(self.collection).document(id)
-            if not doc_ref.get().exists:
+            snapshot = self.db.collection(self.collection).document(id).get()
+            if not snapshot.exists:
                 raise RuntimeError(f"Document `{id}` not found in `{self.collection}`")
-            return doc_ref.get().to_dict()
+            data = snapshot.to_dict()
         except Exception as e:
             raise RuntimeError(f"Error fetching document {id}: {str(e)}") from e
+        self.__cache_document(id, data)
+        return data
+
+    def get_documents_by_ids(self, ids: List[str]) -> Dict[str, Optional[Dict]]:
+        documents = {}
+        for id in dict.fromkeys(ids):
+            cached = self.__get_cached(id)
+            if cached is not None:
+                documents[id] = cached
+        missing = [id for id in dict.fromkeys(ids) if id not in documents]
+        if missing:
+            collection = self.db.collection(self.collection)
+            try:
+                # One round trip for all of them; snapshots come back in any order
+                for snapshot in self.db.get_all([collection.document(id) for id in missing]):
+                    data = snapshot.to_dict() if snapshot.exists else None
+                    documents[snapshot.id] = data
+                    if data is not None:
+                        self.__cache_document(snapshot.id, data)
+            except Exception as e:
+                raise RuntimeError(f"Error fetching documents {missing}: {str(e)}") from e
+        return {id: documents.get(id) for id in ids}
+
+    def get_documents_by_prefix(self, prefix: str) -> Dict[str, Dict]:
+        collection = self.db.collection(self.collection)
+        document_id = FieldPath.document_id()
+        try:
+            # Document IDs sort as strings, so the IDs starting with `prefix` are a range
+            query = collection \
+                .where(filter=FieldFilter(document_id, '>=', collection.document(prefix))) \
+                .where(filter=FieldFilter(document_id, '<', collection.document(prefix + '\uf8ff')))
+            return {snapshot.id: snapshot.to_dict() for snapshot in query.stream()}
+        except Exception as e:
+            raise RuntimeError(f"Error fetching documents {prefix}*: {str(e)}") from e
 
     def set_document_by_id(self, id: str, data: dict) -> WriteResult:
         try:
             doc_ref = self.db.collection(self.collection).document(id)
             result = doc_ref.set(data)
+            self.__invalidate(id)
             update_time = datetime.fromtimestamp(result.update_time.timestamp())
             return WriteResult(
                 status=WriteResult.Status.SUCCESS,
@@ -78,3 +326,81 @@ class FirestoreStateManager(StateManager):
                 status=WriteResult.Status.FAILED,
                 message=str(e)
             )
+
+    def delete_document_by_id(self, id: str) -> None:
+        try:
+            self.db.collection(self.collection).document(id).delete()
+        except Exception as e:
+            raise RuntimeError(f"Error deleting document {id}: {str(e)}") from e
+        finally:
+            self.__invalidate(id)
+
+    def __write_batches(self, documents: Dict[str, Dict], merge: bool) -> WriteResult:
+        collection = self.db.collection(self.collection)
+        items = list(documents.items())
+        update_time = None
+        try:
+            # Each batch is atomic, but a failure leaves the earlier batches written
+            for i in range(0, len(items), FIRESTORE_MAX_BATCH_WRITES):
+                chunk = items[i:i + FIRESTORE_MAX_BATCH_WRITES]
+                batch = self.db.batch()
+                for id, data in chunk:
+                    batch.set(collection.document(id), data, merge=merge)
+                results = batch.commit()
+                for id, _ in chunk:
+                    self.__invalidate(id)
+                if results:
+                    update_time = datetime.fromtimestamp(results[-1].update_time.timestamp())
+            return WriteResult(
+                status=WriteResult.Status.SUCCESS,
+                update_time=update_time,
+                message=f"{len(items)} documents written"
+            )
+        except Exception as e:
+            logger.error(f"Error writing documents: {str(e)}")
+            return WriteResult(
+                status=WriteResult.Status.FAILED,
+                message=str(e)
+            )
+
+    def set_documents(self, documents: Dict[str, Dict]) -> WriteResult:
+        return self.__write_batches(documents, merge=False)
+
+    def update_documents(self, updates: Dict[str, Dict]) -> WriteResult:
+        return self.__write_batches(updates, merge=True)
+
+    def transact(self, id: str, update: Callable[[Optional[Dict]], Optional[Dict]]) -> Optional[Dict]:
+        doc_ref = self.db.collection(self.collection).document(id)
+
+        @transactional
+        def read_modify_write(transaction) -> Optional[Dict]:
+            snapshot = doc_ref.get(transaction=transaction)
+            current = snapshot.to_dict() if snapshot.exists else None
+            data = update(copy.deepcopy(current))
+            if data is None:
+                return current
+            transaction.set(doc_ref, data)
+            return data
+
+        try:
+            return read_modify_write(self.db.transaction())
+        except Exception as e:
+            raise RuntimeError(f"Error updating document {id}: {str(e)}") from e
+        finally:
+            self.__invalidate(id)
+
+    def release_lease(self, id: str, owner: str) -> None:
+        doc_ref = self.db.collection(self.collection).document(id)
+
+        @transactional
+        def release(transaction) -> None:
+            snapshot = doc_ref.get(transaction=transaction)
+            if snapshot.exists and snapshot.to_dict().get('owner') == owner:
+                transaction.delete(doc_ref)
+
+        try:
+            release(self.db.transaction())
+        except Exception as e:
+            raise RuntimeError(f"Error releasing lease {id}: {str(e)}") from e
+        finally:
+            self.__invalidate(id)
@@ -1,57 +1,496 @@
+import asyncio
+import io
+import json
 import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
 from abc import ABC, abstractmethod
-from typing import Optional, Any, Dict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Any, BinaryIO, Dict, Iterable, Iterator, List, Union
 
+from google.api_core.exceptions import NotFound
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud.storage import Client as GCSClient
+from requests.adapters import HTTPAdapter
 from google.oauth2.service_account import Credentials as ServiceAccountCredentials
 
 
 logger = logging.getLogger(__name__)
 
+# GCS resumable uploads require chunks in multiples of 256 KiB
+DEFAULT_CHUNK_SIZE = 4 * 256 * 1024
+DEFAULT_PUT_WORKERS = 8
+
+
+@dataclass
+class PutItem:
+    """An object to store with `put_many`, from either `data` or `stream`."""
+    key: str
+    data: Any = None
+    stream: Optional[Union[BinaryIO, Iterable[bytes]]] = None
+    metadata: Optional[Dict] = None
+    content_type: Optional[str] = None
+
+
+@dataclass
+class ObjectInfo:
+    key: str
+    size: int
+    # Changes whenever the object is replaced
+    version: str
+    metadata: Optional[Dict] = None
+
+
+class IterableReader(io.RawIOBase):
+    """Read-only, non-seekable file-like view over an iterable of bytes chunks."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.__chunks = iter(chunks)
+        self.__buffer = b''
+        self.__position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def tell(self) -> int:
+        # Resumable uploads read the start offset of the stream before sending it, the
+        # default would seek to find it
+        return self.__position
+
+    def readinto(self, b) -> int:
+        # Fill `b` completely unless the chunks run out, resumable uploads treat
+        # a short read as the end of the stream
+        view = memoryview(b).cast('B')
+        size = 0
+        while size < len(view):
+            if not self.__buffer:
+                self.__buffer = next(self.__chunks, None)
+                if self.__buffer is None:
+                    self.__buffer = b''
+                    break
+                continue
+            n = min(len(view) - size, len(self.__buffer))
+            view[size:size + n] = self.__buffer[:n]
+            self.__buffer = self.__buffer[n:]
+            size += n
+        self.__position += size
+        return size
+
 
 class StorageManager(ABC):
     """Abstract base class for storage managers."""
 
     @abstractmethod
-    def put(self, key: str, data: Any, metadata: Optional[Dict] = None) -> None:
+    def put(self, key: str, data: Any, metadata: Optional[Dict] = None,
+            content_type: Optional[str] = None) -> None:
+        """
+        Stores the provided data associated with the key, and optionally, metadata and the
+        MIME type of the data, which backends without content types ignore.
+        """
+        pass
+
+    def put_stream(self, key: str, stream: Union[BinaryIO, Iterable[bytes]],
+                   metadata: Optional[Dict] = None,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE,
+                   content_type: Optional[str] = None) -> None:
+        """
+        Stores data read from a file-like object or an iterable of bytes chunks.
+
+        Backends without streaming support buffer the whole stream and call `put`.
+        """
+        data = stream.read() if hasattr(stream, 'read') else b''.join(stream)
+        self.put(key=key, data=data, metadata=metadata, content_type=content_type)
+
+    def _put_item(self, item: PutItem) -> None:
+        if item.stream is not None:
+            self.put_stream(key=item.key, stream=item.stream, metadata=item.metadata,
+                            content_type=item.content_type)
+        else:
+            self.put(key=item.key, data=item.data, metadata=item.metadata,
+                     content_type=item.content_type)
+
+    def put_many(self, items: List[PutItem],
+                 max_workers: int = DEFAULT_PUT_WORKERS) -> Dict[str, Exception]:
+        """
+        Stores several objects concurrently.
+
+        Returns:
+        Dict[str, Exception]: The error of every key that could not be stored.
+        """
+        def put(item):
+            try:
+                self._put_item(item)
+            except Exception as e:
+                return item.key, e
+            return item.key, None
+
+        if max_workers > 1 and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(items)),
+                                    thread_name_prefix='storage-put') as pool:
+                results = list(pool.map(put, items))
+        else:
+            results = [put(item) for item in items]
+        return {key: e for key, e in results if e is not None}
+
+    @abstractmethod
+    def get(self, key: str) -> bytes:
+        """Retrieves the data associated with the key."""
+        pass
+
+    @abstractmethod
+    def stat(self, key: str) -> ObjectInfo:
+        """Retrieves the size, version and metadata of the object at the key."""
+        pass
+
+    def get_range(self, key: str, start: int, end: Optional[int] = None) -> bytes:
+        """Retrieves the bytes from `start` up to, but excluding, `end` or the end of the data."""
+        return self.get(key)[start:end]
+
+    def get_stream(self, key: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        """Retrieves the data in chunks of at most `chunk_size` bytes."""
+        data = self.get(key)
+        for i in range(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+
+    def download_to_file(self, key: str, path: str) -> None:
+        """Writes the data to a local file, chunk by chunk."""
+        with open(path, 'wb') as f:
+            for chunk in self.get_stream(key):
+                f.write(chunk)
+
+    def get_mapped(self, key: str, path: Optional[str] = None) -> mmap.mmap:
+        """
+        Downloads the data to a local file and maps it into memory read-only, so large
+        files can be sliced without reading them whole. Without `path` a temporary file
+        is used, removed once the map is closed.
+        """
+        if path:
+            self.download_to_file(key, path)
+            return map_file(path)
+        with tempfile.NamedTemporaryFile() as f:
+            self.download_to_file(key, f.name)
+            # The map stays valid after the file is removed
+            return map_file(f.name)
+
+
+def map_file(path: str) -> mmap.mmap:
+    """Map a local file into memory read-only."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise RuntimeError(f"Can't map empty file {path}")
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class InMemoryStorageManager(StorageManager):
+    """StorageManager keeping objects in a dict, for tests and benchmarks."""
+
+    def __init__(self):
+        self.objects: Dict[str, bytes] = {}
+        self.metadata: Dict[str, Optional[Dict]] = {}
+        self.content_types: Dict[str, Optional[str]] = {}
+        self.__versions: Dict[str, int] = {}
+        self.__lock = threading.Lock()
+
+    def put(self, key: str, data: Any, metadata: Optional[Dict] = None,
+            content_type: Optional[str] = None) -> None:
+        data = data.encode() if isinstance(data, str) else bytes(data)
+        with self.__lock:
+            self.objects[key] = data
+            self.metadata[key] = metadata
+            self.content_types[key] = content_type
+            self.__versions[key] = self.__versions.get(key, 0) + 1
+
+    def put_stream(self, key: str, stream: Union[BinaryIO, Iterable[bytes]],
+                   metadata: Optional[Dict] = None,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE,
+                   content_type: Optional[str] = None) -> None:
+        if hasattr(stream, 'read'):
+            stream = iter(lambda: stream.read(chunk_size), b'')
+        self.put(key, b''.join(stream), metadata, content_type)
+
+    def get(self, key: str) -> bytes:
+        with self.__lock:
+            if key not in self.objects:
+                raise RuntimeError(f"No data found for key: {key}")
+            return self.objects[key]
+
+    def stat(self, key: str) -> ObjectInfo:
+        with self.__lock:
+            if key not in self.objects:
+                raise RuntimeError(f"No data found for key: {key}")
+            return ObjectInfo(key=key, size=len(self.objects[key]),
+                              version=str(self.__versions[key]), metadata=self.metadata[key])
+
+
+class AsyncStorageManager(ABC):
+    """Abstract base class for storage managers used from asyncio code."""
+
+    @abstractmethod
+    async def put(self, key: str, data: Any, metadata: Optional[Dict] = None) -> None:
         """Stores the provided data associated with the key, and optionally, metadata."""
         pass
 
     @abstractmethod
-    def get(self, key: str) -> Any:
+    async def put_stream(self, key: str, stream: Union[BinaryIO, Iterable[bytes]],
+                         metadata: Optional[Dict] = None,
+                         chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+        """Stores data read from a file-like object or an iterable of bytes chunks."""
+        pass
+
+    @abstractmethod
+    async def get(self, key: str) -> Any:
         """Retrieves the data associated with the key."""
         pass
 
 
+class ThreadedAsyncStorageManager(AsyncStorageManager):
+    """AsyncStorageManager running the calls of a StorageManager in worker threads."""
+
+    def __init__(self, storage: StorageManager):
+        self.__storage = storage
+
+    async def put(self, key: str, data: Any, metadata: Optional[Dict] = None) -> None:
+        await asyncio.to_thread(self.__storage.put, key=key, data=data, metadata=metadata)
+
+    async def put_stream(self, key: str, stream: Union[BinaryIO, Iterable[bytes]],
+                         metadata: Optional[Dict] = None,
+                         chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+        await asyncio.to_thread(self.__storage.put_stream, key=key, stream=stream,
+                                metadata=metadata, chunk_size=chunk_size)
+
+    async def get(self, key: str) -> Any:
+        return await asyncio.to_thread(self.__storage.get, key)
+
+
 class GoogleCloudStorageManager(StorageManager):
     """StorageManager for Google Cloud Storage."""
 
     def __init__(self, bucket: str,
                  service_account_file: Optional[str] = None,
-                 client: Optional[GCSClient] = None):
+                 client: Optional[GCSClient] = None,
+                 max_workers: int = DEFAULT_PUT_WORKERS,
+                 pool_size: Optional[int] = None):
+        """
+        Initialization of GoogleCloudStorageManager class.
 
+        Parameters:
+        - bucket (str): Name of the bucket.
+        - service_account_file (str): Service account key file, used when no client is given.
+        - client (GCSClient): An optional storage client, defaults to None.
+        - max_workers (int): Number of concurrent uploads of `put_many`, defaults to 8.
+        - pool_size (int): Number of HTTP connections kept open to GCS, defaults to None
+          which keeps the client default of 10. It should be at least `max_workers`.
+          A given `client` keeps its own connection pool.
+        """
         if not client and not service_account_file:
             raise RuntimeError("Neither authorized_user_json_file or client is provided")
         if not client:
-            creds = ServiceAccountCredentials.from_service_account_file(service_account_file)
-            client = GCSClient(credentials=creds)
+            creds = ServiceAccountCredentials.from_service_account_file(
+                service_account_file, scopes=GCSClient.SCOPE)
+            session = None
+            if pool_size:
+                session = AuthorizedSession(creds)
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+            client = GCSClient(credentials=creds, _http=session)
         self.__bucket = client.bucket(bucket_name=bucket)
+        self.__max_workers = max_workers
 
-    def put(self, key: str, data: Any, metadata: Optional[Dict] = None) -> None:
+    def put(self, key: str, data: Any, metadata: Optional[Dict] = None,
+            content_type: Optional[str] = None) -> None:
         try:
             blob = self.__bucket.blob(key)
             if metadata:
                 blob.metadata = metadata
-            blob.upload_from_string(data)
+            blob.upload_from_string(data, content_type=content_type)
             logger.info(f"Blob saved with key: {key}")
         except Exception as e:
             raise RuntimeError(f"Error storing data with key {key}: {str(e)}") from e
 
-    def get(self, key: str) -> Any:
+    def put_stream(self, key: str, stream: Union[BinaryIO, Iterable[bytes]],
+                   metadata: Optional[Dict] = None,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE,
+                   content_type: Optional[str] = None) -> None:
+        try:
+            # Setting a chunk size makes the upload resumable, sent `chunk_size` bytes at a time
+            blob = self.__bucket.blob(key, chunk_size=chunk_size)
+            if metadata:
+                blob.metadata = metadata
+            if not hasattr(stream, 'read'):
+                stream = IterableReader(stream)
+            blob.upload_from_file(stream, rewind=False, content_type=content_type)
+            logger.info(f"Blob streamed with key: {key}")
+        except Exception as e:
+            raise RuntimeError(f"Error storing data with key {key}: {str(e)}") from e
+
+    def _put_item(self, item: PutItem) -> None:
+        try:
+            if item.stream is not None:
+                blob = self.__bucket.blob(item.key, chunk_size=DEFAULT_CHUNK_SIZE)
+            else:
+                blob = self.__bucket.blob(item.key)
+            # Metadata and content type are sent with the upload itself
+            blob.metadata = item.metadata
+            if item.stream is not None:
+                stream = item.stream if hasattr(item.stream, 'read') else IterableReader(item.stream)
+                blob.upload_from_file(stream, rewind=False, content_type=item.content_type)
+            else:
+                blob.upload_from_string(item.data, content_type=item.content_type)
+            logger.info(f"Blob saved with key: {item.key}")
+        except Exception as e:
+            raise RuntimeError(f"Error storing data with key {item.key}: {str(e)}") from e
+
+    def put_many(self, items: List[PutItem],
+                 max_workers: Optional[int] = None) -> Dict[str, Exception]:
+        return super().put_many(items, max_workers=max_workers or self.__max_workers)
+
+    def get(self, key: str) -> bytes:
+        return self.get_range(key, 0)
+
+    def stat(self, key: str) -> ObjectInfo:
         try:
             blob = self.__bucket.get_blob(key)
-            if not blob:
-                raise RuntimeError(f"No data found for key: {key}")
-            return blob
         except Exception as e:
             raise RuntimeError(f"Error retrieving data with key {key}: {str(e)}") from e
+        if not blob:
+            raise RuntimeError(f"No data found for key: {key}")
+        return ObjectInfo(key=key, size=blob.size, version=str(blob.generation),
+                          metadata=blob.metadata)
+
+    def get_range(self, key: str, start: int, end: Optional[int] = None) -> bytes:
+        if end is not None and end <= start:
+            # An empty range can't be written as an inclusive GCS range
+            return b''
+        try:
+            # GCS ranges include their end
+            return self.__bucket.blob(key).download_as_bytes(
+                start=start or None, end=end - 1 if end is not None else None
+            )
+        except NotFound as e:
+            raise RuntimeError(f"No data found for key: {key}") from e
+        except Exception as e:
+            raise RuntimeError(f"Error retrieving data with key {key}: {str(e)}") from e
+
+    def get_stream(self, key: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        try:
+            # Each chunk is fetched with its own ranged request
+            with self.__bucket.blob(key).open('rb', chunk_size=chunk_size) as reader:
+                while True:
+                    chunk = reader.read(chunk_size)
+                    if not chunk:
+                        return
+                    yield chunk
+        except NotFound as e:
+            raise RuntimeError(f"No data found for key: {key}") from e
+        except Exception as e:
+            raise RuntimeError(f"Error retrieving data with key {key}: {str(e)}") from e
+
+    def download_to_file(self, key: str, path: str) -> None:
+        try:
+            self.__bucket.blob(key).download_to_filename(path)
+        except NotFound as e:
+            raise RuntimeError(f"No data found for key: {key}") from e
+        except Exception as e:
+            raise RuntimeError(f"Error retrieving data with key {key}: {str(e)}") from e
+
+
+class LocalFileStorageManager(StorageManager):
+    """
+    StorageManager keeping objects as files under a local directory, to run the pipeline
+    offline. Metadata is kept as JSON files in a `.metadata` directory next to the objects.
+    """
+
+    METADATA_DIR = '.metadata'
+
+    def __init__(self, root: str):
+        self.__root = os.path.realpath(root)
+        os.makedirs(self.__root, exist_ok=True)
+
+    def __path(self, key: str, metadata: bool = False) -> str:
+        parts = [self.__root, self.METADATA_DIR] if metadata else [self.__root]
+        path = os.path.realpath(os.path.join(*parts, key.lstrip('/')))
+        if os.path.commonpath([path, self.__root]) != self.__root:
+            raise RuntimeError(f"Key {key} is outside of {self.__root}")
+        return path + '.json' if metadata else path
+
+    def __write(self, key: str, chunks: Iterable[bytes], metadata: Optional[Dict]) -> None:
+        path = self.__path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written aside and renamed, so readers never see a partial object
+            with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), delete=False) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(f.name, path)
+            metadata_path = self.__path(key, metadata=True)
+            if metadata:
+                os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
+                with open(metadata_path, 'w') as f:
+                    json.dump(metadata, f)
+            elif os.path.exists(metadata_path):
+                os.remove(metadata_path)
+            logger.info(f"File saved with key: {key}")
+        except Exception as e:
+            raise RuntimeError(f"Error storing data with key {key}: {str(e)}") from e
+
+    def put(self, key: str, data: Any, metadata: Optional[Dict] = None,
+            content_type: Optional[str] = None) -> None:
+        self.__write(key, [data.encode() if isinstance(data, str) else data], metadata)
+
+    def put_stream(self, key: str, stream: Union[BinaryIO, Iterable[bytes]],
+                   metadata: Optional[Dict] = None,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE,
+                   content_type: Optional[str] = None) -> None:
+        if hasattr(stream, 'read'):
+            stream = iter(lambda: stream.read(chunk_size), b'')
+        self.__write(key, stream, metadata)
+
+    def __open(self, key: str) -> BinaryIO:
+        try:
+            return open(self.__path(key), 'rb')
+        except FileNotFoundError as e:
+            raise RuntimeError(f"No data found for key: {key}") from e
+
+    def get(self, key: str) -> bytes:
+        with self.__open(key) as f:
+            return f.read()
+
+    def stat(self, key: str) -> ObjectInfo:
+        try:
+            st = os.stat(self.__path(key))
+        except FileNotFoundError as e:
+            raise RuntimeError(f"No data found for key: {key}") from e
+        metadata = None
+        if os.path.exists(self.__path(key, metadata=True)):
+            with open(self.__path(key, metadata=True)) as f:
+                metadata = json.load(f)
+        return ObjectInfo(key=key, size=st.st_size, version=str(st.st_mtime_ns),
+                          metadata=metadata)
+
+    def get_range(self, key: str, start: int, end: Optional[int] = None) -> bytes:
+        with self.__open(key) as f:
+            f.seek(start)
+            return f.read(-1 if end is None else max(end - start, 0))
+
+    def get_stream(self, key: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        with self.__open(key) as f:
+            yield from iter(lambda: f.read(chunk_size), b'')
+
+    def download_to_file(self, key: str, path: str) -> None:
+        with self.__open(key) as f, open(path, 'wb') as out:
+            shutil.copyfileobj(f, out)
+
+    def get_mapped(self, key: str, path: Optional[str] = None) -> mmap.mmap:
+        if path:
+            self.download_to_file(key, path)
+            return map_file(path)
+        # The stored file is mapped in place
+        self.__open(key).close()
+        return map_file(self.__path(key))
@@ -0,0 +1,210 @@
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+
+def fake_message(msg_id, sender, subject, attachment_ids, thread_id=None):
+    return {
+        'id': msg_id,
+        'threadId': thread_id or f'thread-{msg_id}',
+        'internalDate': '1634047722',
+        'payload': {
+            'headers': [
+                {'name': 'Subject', 'value': subject},
+                {'name': 'From', 'value': sender},
+            ],
+            'parts': [
+                {'partId': str(i), 'filename': f'{attachment_id}.pdf',
+                 'mimeType': 'application/pdf', 'body': {'attachmentId': attachment_id}}
+                for i, attachment_id in enumerate(attachment_ids)
+            ]
+        }
+    }
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Concurrent clients open many connections at once
+    request_queue_size = 1024
+
+
+class FakeGmailServer:
+    """
+    Local stand-in for the Gmail REST API serving history, messages and attachments
+    from memory.
+
+    History pages are addressed by their index, so the page token of `history_pages[i]`
+    is `str(i)`. Every request waits `latency` seconds, and message and attachment
+    requests fail with 503 at `error_rate`. Batch requests are answered part by part.
+    """
+
+    ROUTES = [
+        (re.compile(r'^/gmail/v1/users/me/history$'), '_history'),
+        (re.compile(r'^/gmail/v1/users/me/messages/(?P<msg_id>[^/]+)$'), '_message'),
+        (re.compile(r'^/gmail/v1/users/me/messages/(?P<msg_id>[^/]+)/attachments/'
+                    r'(?P<attachment_id>[^/]+)$'), '_attachment'),
+        (re.compile(r'^/gmail/v1/users/me/threads/(?P<thread_id>[^/]+)$'), '_thread'),
+    ]
+
+    def __init__(self,
+                 history_pages: List[Dict],
+                 messages: Dict[str, Dict],
+                 attachments: Dict[str, str],
+                 latency: float = 0.0,
+                 error_rate: float = 0.0,
+                 seed: int = 0):
+        self.history_pages = history_pages
+        self.messages = messages
+        self.attachments = attachments
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests: List[str] = []
+        self._lock = threading.Lock()
+        self.__random = random.Random(seed)
+        self.__server = Server(('127.0.0.1', 0), self.__handler())
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.__server.server_address
+        return f'http://{host}:{port}'
+
+    @property
+    def api_url(self) -> str:
+        return f'{self.url}/gmail/v1/users/me'
+
+    def __enter__(self) -> 'FakeGmailServer':
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def call_counts(self) -> Counter:
+        """Number of requests per route, batch parts included."""
+        def route(path):
+            if path == '/batch':
+                return 'batch'
+            if '/attachments/' in path:
+                return 'attachments'
+            if '/threads/' in path:
+                return 'threads'
+            return 'history' if path.endswith('/history') else 'messages'
+
+        with self._lock:
+            return Counter(route(path) for path in self.requests)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests.clear()
+
+    def _history(self, query: Dict) -> Dict:
+        page = int(query.get('pageToken', ['0'])[0])
+        resp = dict(self.history_pages[page])
+        if page + 1 < len(self.history_pages):
+            resp['nextPageToken'] = str(page + 1)
+        return resp
+
+    def _message(self, query: Dict, msg_id: str) -> Dict:
+        message = self.messages.get(msg_id)
+        if message is None or query.get('format', ['full'])[0] != 'metadata':
+            return message
+        names = query.get('metadataHeaders', [])
+        return {
+            'id': message['id'],
+            'labelIds': message.get('labelIds', []),
+            'sizeEstimate': len(json.dumps(message)) + sum(
+                len(self.attachments.get(part['body'].get('attachmentId'), '')) * 3 // 4
+                for part in message['payload'].get('parts', [])
+            ),
+            'payload': {'headers': [header for header in message['payload']['headers']
+                                    if header['name'] in names]},
+        }
+
+    def _thread(self, query: Dict, thread_id: str) -> Dict:
+        messages = [message for message in self.messages.values()
+                    if message.get('threadId') == thread_id]
+        if messages:
+            return {'id': thread_id, 'messages': messages}
+
+    def _attachment(self, query: Dict, msg_id: str, attachment_id: str) -> Dict:
+        if attachment_id in self.attachments:
+            return {'size': len(self.attachments[attachment_id]) * 3 // 4,
+                    'data': self.attachments[attachment_id]}
+
+    def _respond(self, path: str) -> Tuple[int, Dict]:
+        url = urlparse(path)
+        with self._lock:
+            self.requests.append(url.path)
+            failed = self.error_rate and not url.path.endswith('/history') \
+                and self.__random.random() < self.error_rate
+        if failed:
+            return 503, {'error': {'code': 503, 'message': 'The service is currently unavailable.'}}
+
+        body = None
+        for pattern, route in self.ROUTES:
+            match = pattern.match(url.path)
+            if match:
+                body = getattr(self, route)(parse_qs(url.query), **match.groupdict())
+                break
+        if body is None:
+            return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+        return 200, body
+
+    def _respond_batch(self, content_type: str, body: bytes) -> Tuple[str, bytes]:
+        with self._lock:
+            self.requests.append('/batch')
+        batch = BytesParser().parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        boundary = 'batch_boundary'
+        parts = []
+        for part in batch.get_payload():
+            request_line = part.get_payload().splitlines()[0]
+            status, resp = self._respond(request_line.split(' ')[1])
+            content_id = part['Content-ID'].strip('<>')
+            parts.append(
+                f'--{boundary}\r\nContent-Type: application/http\r\n'
+                f'Content-ID: <response-{content_id}>\r\n\r\n'
+                f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                f'Content-Type: application/json\r\n\r\n{json.dumps(resp)}\r\n'
+            )
+        return (f'multipart/mixed; boundary={boundary}',
+                (''.join(parts) + f'--{boundary}--\r\n').encode())
+
+    def __handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, Nagle would delay the body
+            disable_nagle_algorithm = True
+
+            def __send(self, status: int, content_type: str, content: bytes):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                time.sleep(server.latency)
+                status, body = server._respond(self.path)
+                self.__send(status, 'application/json', json.dumps(body).encode())
+
+            def do_POST(self):
+                time.sleep(server.latency)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                content_type, content = server._respond_batch(self.headers['Content-Type'], body)
+                self.__send(200, content_type, content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
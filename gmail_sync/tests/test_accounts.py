@@ -0,0 +1,178 @@
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+from accounts import Account, AccountRegistry, MultiAccountSync, parse_account
+from gmail_sync import GmailSync
+from models import SyncResult
+from state_manager import InMemoryStateManager
+
+
+class AccountRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state_store = InMemoryStateManager({'gmail_accounts': {'accounts': [
+            {'id': 'household', 'emailAddress': 'Home@Example.com'},
+            {'id': 'finance', 'credentialsDocId': 'finance_creds', 'basePath': 'team/finance',
+             'labelId': 'Label_1'},
+            {'id': 'archived', 'enabled': False},
+        ]}})
+        self.registry = AccountRegistry(self.state_store)
+
+    def test_accounts_default_to_separate_documents_and_paths(self):
+        household, finance = self.registry.accounts()
+        self.assertEqual(household, Account(
+            account_id='household', credentials_doc_id='google_credentials_household',
+            sync_state_doc_id='last_sync_state_household', base_path='household',
+            label_id='INBOX', email_address='home@example.com',
+        ))
+        self.assertEqual((finance.credentials_doc_id, finance.base_path, finance.label_id),
+                         ('finance_creds', 'team/finance', 'Label_1'))
+
+    def test_find_by_email(self):
+        self.assertEqual(self.registry.find_by_email('home@example.com').account_id, 'household')
+        self.assertIsNone(self.registry.find_by_email('other@example.com'))
+
+    def test_register_replaces_account_with_same_id(self):
+        self.registry.register({'id': 'finance', 'basePath': 'finance'})
+        self.registry.register({'id': 'travel'})
+        self.assertEqual([(a.account_id, a.base_path) for a in self.registry.accounts()],
+                         [('household', 'household'), ('finance', 'finance'), ('travel', 'travel')])
+
+    def test_missing_registry_has_no_accounts(self):
+        self.assertEqual(AccountRegistry(InMemoryStateManager()).accounts(), [])
+
+    def test_invalid_accounts(self):
+        with self.assertRaises(ValueError):
+            parse_account(0, {'basePath': 'no-id'})
+        with self.assertRaises(ValueError):
+            self.registry.register({'id': ''})
+        self.state_store.set_document_by_id('gmail_accounts', {'accounts': [{'id': 'a'}, {'id': 'a'}]})
+        with self.assertRaises(ValueError):
+            self.registry.accounts()
+
+
+class MultiAccountSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = AccountRegistry(InMemoryStateManager({'gmail_accounts': {'accounts': [
+            {'id': 'a'}, {'id': 'b'}, {'id': 'c'},
+        ]}}))
+        self.syncs = {}
+
+    def create_sync(self, account):
+        sync = Mock(spec=GmailSync)
+        sync.sync.return_value = SyncResult(history_id='2', messages=1)
+        self.syncs.setdefault(account.account_id, []).append(sync)
+        return sync
+
+    def test_accounts_sync_concurrently_on_bounded_pool(self):
+        barrier = threading.Barrier(2, timeout=5)
+        running, peak = [0], [0]
+        lock = threading.Lock()
+
+        def create_sync(account):
+            def sync(**kwargs):
+                with lock:
+                    running[0] += 1
+                    peak[0] = max(peak[0], running[0])
+                # The first two accounts only finish once both are running
+                if account.account_id != 'c':
+                    barrier.wait()
+                with lock:
+                    running[0] -= 1
+                return SyncResult(history_id='2')
+            return Mock(spec=GmailSync, **{'sync.side_effect': sync})
+
+        results = MultiAccountSync(self.registry, create_sync, max_workers=2).sync_all()
+
+        self.assertEqual([r.account_id for r in results], ['a', 'b', 'c'])
+        self.assertTrue(all(r.succeeded for r in results))
+        self.assertEqual(peak[0], 2)
+
+    def test_failed_account_does_not_stop_the_others(self):
+        multi_account_sync = MultiAccountSync(self.registry, self.create_sync)
+        multi_account_sync.sync_all()
+        self.syncs['b'][0].sync.side_effect = Exception('Invalid grant')
+        self.syncs['c'][0].sync.return_value = None
+
+        with self.assertLogs(level='ERROR'):
+            results = multi_account_sync.sync_all(history_types=['messageAdded'])
+
+        self.assertEqual([r.to_dict() for r in results], [
+            {'history_id': '2', 'messages': 1, 'failed_messages': 0, 'attachments': 0,
+             'bytes_downloaded': 0, 'retries': 0, 'in_progress': False},
+            {'error': 'Invalid grant'},
+            {'error': 'Failed to fetch Gmail history'},
+        ])
+        self.syncs['a'][0].sync.assert_called_with(label_id='INBOX', history_types=['messageAdded'])
+        # Only the account that raised gets a new GmailSync
+        multi_account_sync.sync_all()
+        self.assertEqual({account_id: len(syncs) for account_id, syncs in self.syncs.items()},
+                         {'a': 1, 'b': 2, 'c': 1})
+        self.syncs['b'][0].close.assert_called_once()
+
+    def test_sync_is_rebuilt_when_account_changes(self):
+        multi_account_sync = MultiAccountSync(self.registry, self.create_sync)
+        multi_account_sync.sync_all(account_ids=['a'])
+        self.registry.register({'id': 'a', 'basePath': 'moved'})
+        multi_account_sync.sync_all(account_ids=['a'])
+
+        self.assertEqual(list(self.syncs), ['a'])
+        self.assertEqual(len(self.syncs['a']), 2)
+        self.syncs['a'][0].close.assert_called_once()
+        self.syncs['a'][1].close.assert_not_called()
+
+    def test_account_syncs_one_at_a_time(self):
+        lock = threading.Lock()
+        running, peak = [0], [0]
+
+        def create_sync(account):
+            def sync(**kwargs):
+                with lock:
+                    running[0] += 1
+                    peak[0] = max(peak[0], running[0])
+                time.sleep(0.05)
+                with lock:
+                    running[0] -= 1
+                return SyncResult(history_id='2')
+            return Mock(spec=GmailSync, **{'sync.side_effect': sync})
+
+        multi_account_sync = MultiAccountSync(self.registry, create_sync)
+        account = self.registry.get('a')
+        threads = [threading.Thread(target=multi_account_sync.sync_account, args=(account,))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(peak[0], 1)
+
+    def test_notification_already_synced_is_skipped(self):
+        state_store = InMemoryStateManager({
+            'gmail_accounts': {'accounts': [{'id': 'a'}]},
+            'last_sync_state_a': {'historyId': '100'},
+        })
+        multi_account_sync = MultiAccountSync(AccountRegistry(state_store), self.create_sync)
+
+        results = [multi_account_sync.sync_all(history_id=history_id)[0]
+                   for history_id in [90, 110, 105]]
+
+        self.assertEqual([r.to_dict() for r in results], [
+            {'already_synced': True},
+            {'history_id': '2', 'messages': 1, 'failed_messages': 0, 'attachments': 0,
+             'bytes_downloaded': 0, 'retries': 0, 'in_progress': False},
+            {'already_synced': True},
+        ])
+        self.assertTrue(all(r.succeeded for r in results))
+        self.syncs['a'][0].sync.assert_called_once()
+
+    def test_invalid_max_workers(self):
+        with self.assertRaises(ValueError):
+            MultiAccountSync(self.registry, self.create_sync, max_workers=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
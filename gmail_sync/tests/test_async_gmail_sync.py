@@ -0,0 +1,103 @@
+import unittest
+from unittest.mock import Mock
+
+from async_gmail_sync import AsyncGmailClient, AsyncGmailSync
+from state_manager import InMemoryStateManager, StateManager, ThreadedAsyncStateManager
+from storage_manager import InMemoryStorageManager, StorageManager, ThreadedAsyncStorageManager
+from tests.fake_gmail_server import FakeGmailServer, fake_message
+
+
+class AsyncGmailSyncTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.mock_state_store = Mock(spec=StateManager)
+        self.mock_storage = Mock(spec=StorageManager)
+        self.saved = {}
+        self.mock_storage.put_stream.side_effect = \
+            lambda key, stream, metadata, chunk_size: self.saved.update({key: b''.join(stream)})
+        self.server = FakeGmailServer(
+            history_pages=[
+                {'history': [{'messages': [{'id': 'msg1'}, {'id': 'msg2'}]}], 'historyId': '101'},
+                {'history': [{'messages': [{'id': 'msg3'}]}], 'historyId': '102'},
+            ],
+            messages={
+                'msg1': fake_message('msg1', 'Statement <statement@centralthe1card.com>',
+                                     'Your statement (05/10/2023)', ['att1', 'att2']),
+                'msg2': fake_message('msg2', 'someone@example.com', 'Hello', []),
+                'msg3': fake_message('msg3', 'someone@example.com', 'Invoice', ['att3']),
+            },
+            attachments={
+                'att1': 'c29tZSBkYXRh',  # 'some data'
+                'att2': 'bW9yZSBkYXRh',  # 'more data'
+                'att3': 'ZXZlbiBtb3Jl',  # 'even more'
+            },
+        )
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+
+    async def sync(self, **kwargs):
+        async with AsyncGmailClient(base_url=self.server.api_url) as gmail_client:
+            gmail_sync = AsyncGmailSync(
+                state_store=ThreadedAsyncStateManager(self.mock_state_store),
+                storage=ThreadedAsyncStorageManager(self.mock_storage),
+                gmail_client=gmail_client,
+                base_path='attachments',
+                concurrency=4,
+            )
+            return await gmail_sync.sync(**kwargs)
+
+    async def test_sync_against_fake_gmail(self):
+        result = await self.sync(label_id='INBOX', start_history_id='100')
+
+        self.assertIn('102', result)
+        self.assertEqual(self.saved['attachments/centralthe1card/statement_date=2023-10-05/att1.pdf'],
+                         b'some data')
+        self.assertEqual(len(self.saved), 3)
+        self.assertIn(b'even more', self.saved.values())
+        self.assertEqual(
+            [call.kwargs['data'].get('pageToken')
+             for call in self.mock_state_store.set_document_by_id.call_args_list],
+            ['1', None]
+        )
+
+    async def test_sync_logs_failed_messages(self):
+        del self.server.messages['msg2']
+        with self.assertLogs(level='ERROR') as log:
+            await self.sync(label_id='INBOX', start_history_id='100')
+        self.assertIn('Failed to process message msg2', log.output[0])
+        self.assertIn('404', log.output[0])
+        self.assertEqual(len(self.saved), 3)
+
+    async def test_sync_resumes_from_checkpoint(self):
+        self.mock_state_store.get_document_by_id.return_value = {
+            'historyId': '100', 'updatedTime': 1634047722, 'pageToken': '1'
+        }
+        await self.sync(label_id='INBOX')
+        self.assertNotIn('/gmail/v1/users/me/messages/msg1', self.server.requests)
+        self.assertEqual(len(self.saved), 1)
+
+    async def test_sync_into_in_memory_backends(self):
+        state_store = InMemoryStateManager({'last_sync_state': {'historyId': '100'}})
+        storage = InMemoryStorageManager()
+        async with AsyncGmailClient(base_url=self.server.api_url) as gmail_client:
+            await AsyncGmailSync(ThreadedAsyncStateManager(state_store),
+                                 ThreadedAsyncStorageManager(storage), gmail_client).sync()
+
+        self.assertEqual(state_store.documents['last_sync_state']['historyId'], '102')
+        self.assertEqual(sorted(storage.objects.values()), [b'even more', b'more data', b'some data'])
+        self.assertEqual(storage.stat(next(iter(storage.objects))).version, '1')
+        self.assertEqual(self.server.call_counts(), {'history': 2, 'messages': 3, 'attachments': 3})
+
+    async def test_get_message_without_sync(self):
+        async with AsyncGmailClient(base_url=self.server.api_url) as gmail_client:
+            gmail_sync = AsyncGmailSync(ThreadedAsyncStateManager(self.mock_state_store),
+                                        ThreadedAsyncStorageManager(self.mock_storage),
+                                        gmail_client)
+            msg = await gmail_sync.get_message('msg3')
+
+        self.assertEqual(msg.id, 'msg3')
+        self.assertEqual(len(msg.attachments), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,9 @@
 import unittest
-from unittest.mock import Mock, patch
+from unittest.mock import Mock, call, patch
 
-from storage_manager import GoogleCloudStorageManager
+from google.api_core.exceptions import NotFound
+
+from storage_manager import GoogleCloudStorageManager, IterableReader, PutItem
 
 
 class TestGoogleCloudStorageManager(unittest.TestCase):
@@ -26,21 +28,166 @@ class TestGoogleCloudStorageManager(unittest.TestCase):
         self.storage_manager.put(key, data, metadata)
         self.mock_bucket.blob.assert_called_once_with(key)
 
+    def test_put_stream(self):
+        mock_blob = Mock()
+        self.mock_bucket.blob.return_value = mock_blob
+        key = "test_key"
+        metadata = {"key": "value"}
+        self.storage_manager.put_stream(key, [b"test", b"_data"], metadata, chunk_size=262144,
+                                        content_type="application/pdf")
+        self.mock_bucket.blob.assert_called_once_with(key, chunk_size=262144)
+        self.assertEqual(mock_blob.upload_from_file.call_args.kwargs['content_type'], "application/pdf")
+        self.assertEqual(mock_blob.metadata, metadata)
+        stream = mock_blob.upload_from_file.call_args.args[0]
+        self.assertEqual(stream.read(), b"test_data")
+
+    def test_put_many(self):
+        blobs = {}
+
+        def blob(key, **kwargs):
+            blobs[key] = Mock()
+            if key == 'broken':
+                blobs[key].upload_from_string.side_effect = Exception('Service Unavailable')
+            return blobs[key]
+
+        self.mock_bucket.blob.side_effect = blob
+        failures = self.storage_manager.put_many([
+            PutItem(key='a', data=b'a', metadata={'k': 'v'}, content_type='application/pdf'),
+            PutItem(key='b', stream=[b'b'], content_type='image/png'),
+            PutItem(key='broken', data=b'c'),
+        ])
+
+        self.assertEqual(list(failures), ['broken'])
+        self.assertEqual(blobs['a'].metadata, {'k': 'v'})
+        blobs['a'].upload_from_string.assert_called_once_with(b'a', content_type='application/pdf')
+        self.assertEqual(blobs['b'].upload_from_file.call_args.kwargs['content_type'], 'image/png')
+
+    def test_iterable_reader(self):
+        reader = IterableReader([b"ab", b"", b"cde"])
+        self.assertEqual(reader.read(3), b"abc")
+        self.assertEqual(reader.read(), b"de")
+        self.assertEqual(reader.read(), b"")
+
+    def test_iterable_reader_position(self):
+        reader = IterableReader([b"ab", b"cde"])
+        self.assertFalse(reader.seekable())
+        self.assertEqual(reader.tell(), 0)
+        reader.read(3)
+        self.assertEqual(reader.tell(), 3)
+
     def test_get_data(self):
         mock_blob = Mock()
-        self.mock_bucket.get_blob.return_value = mock_blob
+        mock_blob.download_as_bytes.return_value = b"test_data"
+        self.mock_bucket.blob.return_value = mock_blob
         key = "test_key"
-        retrieved_blob = self.storage_manager.get(key)
-        self.mock_bucket.get_blob.assert_called_once_with(key)
-        self.assertEqual(retrieved_blob, mock_blob)
+        data = self.storage_manager.get(key)
+        self.mock_bucket.blob.assert_called_once_with(key)
+        mock_blob.download_as_bytes.assert_called_once_with(start=None, end=None)
+        self.assertEqual(data, b"test_data")
+
+    def test_get_range(self):
+        mock_blob = Mock()
+        self.mock_bucket.blob.return_value = mock_blob
+        self.storage_manager.get_range("test_key", 10, 20)
+        # The end of a GCS range is inclusive
+        mock_blob.download_as_bytes.assert_called_once_with(start=10, end=19)
+
+        self.assertEqual(self.storage_manager.get_range("test_key", 0, 0), b"")
+        self.assertEqual(self.storage_manager.get_range("test_key", 5, 3), b"")
+        mock_blob.download_as_bytes.assert_called_once()
+
+    def test_get_stream(self):
+        reader = Mock()
+        reader.read.side_effect = [b"test", b"_data", b""]
+        self.mock_bucket.blob.return_value.open.return_value.__enter__ = Mock(return_value=reader)
+        self.mock_bucket.blob.return_value.open.return_value.__exit__ = Mock(return_value=False)
+        chunks = list(self.storage_manager.get_stream("test_key", chunk_size=4))
+        self.assertEqual(chunks, [b"test", b"_data"])
+        self.mock_bucket.blob.return_value.open.assert_called_once_with('rb', chunk_size=4)
 
     def test_get_data_nonexistent_key(self):
-        # Return None to simulate non-existing blob
-        self.mock_bucket.get_blob.return_value = None
+        self.mock_bucket.blob.return_value.download_as_bytes.side_effect = NotFound('No such object')
         key = "nonexistent_key"
-        with self.assertRaises(RuntimeError):
+        with self.assertRaisesRegex(RuntimeError, "No data found"):
             _ = self.storage_manager.get(key)
 
+    def test_stat(self):
+        self.mock_bucket.get_blob.return_value = Mock(size=9, generation=123, metadata={'k': 'v'})
+        info = self.storage_manager.stat("test_key")
+        self.assertEqual((info.size, info.version, info.metadata), (9, '123', {'k': 'v'}))
+
+        self.mock_bucket.get_blob.return_value = None
+        with self.assertRaises(RuntimeError):
+            self.storage_manager.stat("nonexistent_key")
+
 
 if __name__ == "__main__":
     unittest.main()
+
+
+class FakeUploadSession:
+    """HTTP session answering the resumable upload protocol of GCS, keeping what was sent."""
+
+    is_mtls = False
+
+    def __init__(self):
+        self.data = b''
+        self.requests = []
+
+    def request(self, method, url, data=None, headers=None, timeout=None, **kwargs):
+        self.requests.append((method, url, headers))
+        response = Mock(headers={}, status_code=200)
+        if 'uploadType=resumable' in url and method == 'POST':
+            response.headers = {'location': 'https://upload.example.com/session'}
+            response.content = b''
+            return response
+        self.data += data.read() if hasattr(data, 'read') else data
+        final = not headers['content-range'].endswith('/*')
+        response.status_code = 200 if final else 308
+        response.headers = {} if final else {'range': f'bytes=0-{len(self.data) - 1}'}
+        response.content = b'{"name": "key", "bucket": "test_bucket", "size": "%d"}' % len(self.data)
+        response.json.return_value = {'name': 'key', 'bucket': 'test_bucket', 'size': str(len(self.data))}
+        return response
+
+
+class TestGoogleCloudStorageUpload(unittest.TestCase):
+
+    @patch("storage_manager.ServiceAccountCredentials")
+    def test_pool_size_mounts_adapter_on_own_session(self, mock_credentials):
+        from google.auth.credentials import AnonymousCredentials
+
+        mock_credentials.from_service_account_file.return_value = AnonymousCredentials()
+        with patch("storage_manager.GCSClient") as mock_gcs_client:
+            GoogleCloudStorageManager(bucket='test_bucket', service_account_file='key.json',
+                                      pool_size=32)
+
+        session = mock_gcs_client.call_args.kwargs['_http']
+        self.assertEqual(session.get_adapter('https://storage.googleapis.com')._pool_maxsize, 32)
+        self.assertEqual(mock_credentials.from_service_account_file.call_args.kwargs['scopes'],
+                         mock_gcs_client.SCOPE)
+
+        # A given client keeps its own session
+        client = Mock()
+        GoogleCloudStorageManager(bucket='test_bucket', client=client, pool_size=32)
+        self.assertEqual(client.mock_calls, [call.bucket(bucket_name='test_bucket')])
+
+    def test_stream_uploads_with_real_blob(self):
+        from google.auth.credentials import AnonymousCredentials
+        from google.cloud.storage import Client
+
+        client = Client(project='test', credentials=AnonymousCredentials())
+        session = FakeUploadSession()
+        client._http_internal = session
+        storage_manager = GoogleCloudStorageManager(bucket='test_bucket', client=client)
+        chunks = [b'x' * 256 * 1024, b'y' * 256 * 1024, b'z' * 100]
+
+        storage_manager.put_stream('key', chunks, chunk_size=256 * 1024)
+        self.assertEqual(session.data, b''.join(chunks))
+
+        session.data = b''
+        failures = storage_manager.put_many([PutItem(key='key', stream=iter(chunks),
+                                                     content_type='application/pdf')])
+        self.assertEqual(failures, {})
+        self.assertEqual(session.data, b''.join(chunks))
+        initiate_headers = [headers for method, url, headers in session.requests if method == 'POST'][-1]
+        self.assertEqual(initiate_headers['x-upload-content-type'], 'application/pdf')
@@ -1,11 +1,20 @@
-from datetime import datetime
+from datetime import date, datetime
 import tempfile
+import threading
+import time
 import unittest
 from unittest.mock import MagicMock, Mock, patch
 
-from gmail_sync import Attachment, GmailSync, Message
-from state_manager import StateManager
-from storage_manager import StorageManager
+from googleapiclient.errors import HttpError
+
+from gmail_sync import Attachment, GmailSync, Message, MessageFilter, extract_attachment_info
+from instrumentation import Exporter, Instrumentation
+from ledger import ProcessedLedger
+from models import SyncResult
+from routing import AttachmentFilter
+from state_manager import InMemoryStateManager, StateManager
+from storage_manager import InMemoryStorageManager, StorageManager
+from tests.fake_gmail_server import fake_message
 
 
 class GmailSyncTest(unittest.TestCase):
@@ -40,10 +49,13 @@ class GmailSyncTest(unittest.TestCase):
         mock_credentials.from_authorized_user_info.return_value = mock_creds
         mock_credentials.from_authorized_user_file.return_value = None
 
-        self.mock_state_store.get_document_by_id.return_value = {
-            'client_secret': "MOCK_CLIENT_SECRET",
-            'refresh_token': "MOCK_REFRESH_TOKEN",
-            'client_id': "MOCK_CLIENT_ID"
+        self.mock_state_store.get_documents_by_ids.return_value = {
+            'credentials_doc_id': {
+                'client_secret': "MOCK_CLIENT_SECRET",
+                'refresh_token': "MOCK_REFRESH_TOKEN",
+                'client_id': "MOCK_CLIENT_ID"
+            },
+            'last_sync_state': {'historyId': '12345'},
         }
 
         with tempfile.NamedTemporaryFile(delete=True) as temp:
@@ -55,8 +67,12 @@ class GmailSyncTest(unittest.TestCase):
 
             # Assert the Gmail client is built correctly
             mock_credentials = mock_credentials.from_authorized_user_info.return_value
-            mock_build.assert_called_once_with('gmail', 'v1', credentials=mock_credentials)
+            mock_build.assert_called_once_with('gmail', 'v1', credentials=mock_credentials,
+                                               static_discovery=True, cache_discovery=False)
             self.assertEqual(client, mock_build.return_value)
+            # The sync state is read in the same round trip
+            self.mock_state_store.get_documents_by_ids.assert_called_once_with(
+                ['credentials_doc_id', 'last_sync_state'])
 
     @patch("gmail_sync.Credentials")
     @patch("gmail_sync.build")
@@ -74,7 +90,8 @@ class GmailSyncTest(unittest.TestCase):
 
         mock_exists.assert_called_once_with(cache_path)
         mock_credentials.from_authorized_user_file.assert_called_once_with('token.json')
-        mock_build.assert_called_once_with('gmail', 'v1', credentials=mock_creds)
+        mock_build.assert_called_once_with('gmail', 'v1', credentials=mock_creds,
+                                           static_discovery=True, cache_discovery=False)
 
     @patch("gmail_sync.Credentials")
     @patch("gmail_sync.build")
@@ -88,10 +105,13 @@ class GmailSyncTest(unittest.TestCase):
         mock_credentials.from_authorized_user_file.return_value = None
 
         # Mock methods and attributes
-        self.mock_state_store.get_document_by_id.return_value = {
-            'client_secret': "MOCK_CLIENT_SECRET",
-            'refresh_token': "MOCK_REFRESH_TOKEN",
-            'client_id': "MOCK_CLIENT_ID"
+        self.mock_state_store.get_documents_by_ids.return_value = {
+            'credentials_doc_id': {
+                'client_secret': "MOCK_CLIENT_SECRET",
+                'refresh_token': "MOCK_REFRESH_TOKEN",
+                'client_id': "MOCK_CLIENT_ID"
+            },
+            'last_sync_state': {'historyId': '12345'},
         }
 
         with tempfile.NamedTemporaryFile(delete=True) as temp:
@@ -103,7 +123,8 @@ class GmailSyncTest(unittest.TestCase):
 
             # Assert the Gmail client is built correctly
             mock_credentials = mock_credentials.from_authorized_user_info.return_value
-            mock_build.assert_called_once_with('gmail', 'v1', credentials=mock_credentials)
+            mock_build.assert_called_once_with('gmail', 'v1', credentials=mock_credentials,
+                                               static_discovery=True, cache_discovery=False)
             self.assertEqual(client, mock_build.return_value)
 
     @patch("gmail_sync.Credentials")
@@ -116,6 +137,23 @@ class GmailSyncTest(unittest.TestCase):
             self.gmail_sync._GmailSync__init_gmail_client('cache_path', 'credentials_doc_id')
         self.assertIn("Failed to initialize Gmail client.", str(context.exception))
 
+    @patch("gmail_sync.Request")
+    def test_refresh_expired_credentials_before_sync(self, mock_request):
+        mock_creds = Mock()
+        mock_creds.expired = True
+        mock_creds.to_json.return_value = '{"token": "fresh_token"}'
+        self.gmail_sync._GmailSync__credentials = mock_creds
+        self.mock_gmail_client.users().history().list().execute.return_value = {}
+
+        with tempfile.NamedTemporaryFile() as temp:
+            self.gmail_sync._GmailSync__credentials_cache_path = temp.name
+            self.gmail_sync.sync(label_id='INBOX', start_history_id='12345')
+            mock_creds.expired = False
+            self.gmail_sync.sync(label_id='INBOX', start_history_id='12345')
+
+            mock_creds.refresh.assert_called_once_with(mock_request.return_value)
+            self.assertEqual(temp.read(), b'{"token": "fresh_token"}')
+
     def test_get_message(self):
         self.mock_gmail_client.users().messages().get().execute.return_value = {
             'id': 'msg1',
@@ -147,8 +185,144 @@ class GmailSyncTest(unittest.TestCase):
         self.mock_storage.put.assert_called_with(
             key=unittest.mock.ANY,  # UUID will be generated dynamically
             data=attachment.data,
-            metadata=unittest.mock.ANY  # Metadata will contain various details
+            metadata=unittest.mock.ANY,  # Metadata will contain various details
+            content_type='image/jpeg'  # Sent however many attachments the message has
+        )
+
+    def test_save_message_attachments_uploads_concurrently(self):
+        attachments = [
+            Attachment(id=f'att{i}', filename=f'file{i}', mime_type='application/pdf',
+                       data=b'data', part_id=str(i))
+            for i in range(3)
+        ]
+        message = Message(
+            id='msg1', thread_id='thread1', from_address='test@example.com',
+            subject='Test Email', recieved_date=1634047722, attachments=attachments
         )
+        ledger = Mock(spec=ProcessedLedger)
+        gmail_sync = GmailSync(state_store=self.mock_state_store, storage=self.mock_storage,
+                               gmail_client=self.mock_gmail_client, ledger=ledger)
+        self.mock_storage.put_many.side_effect = lambda items: {
+            items[1].key: RuntimeError('Service Unavailable')
+        }
+
+        with self.assertRaisesRegex(RuntimeError, 'Failed to save 1 attachments'):
+            gmail_sync._GmailSync__save_message_attachments(message)
+
+        items = self.mock_storage.put_many.call_args.args[0]
+        self.assertEqual([item.content_type for item in items], ['application/pdf'] * 3)
+        self.mock_storage.put.assert_not_called()
+        self.assertEqual(ledger.mark_attachment_saved.call_args_list, [
+            unittest.mock.call('msg1', '0'), unittest.mock.call('msg1', '2')
+        ])
+        ledger.mark_processed.assert_not_called()
+
+    def test_save_message_attachments_streams_encoded_data(self):
+        # 'some data' in base64 url-safe encoding, decoded 3 bytes at a time
+        attachment = Attachment(id='att1', filename='file1', mime_type='application/pdf',
+                                encoded_data='c29tZSBkYXRh')
+        self.assertEqual(list(attachment.iter_data(chunk_size=3)), [b'som', b'e d', b'ata'])
+
+        message = Message(
+            id='msg1', thread_id='thread1', from_address='test@example.com',
+            subject='Test Email', recieved_date=1634047722, attachments=[attachment]
+        )
+        self.gmail_sync._GmailSync__save_message_attachments(message)
+
+        self.mock_storage.put.assert_not_called()
+        stream = self.mock_storage.put_stream.call_args.kwargs['stream']
+        self.assertEqual(b''.join(stream), b'some data')
+
+    def _dedup_gmail_sync(self):
+        return GmailSync(
+            state_store=self.mock_state_store,
+            storage=self.mock_storage,
+            gmail_client=self.mock_gmail_client,
+            deduplicate=True,
+        )
+
+    def test_save_message_attachments_indexes_new_content(self):
+        state_store = InMemoryStateManager()
+        attachment = Attachment(id='att1', filename='file1', mime_type='image/jpeg', data=b'data')
+        message = Message(
+            id='msg1', thread_id='thread1', from_address='test@example.com',
+            subject='Test Email', recieved_date=1634047722, attachments=[attachment]
+        )
+        gmail_sync = GmailSync(state_store=state_store, storage=self.mock_storage,
+                               gmail_client=self.mock_gmail_client, deduplicate=True)
+        gmail_sync._GmailSync__save_message_attachments(message)
+
+        digest = '3a6eb0790f39ac87c94f3856b2dd2c5d110e6811602261a9a923d3bb23adc8b7'
+        key = f'/unmatched_documents/from=test@example.com/{digest[:16]}_file1'
+        self.mock_storage.put.assert_called_once_with(
+            key=key, data=b'data', metadata=unittest.mock.ANY, content_type=unittest.mock.ANY
+        )
+        self.assertEqual(
+            state_store.documents[f'attachment_sha256_{digest}'],
+            {'key': key, 'gmailMessageID': 'msg1', 'attachmentId': 'att1', 'aliases': []}
+        )
+
+    def test_save_message_attachments_fails_when_index_cannot_be_read(self):
+        self.mock_state_store.get_documents_by_ids.side_effect = RuntimeError('Unavailable')
+        attachment = Attachment(id='att1', filename='file1', mime_type='image/jpeg', data=b'data')
+        message = Message(
+            id='msg1', thread_id='thread1', from_address='test@example.com',
+            subject='Test Email', recieved_date=1634047722, attachments=[attachment]
+        )
+        with self.assertRaises(RuntimeError):
+            self._dedup_gmail_sync()._GmailSync__save_message_attachments(message)
+
+        # Saving it again now could leave a duplicate of content saved before
+        self.mock_storage.put.assert_not_called()
+
+    def test_content_indexed_meanwhile_keeps_its_entry(self):
+        digest = '3a6eb0790f39ac87c94f3856b2dd2c5d110e6811602261a9a923d3bb23adc8b7'
+        state_store = InMemoryStateManager()
+        indexed = {'key': 'saved/file1', 'gmailMessageID': 'msg1', 'attachmentId': 'att1',
+                   'aliases': [{'key': 'saved/file1', 'gmailMessageID': 'msg3',
+                                'gmailThreadID': 'thread3', 'attachmentId': 'att3'}]}
+        attachment = Attachment(id='att2', filename='file1', mime_type='image/jpeg', data=b'data')
+        message = Message(
+            id='msg2', thread_id='thread2', from_address='test@example.com',
+            subject='Fwd: Test Email', recieved_date=1634047722, attachments=[attachment]
+        )
+        gmail_sync = GmailSync(state_store=state_store, storage=self.mock_storage,
+                               gmail_client=self.mock_gmail_client, deduplicate=True)
+
+        # Another message indexes the content while this one uploads it
+        def put(**kwargs):
+            state_store.set_document_by_id(f'attachment_sha256_{digest}', indexed)
+        self.mock_storage.put.side_effect = put
+        gmail_sync._GmailSync__save_message_attachments(message)
+
+        entry = state_store.documents[f'attachment_sha256_{digest}']
+        self.assertEqual(entry['key'], 'saved/file1')
+        self.assertEqual([alias['gmailMessageID'] for alias in entry['aliases']], ['msg3', 'msg2'])
+
+    def test_save_message_attachments_skips_known_content(self):
+        digest = '3a6eb0790f39ac87c94f3856b2dd2c5d110e6811602261a9a923d3bb23adc8b7'
+        state_store = InMemoryStateManager({f'attachment_sha256_{digest}': {
+            'key': 'saved/file1', 'gmailMessageID': 'msg1', 'attachmentId': 'att1', 'aliases': []
+        }})
+        attachment = Attachment(id='att2', filename='file1', mime_type='image/jpeg', data=b'data')
+        forwarded = Message(
+            id='msg2', thread_id='thread2', from_address='test@example.com',
+            subject='Fwd: Test Email', recieved_date=1634047722, attachments=[attachment]
+        )
+        retried = Message(
+            id='msg1', thread_id='thread1', from_address='test@example.com',
+            subject='Test Email', recieved_date=1634047722, attachments=[attachment]
+        )
+        gmail_sync = GmailSync(state_store=state_store, storage=self.mock_storage,
+                               gmail_client=self.mock_gmail_client, deduplicate=True)
+        gmail_sync._GmailSync__save_message_attachments(forwarded)
+        gmail_sync._GmailSync__save_message_attachments(forwarded)
+        gmail_sync._GmailSync__save_message_attachments(retried)
+
+        self.mock_storage.put.assert_not_called()
+        # Only the forwarded copy is recorded as an alias, once
+        aliases = state_store.documents[f'attachment_sha256_{digest}']['aliases']
+        self.assertEqual([alias['gmailMessageID'] for alias in aliases], ['msg2'])
 
     def test_download_attachment(self):
         # Mocking Gmail API response for attachment download
@@ -179,7 +353,7 @@ class GmailSyncTest(unittest.TestCase):
             }
         }
 
-        attachments = self.gmail_sync._GmailSync__extract_attachment_info(message)
+        attachments = extract_attachment_info(message)
 
         self.assertEqual(len(attachments), 2)
         self.assertEqual(attachments[0]['filename'], 'file1')
@@ -195,7 +369,7 @@ class GmailSyncTest(unittest.TestCase):
                 ]
             }
         }
-        attachments = self.gmail_sync._GmailSync__extract_attachment_info(message)
+        attachments = extract_attachment_info(message)
         self.assertEqual(len(attachments), 0)
 
     def test_sync_with_api_failure(self):
@@ -252,6 +426,730 @@ class GmailSyncTest(unittest.TestCase):
             data={'historyId': '12346', 'updatedTime': unittest.mock.ANY}
         )
 
+    def test_sync_returns_and_exports_stats(self):
+        self.mock_gmail_client.users().history().list().execute.return_value = {
+            'history': [{'messages': [{'id': 'msg1'}, {'id': 'msg2'}]}], 'historyId': '12346'
+        }
+        self.mock_gmail_client.users().messages().get().execute.side_effect = [
+            fake_message('msg1', 'bank@example.com', 'Statement', ['att1', 'att2']),
+            fake_message('msg2', 'friend@example.com', 'Hello', []),
+        ]
+        self.mock_gmail_client.users().messages().attachments().get().execute.return_value = {
+            'data': 'c29tZSBkYXRh'
+        }
+        exporter = Mock(spec=Exporter)
+        storage = InMemoryStorageManager()
+        gmail_sync = GmailSync(state_store=InMemoryStateManager(), storage=storage,
+                               gmail_client=self.mock_gmail_client,
+                               instrumentation=Instrumentation([exporter]))
+
+        result = gmail_sync.sync(label_id='INBOX', start_history_id='12345')
+
+        self.assertEqual((result.history_id, result.messages, result.failed_messages,
+                          result.attachments, result.bytes_downloaded), ('12346', 2, 0, 2, 24))
+        self.assertEqual(result.stats['counters']['api_calls.attachments.get'], 2)
+        self.assertEqual(result.stats['counters']['decode.bytes'], 18)
+        self.assertEqual(result.stats['spans']['messages.get']['count'], 2)
+        self.assertIn('storage.put', result.stats['spans'])
+        self.assertEqual(result.stats['spans']['sync']['count'], 1)
+        exporter.export.assert_called_once_with(result.stats)
+        self.assertEqual(exporter.export.call_args.args[0]['historyId'], '12346')
+
+        # Stats cover the latest sync only
+        self.mock_gmail_client.users().history().list().execute.return_value = {}
+        result = gmail_sync.sync(label_id='INBOX', start_history_id='12346')
+        self.assertTrue(result.up_to_date)
+        self.assertEqual(result.stats['counters'], {'api_calls.history.list': 1})
+
+    def test_overlapping_syncs_keep_their_own_stats(self):
+        gmail_sync = GmailSync(state_store=InMemoryStateManager(), storage=self.mock_storage,
+                               gmail_client=self.mock_gmail_client,
+                               instrumentation=Instrumentation([]))
+        lock = threading.Lock()
+        running, peak = [0], [0]
+
+        def sync_history(*args):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            gmail_sync.instrumentation.count('messages.processed')
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return SyncResult(history_id='12346', messages=gmail_sync.instrumentation.counter(
+                'messages.processed'))
+
+        results = []
+        with patch.object(gmail_sync, '_GmailSync__sync_history', side_effect=sync_history):
+            threads = [threading.Thread(target=lambda: results.append(gmail_sync.sync()))
+                       for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(peak[0], 1)
+        self.assertEqual([result.messages for result in results], [1, 1, 1])
+        self.assertEqual([result.stats['counters'] for result in results],
+                         [{'messages.processed': 1}] * 3)
+
+    def test_sync_paginated_history_checkpoints_each_page(self):
+        self.mock_gmail_client.users().history().list().execute.side_effect = [
+            {'history': [{'messages': [{'id': 'msg1'}, {'id': 'msg1'}]}],
+             'historyId': '12346', 'nextPageToken': 'page2'},
+            {'history': [{'messages': [{'id': 'msg2'}]}], 'historyId': '12347'},
+        ]
+        processed = []
+        with patch.object(self.gmail_sync, 'get_message', side_effect=processed.append), \
+                patch.object(self.gmail_sync, '_GmailSync__save_message_attachments'):
+            result = self.gmail_sync.sync(label_id='INBOX', start_history_id='12345')
+
+        self.assertEqual(processed, ['msg1', 'msg2'])
+        self.mock_gmail_client.users().history().list.assert_called_with(
+            userId='me',
+            startHistoryId='12345',
+            labelId='INBOX',
+            historyTypes=['messageAdded', 'labelAdded'],
+            pageToken='page2'
+        )
+        self.assertEqual(self.mock_state_store.set_document_by_id.call_args_list, [
+            unittest.mock.call(id='last_sync_state', data={
+                'historyId': '12345', 'updatedTime': unittest.mock.ANY, 'pageToken': 'page2'
+            }),
+            unittest.mock.call(id='last_sync_state', data={
+                'historyId': '12347', 'updatedTime': unittest.mock.ANY
+            }),
+        ])
+        self.assertEqual(result.history_id, '12347')
+
+    def test_sync_resumes_from_checkpoint(self):
+        self.mock_state_store.get_document_by_id.return_value = {
+            'historyId': '12345', 'updatedTime': 1634047722, 'pageToken': 'page40'
+        }
+        self.mock_gmail_client.users().history().list().execute.return_value = {
+            'historyId': '12350'
+        }
+        self.gmail_sync.sync(label_id='INBOX')
+
+        self.mock_gmail_client.users().history().list.assert_called_with(
+            userId='me',
+            startHistoryId='12345',
+            labelId='INBOX',
+            historyTypes=['messageAdded', 'labelAdded'],
+            pageToken='page40'
+        )
+        # The walk completed, so the checkpoint is replaced by the new history ID
+        self.mock_state_store.set_document_by_id.assert_called_once_with(
+            id='last_sync_state',
+            data={'historyId': '12350', 'updatedTime': unittest.mock.ANY}
+        )
+
+    def test_get_message_downloads_attachments_concurrently(self):
+        gmail_sync = GmailSync(
+            state_store=self.mock_state_store,
+            storage=self.mock_storage,
+            gmail_client=self.mock_gmail_client,
+            credentials=Mock(expired=False),
+            max_workers=3,
+        )
+        self.mock_gmail_client.users().messages().get().execute.return_value = {
+            'threadId': 'thread1',
+            'internalDate': '1634047722',
+            'payload': {
+                'headers': [
+                    {'name': 'Subject', 'value': 'Test Email'},
+                    {'name': 'From', 'value': 'test@example.com'}
+                ],
+                'parts': [
+                    {'filename': f'file{i}', 'body': {'attachmentId': f'att{i}'}}
+                    for i in range(3)
+                ]
+            }
+        }
+        # Every download waits for the others, so this only passes when they run concurrently
+        barrier = threading.Barrier(3, timeout=5)
+
+        def download(*args, **kwargs):
+            barrier.wait()
+            return 'ZGF0YQ=='
+
+        with patch.object(gmail_sync, '_GmailSync__fetch_attachment_data', side_effect=download):
+            message = gmail_sync.get_message('msg1')
+
+        self.assertEqual([a.filename for a in message.attachments], ['file0', 'file1', 'file2'])
+
+    def test_concurrent_requests_use_a_transport_per_thread(self):
+        gmail_sync = GmailSync(
+            state_store=self.mock_state_store,
+            storage=self.mock_storage,
+            gmail_client=self.mock_gmail_client,
+            credentials=Mock(expired=False),
+            max_workers=2,
+        )
+        transports = []
+        request = Mock()
+        request.execute.side_effect = lambda http: transports.append(http)
+
+        threads = [threading.Thread(target=gmail_sync._GmailSync__execute, args=(request, 'messages.get'))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        gmail_sync._GmailSync__execute(request, 'messages.get')
+        gmail_sync._GmailSync__execute(request, 'messages.get')
+
+        self.assertEqual(len(set(map(id, transports))), 3)
+        self.assertIs(transports[2], transports[3])
+
+    def test_sync_skips_processed_messages(self):
+        mock_ledger = Mock(spec=ProcessedLedger)
+        mock_ledger.is_processed.side_effect = lambda msg_id: msg_id == 'msg1'
+        mock_ledger.saved_attachments.return_value = {'1'}
+        gmail_sync = GmailSync(
+            state_store=self.mock_state_store,
+            storage=self.mock_storage,
+            gmail_client=self.mock_gmail_client,
+            ledger=mock_ledger,
+        )
+        self.mock_gmail_client.users().history().list().execute.return_value = {
+            'history': [{'messages': [{'id': 'msg1'}, {'id': 'msg2'}]}],
+            'historyId': '12346'
+        }
+        self.mock_gmail_client.users().messages().get().execute.return_value = {
+            'threadId': 'thread2',
+            'internalDate': '1634047722',
+            'payload': {
+                'headers': [
+                    {'name': 'Subject', 'value': 'Test Email'},
+                    {'name': 'From', 'value': 'test@example.com'}
+                ],
+                'parts': [
+                    {'partId': '1', 'filename': 'file1', 'body': {'attachmentId': 'att1'}},
+                    {'partId': '2', 'filename': 'file2', 'body': {'attachmentId': 'att2'}},
+                ]
+            }
+        }
+        self.mock_gmail_client.users().messages().attachments().get().execute.return_value = {
+            'data': 'c29tZSBkYXRh'
+        }
+        self.mock_gmail_client.users().messages().get.reset_mock()
+        self.mock_gmail_client.users().messages().attachments().get.reset_mock()
+
+        gmail_sync.sync(label_id='INBOX', start_history_id='12345')
+
+        # msg1 is skipped before any Gmail call, msg2 only downloads the unsaved part
+        self.mock_gmail_client.users().messages().get.assert_called_once_with(
+            userId='me', id='msg2'
+        )
+        self.mock_gmail_client.users().messages().attachments().get.assert_called_once_with(
+            userId='me', messageId='msg2', id='att2'
+        )
+        self.mock_storage.put_stream.assert_called_once()
+        mock_ledger.mark_processed.assert_called_once_with('msg2')
+
+    def _mock_batches(self, responses):
+        """Make Gmail batch requests answer from `responses`, keyed by request ID."""
+        batches = []
+
+        def new_batch_http_request(callback):
+            batch = Mock()
+            batch.request_ids = []
+            batch.add.side_effect = lambda request, request_id: batch.request_ids.append(request_id)
+
+            def execute():
+                for request_id in batch.request_ids:
+                    response = responses[request_id]
+                    if isinstance(response, list):
+                        # Answers of the successive attempts
+                        response = response.pop(0)
+                    if isinstance(response, Exception):
+                        callback(request_id, None, response)
+                    else:
+                        callback(request_id, response, None)
+            batch.execute.side_effect = execute
+            batches.append(batch)
+            return batch
+
+        self.mock_gmail_client.new_batch_http_request.side_effect = new_batch_http_request
+        return batches
+
+    def test_get_messages_batched(self):
+        gmail_sync = GmailSync(
+            state_store=self.mock_state_store,
+            storage=self.mock_storage,
+            gmail_client=self.mock_gmail_client,
+            batch_size=2,
+        )
+        message = {
+            'threadId': 'thread1',
+            'internalDate': '1634047722',
+            'payload': {
+                'headers': [
+                    {'name': 'Subject', 'value': 'Test Email'},
+                    {'name': 'From', 'value': 'Test <test@example.com>'}
+                ],
+                'parts': [{'filename': 'file1', 'body': {'attachmentId': 'att1'}}]
+            }
+        }
+        batches = self._mock_batches({
+            'msg1': message,
+            'msg2': message,
+            'msg3': Exception('Not Found'),
+            'msg1:0': {'data': 'c29tZSBkYXRh'},
+            'msg2:0': Exception('Rate Limited'),
+        })
+
+        results = gmail_sync.get_messages(['msg1', 'msg2', 'msg3'])
+
+        # 3 messages.get and 2 attachments.get calls in batches of 2
+        self.assertEqual([b.request_ids for b in batches],
+                         [['msg1', 'msg2'], ['msg3'], ['msg1:0', 'msg2:0']])
+        self.assertEqual(results['msg1'].from_address, 'test@example.com')
+        self.assertEqual(b''.join(results['msg1'].attachments[0].iter_data()), b'some data')
+        self.assertIn('Rate Limited', str(results['msg2']))
+        self.assertIn('Not Found', str(results['msg3']))
+
+    @patch('scheduler.time.sleep')
+    def test_get_messages_batched_retries_throttled_calls(self, mock_sleep):
+        gmail_sync = GmailSync(
+            state_store=self.mock_state_store,
+            storage=self.mock_storage,
+            gmail_client=self.mock_gmail_client,
+            batch_size=10,
+        )
+        throttled = HttpError(Mock(status=429), b'Too many concurrent requests for user')
+        batches = self._mock_batches({
+            'msg1': fake_message('msg1', 'bank@example.com', 'Statement', []),
+            'msg2': [throttled, throttled, fake_message('msg2', 'bank@example.com', 'Statement', [])],
+            'msg3': HttpError(Mock(status=404), b'Not Found'),
+        })
+
+        results = gmail_sync.get_messages(['msg1', 'msg2', 'msg3'])
+
+        self.assertEqual([b.request_ids for b in batches],
+                         [['msg1', 'msg2', 'msg3'], ['msg2'], ['msg2']])
+        self.assertEqual(results['msg2'].id, 'msg2')
+        self.assertIsInstance(results['msg3'], HttpError)
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(gmail_sync.instrumentation.counter('api_calls.retries'), 2)
+
+    def test_message_filter(self):
+        metadata = {
+            'labelIds': ['INBOX', 'Label_1'],
+            'sizeEstimate': 20000,
+            'payload': {'headers': [{'name': 'From', 'value': 'Bank <Statement@Bank.com>'},
+                                    {'name': 'Subject', 'value': 'Hello'}]},
+        }
+        self.assertTrue(MessageFilter().accepts(metadata))
+        self.assertTrue(MessageFilter(senders=['*@bank.com'], label_ids=['Label_1']).accepts(metadata))
+        self.assertTrue(MessageFilter(senders=['statement@bank.com'], max_size=20000).accepts(metadata))
+        self.assertFalse(MessageFilter(senders=['*@example.com']).accepts(metadata))
+        self.assertFalse(MessageFilter(label_ids=['Label_2']).accepts(metadata))
+        self.assertFalse(MessageFilter(min_size=50000).accepts(metadata))
+        self.assertFalse(MessageFilter(routed_only=True).accepts(metadata))
+
+        statement = {'payload': {'headers': [
+            {'name': 'From', 'value': 'statement@centralthe1card.com'},
+            {'name': 'Subject', 'value': 'Your statement (05/10/2023)'},
+        ]}}
+        self.assertTrue(MessageFilter(routed_only=True).accepts(statement))
+
+    def test_get_messages_fetches_metadata_first(self):
+        gmail_sync = GmailSync(
+            state_store=InMemoryStateManager(),
+            storage=InMemoryStorageManager(),
+            gmail_client=self.mock_gmail_client,
+            message_filter=MessageFilter(routed_only=True),
+        )
+        self.mock_gmail_client.users().history().list().execute.return_value = {
+            'history': [{'messages': [{'id': 'msg1'}, {'id': 'msg2'}, {'id': 'msg3'}]}],
+            'historyId': '12346'
+        }
+        statement = fake_message('msg1', 'statement@centralthe1card.com',
+                                 'Your statement (05/10/2023)', ['att1'])
+        batches = self._mock_batches({
+            'msg1': statement,
+            'msg2': fake_message('msg2', 'news@example.com', 'Weekly news', ['att2']),
+            'msg3': HttpError(Mock(status=404), b'Not Found'),
+        })
+        messages = self.mock_gmail_client.users().messages()
+        messages.get().execute.side_effect = [statement, Exception('Not Found')]
+        messages.attachments().get().execute.return_value = {'data': 'c29tZSBkYXRh'}
+
+        with self.assertLogs(level='ERROR') as log:
+            result = gmail_sync.sync(label_id='INBOX', start_history_id='12345')
+
+        self.assertEqual([b.request_ids for b in batches], [['msg1', 'msg2', 'msg3']])
+        calls = [c.kwargs for c in messages.get.call_args_list if c.kwargs]
+        self.assertEqual(calls[0], {
+            'userId': 'me', 'id': 'msg1', 'format': 'metadata',
+            'metadataHeaders': ['From', 'Subject'], 'fields': 'id,labelIds,sizeEstimate,payload/headers',
+        })
+        # Full fetches of msg1, and of msg3 whose metadata could not be read
+        self.assertEqual(calls[3:], [{'userId': 'me', 'id': 'msg1'}, {'userId': 'me', 'id': 'msg3'}])
+        self.assertIn('Failed to process message msg3', log.output[0])
+        self.assertEqual((result.messages, result.failed_messages, result.attachments), (1, 1, 1))
+        self.assertEqual(result.stats['counters']['messages.filtered'], 1)
+
+    def test_sync_filters_and_defers_attachments(self):
+        message = fake_message('msg1', 'bank@example.com', 'Statement', [])
+        message['payload']['parts'] = [
+            {'partId': '0', 'filename': 'statement.pdf', 'mimeType': 'application/pdf',
+             'body': {'attachmentId': 'att1', 'size': 9}},
+            {'partId': '1', 'filename': 'logo.png', 'mimeType': 'image/png',
+             'body': {'attachmentId': 'att2', 'size': 100}},
+            {'partId': '2', 'filename': 'archive.pdf', 'mimeType': 'application/pdf',
+             'body': {'attachmentId': 'att3', 'size': 50 * 2 ** 20}},
+        ]
+        self.mock_gmail_client.users().history().list().execute.return_value = {
+            'history': [{'messages': [{'id': 'msg1'}]}], 'historyId': '12346'
+        }
+        messages = self.mock_gmail_client.users().messages()
+        messages.get().execute.return_value = message
+        messages.attachments().get().execute.return_value = {'data': 'c29tZSBkYXRh'}
+        state_store = InMemoryStateManager()
+        storage = InMemoryStorageManager()
+        gmail_sync = GmailSync(
+            state_store=state_store,
+            storage=storage,
+            gmail_client=self.mock_gmail_client,
+            attachment_filter=AttachmentFilter(mime_types=['application/pdf'], max_size=2 ** 20),
+            defer_oversized=True,
+        )
+
+        result = gmail_sync.sync(label_id='INBOX', start_history_id='12345')
+
+        self.assertEqual([c.kwargs['id'] for c in messages.attachments().get.call_args_list
+                          if c.kwargs], ['att1'])
+        self.assertEqual([key.rpartition('_')[2] for key in storage.objects], ['statement.pdf'])
+        self.assertEqual(result.stats['counters']['attachments.filtered'], 1)
+        self.assertEqual(result.stats['counters']['attachments.deferred'], 1)
+        self.assertEqual(state_store.documents['last_sync_state_deferred_message_msg1'], {
+            'messageId': 'msg1',
+            'attachments': [{'partId': '2', 'filename': 'archive.pdf', 'size': 50 * 2 ** 20}],
+        })
+
+        self.assertEqual(gmail_sync.process_deferred(), 1)
+
+        self.assertEqual(sorted(key.rpartition('_')[2] for key in storage.objects),
+                         ['archive.pdf', 'statement.pdf'])
+        self.assertEqual(state_store.get_documents_by_prefix('last_sync_state_deferred_'), {})
+
+    def test_sync_fetches_threads_together(self):
+        self.mock_gmail_client.users().history().list().execute.return_value = {
+            'history': [{'messages': [{'id': 'msg1', 'threadId': 'thread1'},
+                                      {'id': 'msg2', 'threadId': 'thread2'}]},
+                        {'messages': [{'id': 'msg3', 'threadId': 'thread1'},
+                                      {'id': 'msg4', 'threadId': 'thread1'}]}],
+            'historyId': '12346'
+        }
+        threads = self.mock_gmail_client.users().threads()
+        threads.get().execute.return_value = {'id': 'thread1', 'messages': [
+            fake_message('msg0', 'bank@example.com', 'Statement', ['att0'], thread_id='thread1'),
+            fake_message('msg1', 'bank@example.com', 'Statement', ['att1'], thread_id='thread1'),
+            fake_message('msg3', 'bank@example.com', 'Reminder', [], thread_id='thread1'),
+        ]}
+        messages = self.mock_gmail_client.users().messages()
+        messages.get().execute.return_value = fake_message('msg2', 'shop@example.com', 'Receipt', ['att2'])
+        messages.attachments().get().execute.return_value = {'data': 'c29tZSBkYXRh'}
+        storage = InMemoryStorageManager()
+        gmail_sync = GmailSync(state_store=InMemoryStateManager(), storage=storage,
+                               gmail_client=self.mock_gmail_client, fetch_threads=True)
+
+        with self.assertLogs(level='ERROR') as log:
+            result = gmail_sync.sync(label_id='INBOX', start_history_id='12345')
+
+        self.assertEqual([c.kwargs for c in threads.get.call_args_list if c.kwargs],
+                         [{'userId': 'me', 'id': 'thread1'}])
+        self.assertEqual([c.kwargs for c in messages.get.call_args_list if c.kwargs],
+                         [{'userId': 'me', 'id': 'msg2'}])
+        # Only the synced messages of the thread are saved
+        self.assertEqual(sorted(key.rpartition('_')[2] for key in storage.objects),
+                         ['att1.pdf', 'att2.pdf'])
+        self.assertIn('Failed to process message msg4: Message not found in thread thread1',
+                      log.output[0])
+        self.assertEqual((result.messages, result.failed_messages), (3, 1))
+        self.assertEqual(result.stats['counters']['api_calls.threads.get'], 1)
+
+    def test_sync_batched_logs_failed_messages(self):
+        gmail_sync = GmailSync(
+            state_store=self.mock_state_store,
+            storage=self.mock_storage,
+            gmail_client=self.mock_gmail_client,
+            batch_size=10,
+        )
+        self.mock_gmail_client.users().history().list().execute.return_value = {
+            'history': [{'messages': [{'id': 'msg1'}]}],
+            'historyId': '12346'
+        }
+        self._mock_batches({'msg1': Exception('Not Found')})
+
+        with self.assertLogs(level='ERROR') as log:
+            gmail_sync.sync(label_id='INBOX', start_history_id='12345')
+        self.assertIn('Failed to process message msg1: Not Found', log.output[0])
+
+    def test_client_shared_by_workers_needs_its_credentials(self):
+        with self.assertRaises(ValueError):
+            GmailSync(state_store=self.mock_state_store, storage=self.mock_storage,
+                      gmail_client=self.mock_gmail_client, max_workers=2)
+
+    def test_close_shuts_down_attachment_downloads(self):
+        with GmailSync(state_store=self.mock_state_store, storage=self.mock_storage,
+                       gmail_client=self.mock_gmail_client, credentials=Mock(expired=False),
+                       max_workers=2) as gmail_sync:
+            pool = gmail_sync._GmailSync__attachment_pool
+            pipeline = gmail_sync._GmailSync__label_pipeline('Label_1', 'label1')
+        with self.assertRaises(RuntimeError):
+            pool.submit(print)
+        with self.assertRaises(RuntimeError):
+            pipeline._GmailSync__attachment_pool.submit(print)
+
+    def test_invalid_batch_size(self):
+        with self.assertRaises(ValueError):
+            GmailSync(
+                state_store=self.mock_state_store,
+                storage=self.mock_storage,
+                gmail_client=self.mock_gmail_client,
+                batch_size=101,
+            )
+
+    def _sharded_sync(self, state_store):
+        return GmailSync(
+            state_store=state_store,
+            storage=self.mock_storage,
+            gmail_client=self.mock_gmail_client,
+        )
+
+    def test_sync_sharded_instances_split_the_window(self):
+        state_store = InMemoryStateManager({'last_sync_state': {'historyId': '12345'}})
+        self.mock_gmail_client.users().history().list().execute.return_value = {
+            'history': [{'messages': [{'id': f'msg{i}'} for i in range(5)]}],
+            'historyId': '12350'
+        }
+        first, second = self._sharded_sync(state_store), self._sharded_sync(state_store)
+        # Another instance holds the lease of one shard while the first one runs
+        state_store.acquire_lease('last_sync_state_shard_2_lease', 'second', 60)
+
+        processed = []
+        with patch.object(first, 'get_message', side_effect=processed.append), \
+                patch.object(first, '_GmailSync__save_message_attachments'):
+            result = first.sync_sharded(owner='first', shard_size=2)
+        self.assertTrue(result.in_progress)
+        self.assertIsNone(result.history_id)
+        self.assertEqual(sorted(processed), ['msg0', 'msg1', 'msg2', 'msg3'])
+        self.assertEqual(state_store.documents['last_sync_state'], {'historyId': '12345'})
+
+        state_store.release_lease('last_sync_state_shard_2_lease', 'second')
+        with patch.object(second, 'get_message', side_effect=processed.append), \
+                patch.object(second, '_GmailSync__save_message_attachments'):
+            result = second.sync_sharded(owner='second', shard_size=2)
+        self.assertEqual(result.history_id, '12350')
+        self.assertEqual(sorted(processed), ['msg0', 'msg1', 'msg2', 'msg3', 'msg4'])
+        self.assertEqual(state_store.documents['last_sync_state']['historyId'], '12350')
+        # The history was walked once, by the planner
+        self.mock_gmail_client.users().history().list().execute.assert_called_once()
+
+    def test_backfill_scans_date_shards_and_checkpoints_them(self):
+        state_store = InMemoryStateManager()
+        gmail_sync = self._sharded_sync(state_store)
+        self.mock_gmail_client.users().messages().list().execute.side_effect = [
+            {'messages': [{'id': 'msg1'}], 'nextPageToken': 'page2'},
+            {'messages': [{'id': 'msg2'}]},
+            Exception('Rate Limit Exceeded'),
+        ]
+        processed = []
+        with patch.object(gmail_sync, 'get_message', side_effect=processed.append), \
+                patch.object(gmail_sync, '_GmailSync__save_message_attachments'):
+            with self.assertRaises(RuntimeError), self.assertLogs(level='ERROR') as log:
+                gmail_sync.backfill('from:bank', date(2023, 1, 1), date(2023, 3, 1),
+                                    shard_days=31, backfill_id='bank')
+        self.assertIn("Failed to backfill 'from:bank after:2023/02/01 before:2023/03/01'",
+                      log.output[0])
+        self.assertEqual(processed, ['msg1', 'msg2'])
+        self.mock_gmail_client.users().messages().list.assert_any_call(
+            userId='me', q='from:bank after:2023/01/01 before:2023/02/01', maxResults=500,
+            pageToken='page2'
+        )
+        self.assertTrue(state_store.documents['last_sync_state_backfill_bank_20230101_20230201']
+                        ['done'])
+
+        # Running it again only scans the failed shard
+        self.mock_gmail_client.users().messages().list().execute.side_effect = [
+            {'messages': [{'id': 'msg3'}]},
+        ]
+        with patch.object(gmail_sync, 'get_message', side_effect=processed.append), \
+                patch.object(gmail_sync, '_GmailSync__save_message_attachments'):
+            result = gmail_sync.backfill('from:bank', date(2023, 1, 1), date(2023, 3, 1),
+                                         shard_days=31, backfill_id='bank')
+        self.assertEqual(result.stats['counters']['api_calls.messages.list'], 1)
+        self.assertEqual(result.stats['shards'], 2)
+        self.assertEqual(processed, ['msg1', 'msg2', 'msg3'])
+
+    def test_sync_sharded_writes_shards_while_walking(self):
+        state_store = InMemoryStateManager({'last_sync_state': {'historyId': '12345'}})
+        self.mock_gmail_client.users().history().list().execute.side_effect = [
+            {'history': [{'messages': [{'id': f'msg{i}'} for i in range(3)]}],
+             'historyId': '12346', 'nextPageToken': 'p2'},
+            {'history': [{'messages': [{'id': f'msg{i}'} for i in range(3, 5)]}],
+             'historyId': '12347'},
+        ]
+        gmail_sync = self._sharded_sync(state_store)
+        writes = patch.object(state_store, 'set_documents', wraps=state_store.set_documents)
+        with writes as writes, \
+                patch.object(gmail_sync, 'get_message'), \
+                patch.object(gmail_sync, '_GmailSync__save_message_attachments'):
+            gmail_sync.sync_sharded(owner='planner', shard_size=2)
+
+        self.assertEqual([sorted(c.args[0]) for c in writes.call_args_list], [
+            ['last_sync_state_shard_0'], ['last_sync_state_shard_1'], ['last_sync_state_shard_2'],
+        ])
+        self.assertEqual(state_store.documents['last_sync_state_shard_1']['msgIds'],
+                         ['msg2', 'msg3'])
+        self.assertEqual(state_store.documents['last_sync_state_window']['shards'], 3)
+
+    def test_sync_sharded_stops_planning_when_lease_is_lost(self):
+        state_store = InMemoryStateManager({'last_sync_state': {'historyId': '12345'}})
+        self.mock_gmail_client.users().history().list().execute.side_effect = [
+            {'history': [{'messages': [{'id': 'msg1'}]}], 'historyId': '12346', 'nextPageToken': 'p2'},
+            {'history': [{'messages': [{'id': 'msg2'}]}], 'historyId': '12347'},
+        ]
+        with patch.object(state_store, 'acquire_lease', side_effect=[True, False]), \
+                self.assertLogs(level='ERROR') as log:
+            result = self._sharded_sync(state_store).sync_sharded(owner='planner')
+
+        self.assertIsNone(result)
+        self.assertIn('Lost the planner lease', log.output[0])
+        self.assertNotIn('last_sync_state_shard_0', state_store.documents)
+        self.assertNotIn('last_sync_state_window', state_store.documents)
+
+    def test_sync_sharded_stops_processing_a_shard_when_its_lease_is_lost(self):
+        state_store = InMemoryStateManager({'last_sync_state': {'historyId': '12345'}})
+        self.mock_gmail_client.users().history().list().execute.return_value = {
+            'history': [{'messages': [{'id': f'msg{i}'} for i in range(3)]}],
+            'historyId': '12346'
+        }
+        gmail_sync = self._sharded_sync(state_store)
+        processed = []
+
+        def get_message(msg_id):
+            processed.append(msg_id)
+            # The lease expires during the first message and another instance takes it over
+            state_store.set_document_by_id('last_sync_state_shard_0_lease',
+                                           {'owner': 'other', 'expiresAt': time.time() + 60})
+
+        with patch.object(gmail_sync, 'get_message', side_effect=get_message), \
+                patch.object(gmail_sync, '_GmailSync__save_message_attachments'), \
+                self.assertLogs(level='WARNING') as log:
+            result = gmail_sync.sync_sharded(owner='planner', shard_size=3)
+
+        self.assertEqual(processed, ['msg0'])
+        self.assertIn('Lost the lease of last_sync_state_shard_0', log.output[-1])
+        self.assertTrue(result.in_progress)
+        self.assertFalse(state_store.documents['last_sync_state_shard_0']['done'])
+        self.assertEqual(state_store.documents['last_sync_state'], {'historyId': '12345'})
+        # The lease of the other instance is left alone
+        self.assertEqual(state_store.documents['last_sync_state_shard_0_lease']['owner'], 'other')
+
+    def test_sync_sharded_waits_for_planner(self):
+        state_store = InMemoryStateManager({'last_sync_state': {'historyId': '12345'}})
+        state_store.acquire_lease('last_sync_state_planner_lease', 'planner', 60)
+
+        result = self._sharded_sync(state_store).sync_sharded(owner='worker')
+
+        self.assertTrue(result.in_progress)
+        self.assertFalse(result.up_to_date)
+        self.mock_gmail_client.users().history().list().execute.assert_not_called()
+
+    def test_sync_labels_routes_one_history_walk_to_each_label(self):
+        state_store = InMemoryStateManager({
+            'last_sync_state': {'historyId': '12345'},
+            # Already synced the first record
+            'last_sync_state_Label_1': {'historyId': '12346'},
+        })
+        self.mock_gmail_client.users().history().list().execute.return_value = {
+            'history': [
+                {'id': '12346',
+                 'messagesAdded': [{'message': {'id': 'msg1', 'labelIds': ['Label_1']}}]},
+                {'id': '12347',
+                 'messagesAdded': [{'message': {'id': 'msg2', 'labelIds': ['Label_2']}}]},
+                {'id': '12348', 'labelsAdded': [{'message': {'id': 'msg1', 'labelIds': ['Label_1']},
+                                                 'labelIds': ['Label_2']}]},
+                {'id': '12349',
+                 'messagesAdded': [{'message': {'id': 'msg3', 'labelIds': ['INBOX']}}]},
+                {'id': '12350',
+                 'messagesAdded': [{'message': {'id': 'msg4', 'labelIds': ['Label_1']}}]},
+            ],
+            'historyId': '12350'
+        }
+        self.mock_gmail_client.users().messages().get().execute.side_effect = [
+            fake_message('msg2', 'shop@example.com', 'Receipt', ['att2']),
+            fake_message('msg1', 'bank@example.com', 'Statement', ['att1']),
+            fake_message('msg4', 'bank@example.com', 'Statement', ['att4']),
+        ]
+        self.mock_gmail_client.users().messages().attachments().get().execute.return_value = {
+            'data': 'c29tZSBkYXRh'
+        }
+        storage = InMemoryStorageManager()
+        gmail_sync = GmailSync(state_store=state_store, storage=storage,
+                               gmail_client=self.mock_gmail_client, base_path='mail')
+
+        result = gmail_sync.sync_labels({'Label_1': 'statements', 'Label_2': 'receipts/'})
+
+        self.assertEqual((result.history_id, result.messages, result.attachments), ('12350', 3, 3))
+        self.assertEqual(result.stats['counters']['messages.label.Label_1'], 1)
+        self.assertEqual(result.stats['counters']['messages.label.Label_2'], 2)
+        # A single unfiltered walk, starting from the label that is furthest behind
+        history_calls = [c.kwargs
+                         for c in self.mock_gmail_client.users().history().list.call_args_list
+                         if c.kwargs]
+        self.assertEqual(len(history_calls), 1)
+        self.assertEqual(history_calls[0]['startHistoryId'], '12345')
+        self.assertNotIn('labelId', history_calls[0])
+        self.assertEqual(sorted(path.split('/')[1] for path in storage.objects),
+                         ['receipts', 'receipts', 'statements'])
+        self.assertTrue(all(path.startswith('mail/') for path in storage.objects))
+        for label_id in ('Label_1', 'Label_2'):
+            self.assertEqual(state_store.documents[f'last_sync_state_{label_id}']['historyId'],
+                             '12350')
+        self.assertEqual(state_store.documents['last_sync_state_labels']['historyId'], '12350')
+        self.assertEqual(state_store.documents['last_sync_state']['historyId'], '12345')
+
+        # Nothing new for any label
+        self.mock_gmail_client.users().history().list().execute.return_value = {
+            'historyId': '12350'
+        }
+        result = gmail_sync.sync_labels({'Label_1': 'statements', 'Label_2': 'receipts'})
+        self.assertTrue(result.up_to_date)
+
+    def test_sync_labels_deduplicates_each_label_apart(self):
+        state_store = InMemoryStateManager({'last_sync_state': {'historyId': '12345'}})
+        self.mock_gmail_client.users().history().list().execute.return_value = {
+            'history': [{'id': '12346', 'messagesAdded': [
+                {'message': {'id': 'msg1', 'labelIds': ['Label_1', 'Label_2']}},
+            ]}],
+            'historyId': '12346'
+        }
+        self.mock_gmail_client.users().messages().get().execute.return_value = \
+            fake_message('msg1', 'bank@example.com', 'Statement', ['att1'])
+        self.mock_gmail_client.users().messages().attachments().get().execute.return_value = {
+            'data': 'c29tZSBkYXRh'
+        }
+        storage = InMemoryStorageManager()
+        gmail_sync = GmailSync(state_store=state_store, storage=storage,
+                               gmail_client=self.mock_gmail_client, deduplicate=True)
+
+        gmail_sync.sync_labels({'Label_1': 'statements', 'Label_2': 'archive'})
+
+        self.assertEqual(sorted(path.split('/')[0] for path in storage.objects),
+                         ['archive', 'statements'])
+        self.assertEqual(len([doc_id for doc_id in state_store.documents
+                              if doc_id.startswith('attachment_sha256_')]), 2)
+
+    def test_sync_labels_requires_labels(self):
+        with self.assertRaises(ValueError):
+            self.gmail_sync.sync_labels({})
+
 
 # Running the test
 if __name__ == "__main__":
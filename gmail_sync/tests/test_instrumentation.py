@@ -0,0 +1,65 @@
+import json
+import unittest
+from unittest.mock import Mock
+
+from instrumentation import Exporter, Histogram, Instrumentation, LoggingExporter
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_observe(self):
+        histogram = Histogram(buckets=[0.1, 1.0])
+        for value in [0.05, 0.2, 0.5, 3.0]:
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [1, 2, 1])
+        self.assertEqual(histogram.snapshot(), {
+            'count': 4, 'sum': 3.75, 'min': 0.05, 'max': 3.0, 'p50': 1.0, 'p95': 3.0,
+        })
+
+    def test_empty(self):
+        self.assertEqual(Histogram().snapshot()['p50'], None)
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def test_spans_and_counters(self):
+        instrumentation = Instrumentation(exporters=[])
+        with instrumentation.span('messages.get'):
+            instrumentation.count('api_calls.messages.get')
+        with self.assertRaises(ValueError):
+            with instrumentation.span('messages.get'):
+                raise ValueError()
+        self.assertEqual(b''.join(instrumentation.timed_chunks('decode', [b'ab', b'c'])), b'abc')
+
+        stats = instrumentation.snapshot()
+        self.assertEqual(stats['counters'], {'api_calls.messages.get': 1, 'decode.bytes': 3})
+        self.assertEqual(stats['spans']['messages.get']['count'], 2)
+        self.assertEqual(stats['spans']['decode']['count'], 1)
+
+        instrumentation.reset()
+        self.assertEqual(instrumentation.snapshot(), {'counters': {}, 'spans': {}})
+
+    def test_export(self):
+        failing = Mock(spec=Exporter)
+        failing.export.side_effect = RuntimeError('unavailable')
+        exporter = Mock(spec=Exporter)
+        instrumentation = Instrumentation(exporters=[failing])
+        instrumentation.add_exporter(exporter)
+        instrumentation.count('messages.processed', 3)
+
+        with self.assertLogs('instrumentation', level='WARNING'):
+            stats = instrumentation.export(historyId='101')
+
+        self.assertEqual(stats, {'historyId': '101', 'counters': {'messages.processed': 3}, 'spans': {}})
+        exporter.export.assert_called_once_with(stats)
+
+    def test_logging_exporter_logs_json(self):
+        with self.assertLogs('instrumentation', level='INFO') as log:
+            LoggingExporter().export({'counters': {'messages.processed': 1}})
+        self.assertEqual(json.loads(log.records[0].getMessage()),
+                         {'event': 'gmail_sync_stats', 'counters': {'messages.processed': 1}})
+
+
+if __name__ == "__main__":
+    unittest.main()
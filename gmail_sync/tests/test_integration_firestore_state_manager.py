@@ -56,6 +56,26 @@ class FirestoreStateStoreIntegrationTest(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             _ = self.firestore_state_store.get_document_by_id(non_existent_id)
 
+    def test_get_documents_by_ids(self):
+        test_data = SyncState(historyId="12345", updatedTime=1616885415)
+        self.firestore_state_store.set_document_by_id("test_batch_1", vars(test_data))
+
+        fetched = self.firestore_state_store.get_documents_by_ids(["test_batch_1", "test_batch_missing"])
+        self.assertDictEqual(fetched, {"test_batch_1": vars(test_data), "test_batch_missing": None})
+
+    def test_get_documents_by_prefix_and_delete(self):
+        self.firestore_state_store.set_documents({
+            "test_prefix_b": {"n": 2}, "test_prefix_a": {"n": 1}, "test_prefixed": {"n": 3},
+        })
+
+        fetched = self.firestore_state_store.get_documents_by_prefix("test_prefix_")
+        self.assertEqual(list(fetched.items()),
+                         [("test_prefix_a", {"n": 1}), ("test_prefix_b", {"n": 2})])
+
+        self.firestore_state_store.delete_document_by_id("test_prefix_a")
+        self.assertEqual(list(self.firestore_state_store.get_documents_by_prefix("test_prefix_")),
+                         ["test_prefix_b"])
+
     def test_special_characters_in_id(self):
         special_char_id = "test_id_!@#$%^&*()"
         test_data = SyncState(historyId="12345", updatedTime=1616885415)
@@ -0,0 +1,69 @@
+import unittest
+from unittest.mock import Mock
+
+from ledger import ProcessedLedger
+from state_manager import StateManager
+
+
+class ProcessedLedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_state_store = Mock(spec=StateManager)
+        self.ledger = ProcessedLedger(self.mock_state_store)
+
+    def test_unknown_message_is_not_processed(self):
+        self.mock_state_store.get_document_by_id.side_effect = RuntimeError('Not found')
+        self.assertFalse(self.ledger.is_processed('msg1'))
+        self.mock_state_store.get_document_by_id.assert_called_once_with('processed_msg1')
+        self.assertEqual(self.ledger.saved_attachments('msg1'), set())
+
+    def test_completed_message_is_remembered(self):
+        self.mock_state_store.get_document_by_id.return_value = {'completed': True}
+        self.assertTrue(self.ledger.is_processed('msg1'))
+        self.assertTrue(self.ledger.is_processed('msg1'))
+        # The second lookup is answered from memory
+        self.mock_state_store.get_document_by_id.assert_called_once()
+
+    def test_partially_processed_message(self):
+        self.mock_state_store.get_document_by_id.return_value = {
+            'completed': False, 'attachments': ['1']
+        }
+        self.assertFalse(self.ledger.is_processed('msg1'))
+        self.assertEqual(self.ledger.saved_attachments('msg1'), {'1'})
+
+        self.ledger.mark_attachment_saved('msg1', '2')
+        data = self.mock_state_store.set_document_by_id.call_args.kwargs['data']
+        self.assertEqual((data['completed'], data['attachments']), (False, ['1', '2']))
+
+        self.ledger.mark_processed('msg1')
+        data = self.mock_state_store.set_document_by_id.call_args.kwargs['data']
+        self.assertTrue(data['completed'])
+        self.assertTrue(self.ledger.is_processed('msg1'))
+        self.mock_state_store.get_document_by_id.assert_called_once()
+
+    def test_scoped_ledger_is_separate(self):
+        self.mock_state_store.get_document_by_id.return_value = {'completed': True}
+        self.assertTrue(self.ledger.is_processed('msg1'))
+
+        scoped = self.ledger.scoped('Label_1')
+        self.mock_state_store.get_document_by_id.return_value = None
+        self.assertFalse(scoped.is_processed('msg1'))
+        self.mock_state_store.get_document_by_id.assert_called_with('processed_Label_1_msg1')
+
+    def test_prefetch_reads_entries_in_one_call(self):
+        self.mock_state_store.get_documents_by_ids.return_value = {
+            'processed_msg1': {'completed': True},
+            'processed_msg2': {'completed': False, 'attachments': ['1']},
+            'processed_msg3': None,
+        }
+        self.ledger.prefetch(['msg1', 'msg2', 'msg3'])
+
+        self.assertTrue(self.ledger.is_processed('msg1'))
+        self.assertFalse(self.ledger.is_processed('msg2'))
+        self.assertFalse(self.ledger.is_processed('msg3'))
+        self.assertEqual(self.ledger.saved_attachments('msg2'), {'1'})
+        self.mock_state_store.get_document_by_id.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+from storage_manager import LocalFileStorageManager, PutItem
+
+
+class LocalFileStorageManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.storage = LocalFileStorageManager(self.root.name)
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def test_put_and_get(self):
+        self.storage.put('/statements/a.pdf', b'0123456789', metadata={'from': 'bank'})
+        self.assertEqual(self.storage.get('statements/a.pdf'), b'0123456789')
+        info = self.storage.stat('statements/a.pdf')
+        self.assertEqual((info.size, info.metadata), (10, {'from': 'bank'}))
+
+    def test_stream_and_ranges(self):
+        self.storage.put_stream('a.pdf', [b'0123', b'456', b'789'])
+        self.assertEqual(list(self.storage.get_stream('a.pdf', chunk_size=4)),
+                         [b'0123', b'4567', b'89'])
+        self.assertEqual(self.storage.get_range('a.pdf', 2, 5), b'234')
+        self.assertEqual(self.storage.get_range('a.pdf', 8), b'89')
+
+    def test_download_and_map(self):
+        self.storage.put('a.pdf', b'0123456789')
+        path = os.path.join(self.root.name, 'copy.pdf')
+        self.storage.download_to_file('a.pdf', path)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789')
+        with self.storage.get_mapped('a.pdf') as mapped:
+            self.assertEqual(mapped[3:6], b'345')
+
+    def test_put_many_collects_failures(self):
+        failures = self.storage.put_many([
+            PutItem(key='a.pdf', data=b'a'),
+            PutItem(key='../outside.pdf', data=b'b'),
+        ])
+        self.assertEqual(list(failures), ['../outside.pdf'])
+        self.assertEqual(self.storage.get('a.pdf'), b'a')
+
+    def test_missing_key(self):
+        with self.assertRaisesRegex(RuntimeError, 'No data found'):
+            self.storage.get('missing.pdf')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,283 @@
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+import main
+
+
+def push_request(history_id=None):
+    request = Mock()
+    request.get_json.return_value = None
+    if history_id:
+        data = json.dumps({'emailAddress': 'me@example.com', 'historyId': history_id})
+        request.get_json.return_value = {
+            'message': {'data': base64.b64encode(data.encode()).decode()}
+        }
+    return request
+
+
+@patch('google.cloud.error_reporting.Client')
+@patch('storage_manager.GoogleCloudStorageManager')
+@patch('state_manager.FirestoreStateManager')
+@patch('gmail_sync.GmailSync')
+class DownloadAttachmentsHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        main._clients.clear()
+
+    def tearDown(self):
+        main._clients.clear()
+
+    def test_clients_are_reused_across_requests(self, mock_gmail_sync, mock_state_manager,
+                                                mock_storage_manager, mock_error_reporting):
+        mock_gmail_sync.return_value.sync.return_value = 'Data is already up-to-date'
+
+        for _ in range(3):
+            result = main.download_attachments_handler(push_request())
+
+        self.assertEqual(result, 'Data is already up-to-date')
+        self.assertEqual(mock_gmail_sync.return_value.sync.call_count, 3)
+        mock_gmail_sync.assert_called_once()
+        mock_state_manager.assert_called_once()
+        mock_storage_manager.assert_called_once()
+        # Errors are only reported from the failure path
+        mock_error_reporting.assert_not_called()
+
+    def test_gmail_sync_is_rebuilt_after_failure(self, mock_gmail_sync, mock_state_manager,
+                                                 mock_storage_manager, mock_error_reporting):
+        mock_gmail_sync.return_value.sync.side_effect = [Exception('Invalid grant'), 'OK']
+
+        main.download_attachments_handler(push_request())
+        main.download_attachments_handler(push_request())
+
+        mock_error_reporting.return_value.report_exception.assert_called_once()
+        self.assertEqual(mock_gmail_sync.call_count, 2)
+        mock_state_manager.assert_called_once()
+        # The GmailSync dropped releases its download threads
+        mock_gmail_sync.return_value.close.assert_called_once()
+
+    def test_concurrent_requests_sync_one_at_a_time(self, mock_gmail_sync, mock_state_manager,
+                                                    mock_storage_manager, mock_error_reporting):
+        mock_state_manager.return_value.get_document_by_id.return_value = {'historyId': '100'}
+        lock = threading.Lock()
+        running, peak = [0], [0]
+
+        def sync(**kwargs):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return 'OK'
+        mock_gmail_sync.return_value.sync.side_effect = sync
+
+        requests = [push_request(), push_request(110), push_request(), push_request(120)]
+        threads = [threading.Thread(target=main.download_attachments_handler, args=(request,))
+                   for request in requests]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(peak[0], 1)
+        self.assertGreaterEqual(mock_gmail_sync.return_value.sync.call_count, 2)
+        mock_error_reporting.assert_not_called()
+
+    def test_notifications_of_synced_history_return_early(self, mock_gmail_sync,
+                                                          mock_state_manager,
+                                                          mock_storage_manager,
+                                                          mock_error_reporting):
+        mock_state_store = mock_state_manager.return_value
+        mock_state_store.get_document_by_id.return_value = {'historyId': '100'}
+        mock_gmail_sync.return_value.sync.return_value = '{ "history_id": "120"}'
+
+        results = [main.download_attachments_handler(push_request(history_id))
+                   for history_id in [90, 110, 105, 110]]
+
+        # 90 is older than the stored state, 105 and 110 are covered by the sync for 110
+        self.assertEqual(results, [
+            'History 90 is already synced',
+            '{ "history_id": "120"}',
+            'History 105 is already synced',
+            'History 110 is already synced',
+        ])
+        mock_gmail_sync.return_value.sync.assert_called_once()
+        self.assertEqual(mock_state_store.get_document_by_id.call_count, 2)
+
+
+@patch('google.cloud.error_reporting.Client')
+@patch('storage_manager.GoogleCloudStorageManager')
+@patch('state_manager.FirestoreStateManager')
+@patch('gmail_sync.GmailSync')
+class BackfillHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        main._clients.clear()
+
+    def tearDown(self):
+        main._clients.clear()
+
+    def test_backfill_dates(self, mock_gmail_sync, mock_state_manager, mock_storage_manager,
+                            mock_error_reporting):
+        from datetime import date
+        from models import SyncResult
+
+        mock_gmail_sync.return_value.backfill.return_value = SyncResult(history_id=None, messages=3)
+        request = Mock()
+        request.get_json.return_value = {'query': 'from:bank', 'after': '2023-01-01',
+                                         'before': '2023-03-01'}
+
+        result = main.backfill_handler(request)
+
+        self.assertEqual(json.loads(result)['messages'], 3)
+        mock_gmail_sync.return_value.backfill.assert_called_once_with(
+            query='from:bank', start_date=date(2023, 1, 1), end_date=date(2023, 3, 1),
+            shard_days=30,
+        )
+        mock_error_reporting.assert_not_called()
+
+    def test_invalid_requests_are_answered(self, mock_gmail_sync, mock_state_manager,
+                                           mock_storage_manager, mock_error_reporting):
+        request = Mock()
+        for body, message in [
+            ({'after': '2023-01-01'}, 'Query not found'),
+            ({'query': 'from:bank'}, 'Start date `after` not found'),
+            ({'query': 'from:bank', 'after': '01/01/2023'}, 'Invalid date'),
+            ({'query': 'from:bank', 'after': '2023-01-01', 'before': 20230301}, 'Invalid date'),
+        ]:
+            request.get_json.return_value = body
+            self.assertIn(message, main.backfill_handler(request))
+
+        mock_gmail_sync.return_value.backfill.assert_not_called()
+        mock_error_reporting.assert_not_called()
+
+
+@patch('google.cloud.error_reporting.Client')
+@patch('storage_manager.GoogleCloudStorageManager')
+@patch('state_manager.FirestoreStateManager')
+@patch('gmail_sync.GmailSync')
+class SyncAccountsHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        main._clients.clear()
+
+    def tearDown(self):
+        main._clients.clear()
+
+    def test_notification_syncs_its_account_only(self, mock_gmail_sync, mock_state_manager,
+                                                 mock_storage_manager, mock_error_reporting):
+        from models import SyncResult
+
+        documents = {
+            'gmail_accounts': {'accounts': [
+                {'id': 'household', 'emailAddress': 'home@example.com'},
+                {'id': 'finance', 'emailAddress': 'me@example.com', 'basePath': 'team'},
+            ]},
+            'last_sync_state_finance': {'historyId': '100'},
+        }
+        mock_state_manager.return_value.get_documents_by_ids.side_effect = \
+            lambda ids: {id: documents.get(id) for id in ids}
+        mock_gmail_sync.return_value.sync.return_value = SyncResult(history_id='120')
+
+        result = main.sync_accounts_handler(push_request(110))
+
+        self.assertEqual(json.loads(result)['finance']['history_id'], '120')
+        self.assertNotIn('household', json.loads(result))
+        # The sync for 110 covered the notification
+        self.assertEqual(json.loads(main.sync_accounts_handler(push_request(110))),
+                         {'finance': {'already_synced': True}})
+        mock_gmail_sync.return_value.sync.assert_called_once()
+        kwargs = mock_gmail_sync.call_args.kwargs
+        self.assertEqual((kwargs['credentials_doc_id'], kwargs['sync_state_doc_id'], kwargs['base_path']),
+                         ('google_credentials_finance', 'last_sync_state_finance', 'team'))
+        mock_error_reporting.assert_not_called()
+
+
+@patch('google.cloud.error_reporting.Client')
+@patch('storage_manager.GoogleCloudStorageManager')
+@patch('state_manager.FirestoreStateManager')
+class AccountCredentialsTest(unittest.TestCase):
+
+    def setUp(self):
+        main._clients.clear()
+        self.documents = {
+            'gmail_accounts': {'accounts': [{'id': 'a'}, {'id': 'b', 'labelId': 'Label_1'}]},
+            'google_credentials_a': {'token': 'TOKEN_A'},
+            'google_credentials_b': {'token': 'TOKEN_B'},
+        }
+        self.temp_dir = tempfile.TemporaryDirectory()
+        patcher = patch('tempfile.gettempdir', return_value=self.temp_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        main._clients.clear()
+        self.temp_dir.cleanup()
+
+    def _mock_state_store(self, mock_state_manager):
+        state_store = mock_state_manager.return_value
+        state_store.get_document_by_id.side_effect = lambda id: self.documents[id]
+        state_store.get_documents_by_ids.side_effect = lambda ids: {id: self.documents.get(id) for id in ids}
+        return state_store
+
+    @patch('gmail_sync.build')
+    @patch('gmail_sync.Credentials')
+    def test_accounts_use_their_own_credentials(self, mock_credentials, mock_build, mock_state_manager,
+                                                mock_storage_manager, mock_error_reporting):
+        self._mock_state_store(mock_state_manager)
+
+        def credentials(info):
+            return Mock(valid=True, expired=False, token=info['token'],
+                        **{'to_json.return_value': json.dumps(info)})
+
+        def cached_credentials(path):
+            with open(path) as f:
+                return credentials(json.load(f))
+        mock_credentials.from_authorized_user_info.side_effect = credentials
+        mock_credentials.from_authorized_user_file.side_effect = cached_credentials
+
+        create_sync = main.get_multi_account_sync()._MultiAccountSync__create_sync
+        registry = main.get_multi_account_sync().registry
+        for account_id in ['a', 'b', 'a', 'b']:
+            create_sync(registry.get(account_id))
+
+        tokens = [c.kwargs['credentials'].token for c in mock_build.call_args_list]
+        self.assertEqual(tokens, ['TOKEN_A', 'TOKEN_B', 'TOKEN_A', 'TOKEN_B'])
+        self.assertEqual(sorted(os.listdir(self.temp_dir.name)), ['token_a.json', 'token_b.json'])
+
+    @patch('google_auth_oauthlib.flow.Flow')
+    def test_callback_stores_credentials_of_account(self, mock_flow, mock_state_manager,
+                                                    mock_storage_manager, mock_error_reporting):
+        state_store = self._mock_state_store(mock_state_manager)
+        mock_flow.from_client_secrets_file.return_value.credentials.to_json.return_value = '{"token": "NEW"}'
+        request = Mock(args={'code': 'code', 'state': 'account:b'})
+
+        main.callback_handler(request)
+
+        state_store.set_document_by_id.assert_called_once_with('google_credentials_b', {'token': 'NEW'})
+        mock_error_reporting.assert_not_called()
+
+    @patch('googleapiclient.discovery.build')
+    @patch('google.oauth2.credentials.Credentials')
+    def test_renew_watch_of_account(self, mock_credentials, mock_build, mock_state_manager,
+                                    mock_storage_manager, mock_error_reporting):
+        self._mock_state_store(mock_state_manager)
+
+        main.renew_watch_handler(Mock(args={'account': 'b'}))
+
+        mock_credentials.from_authorized_user_info.assert_called_once_with({'token': 'TOKEN_B'})
+        body = mock_build.return_value.users.return_value.watch.call_args.kwargs['body']
+        self.assertEqual(body['labelIds'], ['Label_1'])
+
+        main.renew_watch_handler(Mock(args={'account': 'unknown'}))
+        mock_error_reporting.return_value.report_exception.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import base64
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+from notifications import GmailNotification, NotificationCoalescer, parse_notification
+
+
+class ParseNotificationTest(unittest.TestCase):
+
+    def test_parse_notification(self):
+        data = base64.b64encode(b'{"emailAddress": "me@example.com", "historyId": 9876}')
+        notification = parse_notification({'message': {'data': data.decode()}})
+        self.assertEqual(notification, GmailNotification('me@example.com', 9876))
+
+    def test_parse_request_without_notification(self):
+        self.assertIsNone(parse_notification(None))
+        self.assertIsNone(parse_notification({'message': {'data': 'bm90IGpzb24='}}))
+
+
+class NotificationCoalescerTest(unittest.TestCase):
+
+    def test_skips_history_of_stored_state(self):
+        coalescer = NotificationCoalescer()
+        sync = Mock()
+        self.assertIsNone(coalescer.run(100, sync, lambda: '100'))
+        sync.assert_not_called()
+        self.assertTrue(coalescer.is_synced(100))
+
+    def test_failed_sync_is_not_coalesced(self):
+        coalescer = NotificationCoalescer()
+        with self.assertRaises(RuntimeError):
+            coalescer.run(101, Mock(side_effect=RuntimeError('Failed')), lambda: 100)
+        self.assertFalse(coalescer.is_synced(101))
+
+    def test_burst_triggers_one_sync(self):
+        coalescer = NotificationCoalescer(debounce_seconds=0.2)
+        sync = Mock(return_value='synced')
+        results = {}
+
+        def notify(history_id):
+            results[history_id] = coalescer.run(history_id, sync, lambda: 100)
+
+        threads = []
+        for history_id in range(101, 131):
+            threads.append(threading.Thread(target=notify, args=(history_id,)))
+            threads[-1].start()
+            time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+
+        sync.assert_called_once()
+        self.assertEqual(list(results.values()).count('synced'), 1)
+        self.assertTrue(coalescer.is_synced(130))
+
+
+if __name__ == "__main__":
+    unittest.main()
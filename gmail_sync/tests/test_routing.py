@@ -0,0 +1,155 @@
+import json
+import threading
+import unittest
+from unittest.mock import Mock
+
+from routing import (DEFAULT_RULES, AttachmentFilter, CompiledRules, Router, RoutingSource,
+                     StateManagerRoutingSource, StorageRoutingSource)
+from state_manager import InMemoryStateManager
+from storage_manager import ObjectInfo, StorageManager
+
+
+class CompiledRulesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rules = CompiledRules(DEFAULT_RULES + [
+            {'from': 'alerts@bank.com', 'subject': r'Statement (?P<month>\d\d)/(?P<year>\d{4})',
+             'path': 'bank/statement/{year}-{month}/{filename}'},
+            {'from': '*@bank.com', 'subject': r'(?P<kind>Receipt|Notice)',
+             'path': 'bank/{kind}/{filename}'},
+            {'subject': r'[Ii]nvoice #(?P<number>\d+)', 'path': 'invoices/{domain}/{number}_{filename}'},
+        ])
+
+    def test_default_rules(self):
+        self.assertEqual(
+            self.rules.route('Statement@CentralThe1Card.com', 'E-Statement (05/10/2023)', 'a.pdf'),
+            'centralthe1card/statement_date=2023-10-05/a.pdf'
+        )
+        self.assertIsNone(self.rules.route('statement@centralthe1card.com', 'No date', 'a.pdf'))
+
+    def test_exact_address_before_domain_before_any_sender(self):
+        self.assertEqual(self.rules.route('alerts@bank.com', 'Statement 09/2023 Notice', 'a.pdf'),
+                         'bank/statement/2023-09/a.pdf')
+        self.assertEqual(self.rules.route('alerts@bank.com', 'Notice of change', 'a.pdf'),
+                         'bank/Notice/a.pdf')
+        self.assertEqual(self.rules.route('other@bank.com', 'Invoice #12 and Receipt', 'a.pdf'),
+                         'bank/Receipt/a.pdf')
+        self.assertEqual(self.rules.route('shop@store.com', 'Your invoice #12', 'a.pdf'),
+                         'invoices/store.com/12_a.pdf')
+        self.assertIsNone(self.rules.route('shop@store.com', 'Hello', 'a.pdf'))
+
+    def test_matches(self):
+        self.assertTrue(self.rules.matches('Alerts@Bank.com', 'Receipt'))
+        self.assertTrue(self.rules.matches('shop@store.com', 'Invoice #7'))
+        self.assertFalse(self.rules.matches('shop@store.com', 'Hello'))
+        self.assertFalse(self.rules.matches('someone@example.com', None))
+
+    def test_inline_flags_apply_to_their_rule(self):
+        rules = CompiledRules([
+            {'from': 'a@b.com', 'subject': r'(?i)(?s)statement (?P<month>\d\d)',
+             'path': 'statements/{month}/{filename}'},
+            {'from': 'a@b.com', 'subject': r'Receipt', 'path': 'receipts/{filename}'},
+        ])
+        self.assertEqual(rules.route('a@b.com', 'STATEMENT 09', 'a.pdf'), 'statements/09/a.pdf')
+        self.assertIsNone(rules.route('a@b.com', 'RECEIPT', 'a.pdf'))
+
+    def test_dot_of_a_rule_does_not_match_line_breaks(self):
+        rules = CompiledRules([{'subject': r'Statement.(?P<month>\d\d)',
+                                'path': 'statements/{month}/{filename}'}])
+        self.assertIsNone(rules.route('a@b.com', 'Statement\n09', 'a.pdf'))
+        # A match is still found past a line break
+        self.assertEqual(rules.route('a@b.com', 'Fwd:\nStatement 09', 'a.pdf'),
+                         'statements/09/a.pdf')
+
+    def test_unmatched_optional_groups_are_empty(self):
+        rules = CompiledRules([{'subject': r'Invoice(?: #(?P<no>\d+))?', 'path': 'invoices/{no}{filename}'}])
+        self.assertEqual(rules.route('a@b.com', 'Invoice #12', 'a.pdf'), 'invoices/12a.pdf')
+        self.assertEqual(rules.route('a@b.com', 'Invoice', 'a.pdf'), 'invoices/a.pdf')
+
+    def test_invalid_rules(self):
+        with self.assertRaises(ValueError):
+            CompiledRules([{'from': 'a@b.com', 'subject': '(unclosed', 'path': '{filename}'}])
+        with self.assertRaises(ValueError):
+            CompiledRules([{'from': 'a@b.com', 'subject': 'x', 'path': '{year}/{filename}'}])
+        with self.assertRaises(ValueError):
+            CompiledRules([{'from': 'a@b.com', 'path': '{filename}', 'mimeTypes': 'application/pdf'}])
+        with self.assertRaises(ValueError):
+            CompiledRules([{'from': 'a@b.com', 'path': '{filename}', 'maxSize': '10MB'}])
+
+    def test_attachment_filters(self):
+        rules = CompiledRules([
+            {'from': '*@bank.com', 'path': 'bank/{filename}', 'mimeTypes': ['application/pdf'],
+             'filenames': ['statement_*'], 'maxSize': 1000},
+            {'from': '*@store.com', 'path': 'store/{filename}'},
+        ])
+        attachment_filter = rules.attachment_filter('alerts@bank.com', 'Hello')
+        self.assertTrue(attachment_filter.accepts('Statement_2023.PDF', 'application/pdf', 1000))
+        self.assertFalse(attachment_filter.accepts('logo.png', 'image/png', 100))
+        self.assertFalse(attachment_filter.accepts('statement_2023.pdf', 'application/pdf', 1001))
+        self.assertTrue(attachment_filter.is_oversized(1001))
+        self.assertIsNone(rules.attachment_filter('shop@store.com', 'Hello'))
+        self.assertIsNone(rules.attachment_filter('someone@example.com', 'Hello'))
+
+        images = AttachmentFilter(mime_types=['image/*'], min_size=100)
+        self.assertTrue(images.accepts('photo.jpg', 'image/jpeg', 100))
+        self.assertFalse(images.accepts('pixel.gif', 'image/gif', 43))
+
+
+class RouterTest(unittest.TestCase):
+
+    def test_recompiles_only_when_version_changes(self):
+        state_store = InMemoryStateManager({'routing_rules': {'version': 1, 'rules': [
+            {'from': 'a@b.com', 'path': 'v1/{filename}'},
+        ]}})
+        router = Router(StateManagerRoutingSource(state_store), refresh_seconds=0)
+        self.assertEqual(router.route('a@b.com', '', 'a.pdf'), 'v1/a.pdf')
+
+        state_store.documents['routing_rules']['rules'][0]['path'] = 'unversioned/{filename}'
+        self.assertEqual(router.route('a@b.com', '', 'a.pdf'), 'v1/a.pdf')
+
+        state_store.documents['routing_rules'] = {'version': 2, 'rules': [
+            {'from': 'a@b.com', 'path': 'v2/{filename}'},
+        ]}
+        self.assertEqual(router.route('a@b.com', '', 'a.pdf'), 'v2/a.pdf')
+        self.assertEqual(router.version, '2')
+
+    def test_keeps_rules_when_config_is_invalid(self):
+        storage = Mock(spec=StorageManager)
+        storage.stat.return_value = ObjectInfo(key='routing.json', size=0, version='7')
+        storage.get.return_value = json.dumps(
+            {'rules': [{'from': 'a@b.com', 'path': '{year}'}]}
+        ).encode()
+        router = Router(StorageRoutingSource(storage, 'routing.json'), refresh_seconds=3600)
+
+        with self.assertLogs(level='ERROR'):
+            path = router.route('statement@firstchoicecard.com', '(01/02/2024)', 'a.pdf')
+        self.assertEqual(path, 'firstchoicecard/statement_date=2024-02-01/a.pdf')
+        # Not checked again before refresh_seconds
+        router.route('a@b.com', '', 'a.pdf')
+        storage.stat.assert_called_once_with('routing.json')
+
+    def test_routes_with_current_rules_while_fetching(self):
+        fetching, release = threading.Event(), threading.Event()
+        source = Mock(spec=RoutingSource)
+
+        def fetch(version):
+            fetching.set()
+            release.wait(5)
+            return {'version': 2, 'rules': [{'from': 'a@b.com', 'path': 'v2/{filename}'}]}
+        source.fetch.side_effect = fetch
+        router = Router(source, refresh_seconds=3600)
+
+        refresh = threading.Thread(target=router.refresh)
+        refresh.start()
+        self.assertTrue(fetching.wait(5))
+        # Not checked again while the fetch is running, and not blocked by it
+        self.assertIsNone(router.route('a@b.com', '', 'a.pdf'))
+        release.set()
+        refresh.join()
+
+        self.assertEqual(router.route('a@b.com', '', 'a.pdf'), 'v2/a.pdf')
+        source.fetch.assert_called_once_with(None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+import threading
+import unittest
+from unittest.mock import Mock, patch
+
+from googleapiclient.errors import HttpError
+
+from instrumentation import Instrumentation
+from scheduler import QuotaScheduler, is_retryable, is_throttled
+
+
+def http_error(status, content=b''):
+    return HttpError(Mock(status=status), content)
+
+
+class ErrorClassificationTest(unittest.TestCase):
+
+    def test_is_throttled(self):
+        self.assertTrue(is_throttled(http_error(429)))
+        self.assertTrue(is_throttled(http_error(503)))
+        self.assertTrue(is_throttled(http_error(403, b'{"reason": "userRateLimitExceeded"}')))
+        self.assertFalse(is_throttled(http_error(403, b'{"reason": "insufficientPermissions"}')))
+        self.assertFalse(is_throttled(http_error(404)))
+        self.assertFalse(is_throttled(ValueError()))
+
+    def test_is_retryable(self):
+        self.assertTrue(is_retryable(ConnectionResetError()))
+        self.assertTrue(is_retryable(TimeoutError()))
+        self.assertFalse(is_retryable(None))
+
+
+@patch('scheduler.time.sleep')
+class QuotaSchedulerTest(unittest.TestCase):
+
+    def test_retries_throttled_calls_with_backoff(self, mock_sleep):
+        instrumentation = Instrumentation(exporters=[])
+        scheduler = QuotaScheduler(max_concurrency=8, base_delay=1, instrumentation=instrumentation)
+        call = Mock(side_effect=[http_error(429), http_error(503), 'response'])
+
+        with patch('scheduler.random.uniform', side_effect=lambda low, high: high):
+            self.assertEqual(scheduler.execute(call, units=5), 'response')
+
+        self.assertEqual([c.args[0] for c in mock_sleep.call_args_list], [1, 2])
+        self.assertEqual(instrumentation.counter('api_calls.retries'), 2)
+        self.assertEqual(instrumentation.counter('api_calls.throttled'), 2)
+        # Halved twice, then grown back by one success
+        self.assertEqual(scheduler.concurrency, 2)
+
+    def test_raises_after_max_retries(self, mock_sleep):
+        scheduler = QuotaScheduler(max_retries=2)
+        call = Mock(side_effect=http_error(429))
+
+        with self.assertRaises(HttpError):
+            scheduler.execute(call, units=5)
+        self.assertEqual(call.call_count, 3)
+
+    def test_does_not_retry_other_errors(self, mock_sleep):
+        call = Mock(side_effect=http_error(404))
+
+        with self.assertRaises(HttpError):
+            QuotaScheduler().execute(call, units=5)
+        call.assert_called_once()
+        mock_sleep.assert_not_called()
+
+    def test_concurrency_grows_back_after_throttling(self, mock_sleep):
+        scheduler = QuotaScheduler(max_concurrency=4, min_concurrency=2)
+        for _ in range(3):
+            scheduler.on_throttled()
+        self.assertEqual(scheduler.concurrency, 2)
+
+        # About one more call in flight per limit's worth of successes
+        for _ in range(6):
+            scheduler.on_success()
+        self.assertEqual(scheduler.concurrency, 4)
+
+    @patch('scheduler.time.monotonic')
+    def test_paces_calls_to_the_quota(self, mock_monotonic, mock_sleep):
+        now = [100.0]
+        mock_monotonic.side_effect = lambda: now[0]
+        mock_sleep.side_effect = lambda seconds: now.__setitem__(0, now[0] + seconds)
+        scheduler = QuotaScheduler(units_per_second=10, burst_units=10)
+
+        for _ in range(6):
+            scheduler.execute(Mock(), units=5)
+
+        # The burst covers two calls, then each call waits for its 5 units
+        self.assertEqual(now[0], 102.0)
+
+    @patch('scheduler.time.monotonic')
+    def test_charges_calls_larger_than_the_bucket_in_full(self, mock_monotonic, mock_sleep):
+        now = [100.0]
+        mock_monotonic.side_effect = lambda: now[0]
+        mock_sleep.side_effect = lambda seconds: now.__setitem__(0, now[0] + seconds)
+        scheduler = QuotaScheduler(units_per_second=250)
+
+        for _ in range(5):
+            scheduler.acquire(500)
+        scheduler.acquire(250)
+
+        # 2750 units at 250 per second, less the burst of 250 units
+        self.assertEqual(now[0], 110.0)
+
+    def test_limits_calls_in_flight(self, mock_sleep):
+        scheduler = QuotaScheduler(max_concurrency=2)
+        in_flight, peak = 0, 0
+        lock = threading.Lock()
+        release = threading.Event()
+
+        def call():
+            nonlocal in_flight, peak
+            with lock:
+                in_flight += 1
+                peak = max(peak, in_flight)
+            release.wait(0.05)
+            with lock:
+                in_flight -= 1
+
+        threads = [threading.Thread(target=scheduler.execute, args=(call, 1)) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(peak, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
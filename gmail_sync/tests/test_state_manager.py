@@ -0,0 +1,151 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from state_manager import FirestoreStateManager, InMemoryStateManager, WriteResult
+
+
+def snapshot(id, data):
+    doc = MagicMock(id=id, exists=data is not None)
+    doc.to_dict.return_value = data
+    return doc
+
+
+class FirestoreStateManagerTest(unittest.TestCase):
+
+    @patch('state_manager.FirestoreClient')
+    def setUp(self, mock_client):
+        self.db = mock_client.return_value
+        self.doc_ref = self.db.collection.return_value.document.return_value
+        self.state_store = FirestoreStateManager(collection='gmail_sync', cache_ttl_seconds=60)
+
+    def test_get_document_reads_once(self):
+        self.doc_ref.get.return_value = snapshot('doc', {'historyId': '1'})
+
+        self.assertEqual(self.state_store.get_document_by_id('doc'), {'historyId': '1'})
+        self.assertEqual(self.state_store.get_document_by_id('doc'), {'historyId': '1'})
+        # The second read is served by the cache
+        self.doc_ref.get.assert_called_once_with()
+
+    def test_uncached_read(self):
+        self.doc_ref.get.return_value = snapshot('doc', {'done': False})
+        self.state_store.get_document_by_id('doc')
+
+        self.doc_ref.get.return_value = snapshot('doc', {'done': True})
+        self.assertEqual(self.state_store.get_document_by_id('doc', use_cache=False), {'done': True})
+        self.assertEqual(self.doc_ref.get.call_count, 2)
+        # The fresh copy is cached for later reads
+        self.assertEqual(self.state_store.get_document_by_id('doc'), {'done': True})
+
+    def test_missing_document(self):
+        self.doc_ref.get.return_value = snapshot('doc', None)
+        with self.assertRaises(RuntimeError):
+            self.state_store.get_document_by_id('doc')
+
+    def test_set_document_invalidates_cache(self):
+        self.doc_ref.get.return_value = snapshot('doc', {'historyId': '1'})
+        self.state_store.get_document_by_id('doc')
+
+        self.state_store.set_document_by_id('doc', {'historyId': '2'})
+        self.doc_ref.get.return_value = snapshot('doc', {'historyId': '2'})
+        self.assertEqual(self.state_store.get_document_by_id('doc'), {'historyId': '2'})
+        self.assertEqual(self.doc_ref.get.call_count, 2)
+
+    def test_get_documents_by_ids_reads_in_one_round_trip(self):
+        self.doc_ref.get.return_value = snapshot('cached', {'n': 0})
+        self.state_store.get_document_by_id('cached')
+        self.db.get_all.return_value = [snapshot('b', None), snapshot('a', {'n': 1})]
+
+        documents = self.state_store.get_documents_by_ids(['a', 'cached', 'b'])
+
+        self.assertEqual(documents, {'a': {'n': 1}, 'cached': {'n': 0}, 'b': None})
+        self.db.get_all.assert_called_once()
+        self.assertEqual(len(self.db.get_all.call_args.args[0]), 2)
+
+    def test_set_documents_is_chunked_into_batches(self):
+        commit = self.db.batch.return_value.commit
+        commit.return_value = [MagicMock()]
+
+        result = self.state_store.set_documents({f'doc{i}': {'n': i} for i in range(1201)})
+
+        self.assertEqual(result.status, WriteResult.Status.SUCCESS)
+        self.assertEqual(commit.call_count, 3)
+        self.assertEqual(self.db.batch.return_value.set.call_count, 1201)
+        self.db.batch.return_value.set.assert_called_with(self.doc_ref, {'n': 1200}, merge=False)
+
+    def test_failed_batch(self):
+        self.db.batch.return_value.commit.side_effect = Exception('Deadline exceeded')
+        result = self.state_store.update_documents({'doc': {'n': 1}})
+        self.assertEqual(result.status, WriteResult.Status.FAILED)
+        self.db.batch.return_value.set.assert_called_once_with(self.doc_ref, {'n': 1}, merge=True)
+
+    def test_get_documents_by_prefix_queries_an_id_range(self):
+        collection = self.db.collection.return_value
+        query = collection.where.return_value.where.return_value
+        query.stream.return_value = [snapshot('deferred_a', {'n': 1}),
+                                     snapshot('deferred_b', {'n': 2})]
+
+        documents = self.state_store.get_documents_by_prefix('deferred_')
+
+        self.assertEqual(documents, {'deferred_a': {'n': 1}, 'deferred_b': {'n': 2}})
+        self.assertEqual([c.args[0] for c in collection.document.call_args_list],
+                         ['deferred_', 'deferred_\uf8ff'])
+
+    def test_delete_document_invalidates_cache(self):
+        self.doc_ref.get.return_value = snapshot('doc', {'n': 1})
+        self.state_store.get_document_by_id('doc')
+
+        self.state_store.delete_document_by_id('doc')
+        self.doc_ref.delete.assert_called_once_with()
+        self.doc_ref.get.return_value = snapshot('doc', None)
+        with self.assertRaises(RuntimeError):
+            self.state_store.get_document_by_id('doc')
+
+
+class InMemoryStateManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state_store = InMemoryStateManager({'a': {'n': 1, 'tag': 'x'}})
+
+    def test_set_and_update_documents(self):
+        self.state_store.set_documents({'b': {'n': 2}})
+        self.state_store.update_documents({'a': {'n': 3}, 'c': {'n': 4}})
+        self.assertEqual(self.state_store.get_documents_by_ids(['a', 'b', 'c', 'd']), {
+            'a': {'n': 3, 'tag': 'x'}, 'b': {'n': 2}, 'c': {'n': 4}, 'd': None
+        })
+
+    def test_get_documents_by_prefix_and_delete(self):
+        self.state_store.set_documents({'q_2': {'n': 2}, 'q_1': {'n': 1}, 'qq': {'n': 3}})
+        self.assertEqual(list(self.state_store.get_documents_by_prefix('q_').items()),
+                         [('q_1', {'n': 1}), ('q_2', {'n': 2})])
+        self.state_store.delete_document_by_id('q_1')
+        self.state_store.delete_document_by_id('missing')
+        self.assertEqual(list(self.state_store.get_documents_by_prefix('q_')), ['q_2'])
+
+    def test_transact(self):
+        self.assertEqual(self.state_store.transact('a', lambda doc: {**doc, 'n': doc['n'] + 1}),
+                         {'n': 2, 'tag': 'x'})
+        self.assertEqual(self.state_store.transact('a', lambda doc: None), {'n': 2, 'tag': 'x'})
+        self.assertIsNone(self.state_store.transact('missing', lambda doc: None))
+
+    def test_compare_and_set(self):
+        self.assertFalse(self.state_store.compare_and_set('a', {'n': 2}, {'n': 5}))
+        self.assertTrue(self.state_store.compare_and_set('a', {'n': 1}, {'n': 5}))
+        self.assertFalse(self.state_store.compare_and_set('a', None, {'n': 6}))
+        self.assertTrue(self.state_store.compare_and_set('new', None, {'n': 6}))
+        self.assertEqual(self.state_store.documents['a'], {'n': 5})
+
+    def test_leases(self):
+        self.assertTrue(self.state_store.acquire_lease('lease', 'first', 60))
+        self.assertFalse(self.state_store.acquire_lease('lease', 'second', 60))
+        self.assertTrue(self.state_store.acquire_lease('lease', 'first', 60))
+        self.state_store.release_lease('lease', 'second')
+        self.assertFalse(self.state_store.acquire_lease('lease', 'second', 60))
+        self.state_store.release_lease('lease', 'first')
+        self.assertTrue(self.state_store.acquire_lease('lease', 'second', 60))
+        # An expired lease can be taken over
+        self.state_store.documents['lease']['expiresAt'] = 0
+        self.assertTrue(self.state_store.acquire_lease('lease', 'first', 60))
+
+
+if __name__ == "__main__":
+    unittest.main()
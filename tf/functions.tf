@@ -108,12 +108,17 @@ resource "google_cloudfunctions2_function" "gmail_sync_download" {
   }
 
   service_config {
-    max_instance_count    = 1
-    min_instance_count    = 0
-    available_memory      = "256M"
-    service_account_email = google_service_account.gmail_sync_download_function.email
+    max_instance_count = 1
+    min_instance_count = 0
+    available_memory   = "256M"
+    # Notifications of a burst reach the running instance while it debounces or syncs, so
+    # they are coalesced into its sync. Serving concurrent requests needs a whole CPU.
+    available_cpu                    = "1"
+    max_instance_request_concurrency = var.gmail_sync_download_request_concurrency
+    service_account_email            = google_service_account.gmail_sync_download_function.email
 
     environment_variables = {
+      GMAIL_SYNC_DEBOUNCE_SECONDS    = var.gmail_sync_download_debounce_seconds
       FIRESTORE_COLLECTION           = var.gmail_sync_firestore_collection
       FIRESTORE_DB                   = var.gmail_sync_firestore_db
       SERVICE_ACCOUNT_KEY_FILE       = "/etc/secrets/sa_keys/${google_secret_manager_secret.gmail_sync_sa_key.secret_id}"
@@ -191,3 +196,135 @@ resource "google_cloudfunctions2_function" "gmail_sync_renew_watch" {
     }
   }
 }
+
+resource "google_cloudfunctions2_function" "gmail_sync_accounts" {
+  name     = "gmail-sync-accounts"
+  location = data.google_client_config.this.region
+
+  build_config {
+    runtime     = "python311"
+    entry_point = "sync_accounts_handler"
+    source {
+      storage_source {
+        bucket = google_storage_bucket.bookkeeping.name
+        object = google_storage_bucket_object.gmail_sync_download_function_source.name
+      }
+    }
+  }
+
+  service_config {
+    # Syncs of an account are serialized within an instance only
+    max_instance_count = 1
+    min_instance_count = 0
+    available_memory   = "512M"
+    # Accounts sync on threads of their own
+    available_cpu                    = "1"
+    max_instance_request_concurrency = var.gmail_sync_accounts_request_concurrency
+    service_account_email            = google_service_account.gmail_sync_connect.email
+
+    environment_variables = {
+      GMAIL_SYNC_DEBOUNCE_SECONDS = var.gmail_sync_download_debounce_seconds
+      FIRESTORE_COLLECTION        = var.gmail_sync_firestore_collection
+      FIRESTORE_DB                = var.gmail_sync_firestore_db
+      SERVICE_ACCOUNT_KEY_FILE    = "/etc/secrets/sa_keys/${google_secret_manager_secret.gmail_sync_sa_key.secret_id}"
+      GMAIL_HISTORY_TYPES         = "messageAdded,labelAdded"
+      GMAIL_ACCOUNTS_DOCUMENT_ID  = var.gmail_sync_accounts_document_id
+      GMAIL_ACCOUNTS_MAX_WORKERS  = var.gmail_sync_accounts_max_workers
+
+      DESTINATION_BUCKET_NAME = google_storage_bucket.lakehouse.name
+      DESTINATION_BASE_PATH   = var.attachment_save_path
+    }
+
+    secret_volumes {
+      mount_path = "/etc/secrets/sa_keys"
+      project_id = google_secret_manager_secret.gmail_sync_sa_key.project
+      secret     = google_secret_manager_secret.gmail_sync_sa_key.secret_id
+    }
+  }
+}
+
+resource "google_cloudfunctions2_function" "gmail_sync_deferred_attachments" {
+  name     = "gmail-sync-deferred-attachments"
+  location = data.google_client_config.this.region
+
+  build_config {
+    runtime     = "python311"
+    entry_point = "deferred_attachments_handler"
+    source {
+      storage_source {
+        bucket = google_storage_bucket.bookkeeping.name
+        object = google_storage_bucket_object.gmail_sync_download_function_source.name
+      }
+    }
+  }
+
+  service_config {
+    max_instance_count = 1
+    min_instance_count = 0
+    # Deferred attachments are the ones too large for the download function
+    available_memory      = var.gmail_sync_deferred_attachments_memory
+    timeout_seconds       = 540
+    service_account_email = google_service_account.gmail_sync_connect.email
+
+    environment_variables = {
+      FIRESTORE_COLLECTION           = var.gmail_sync_firestore_collection
+      FIRESTORE_DB                   = var.gmail_sync_firestore_db
+      SERVICE_ACCOUNT_KEY_FILE       = "/etc/secrets/sa_keys/${google_secret_manager_secret.gmail_sync_sa_key.secret_id}"
+      GOOGLE_CREDENTIALS_DOCUMENT_ID = local.google_credentials_document_id
+
+      DESTINATION_BUCKET_NAME = google_storage_bucket.lakehouse.name
+      DESTINATION_BASE_PATH   = var.attachment_save_path
+      SYNC_STATE_DOCUMENT_ID  = local.gmail_sync_state_document_id
+    }
+
+    secret_volumes {
+      mount_path = "/etc/secrets/sa_keys"
+      project_id = google_secret_manager_secret.gmail_sync_sa_key.project
+      secret     = google_secret_manager_secret.gmail_sync_sa_key.secret_id
+    }
+  }
+}
+
+# Invoked on demand with a JSON body of {"query", "after", "before", "shardDays"}
+resource "google_cloudfunctions2_function" "gmail_sync_backfill" {
+  name     = "gmail-sync-backfill"
+  location = data.google_client_config.this.region
+
+  build_config {
+    runtime     = "python311"
+    entry_point = "backfill_handler"
+    source {
+      storage_source {
+        bucket = google_storage_bucket.bookkeeping.name
+        object = google_storage_bucket_object.gmail_sync_download_function_source.name
+      }
+    }
+  }
+
+  service_config {
+    max_instance_count = 1
+    min_instance_count = 0
+    available_memory   = "512M"
+    # A backfill resumes from its checkpoints when run again, but each run should get far
+    timeout_seconds       = 3600
+    service_account_email = google_service_account.gmail_sync_connect.email
+
+    environment_variables = {
+      FIRESTORE_COLLECTION           = var.gmail_sync_firestore_collection
+      FIRESTORE_DB                   = var.gmail_sync_firestore_db
+      SERVICE_ACCOUNT_KEY_FILE       = "/etc/secrets/sa_keys/${google_secret_manager_secret.gmail_sync_sa_key.secret_id}"
+      GOOGLE_CREDENTIALS_DOCUMENT_ID = local.google_credentials_document_id
+      GMAIL_SYNC_MAX_WORKERS         = var.gmail_sync_backfill_max_workers
+
+      DESTINATION_BUCKET_NAME = google_storage_bucket.lakehouse.name
+      DESTINATION_BASE_PATH   = var.attachment_save_path
+      SYNC_STATE_DOCUMENT_ID  = local.gmail_sync_state_document_id
+    }
+
+    secret_volumes {
+      mount_path = "/etc/secrets/sa_keys"
+      project_id = google_secret_manager_secret.gmail_sync_sa_key.project
+      secret     = google_secret_manager_secret.gmail_sync_sa_key.secret_id
+    }
+  }
+}
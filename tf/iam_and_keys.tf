@@ -103,6 +103,76 @@ resource "google_cloudfunctions2_function_iam_binding" "gmail_sync_renew_watch_i
   ]
 }
 
+resource "google_cloud_run_service_iam_binding" "gmail_sync_accounts_invoker" {
+  project  = google_cloudfunctions2_function.gmail_sync_accounts.project
+  location = google_cloudfunctions2_function.gmail_sync_accounts.location
+  service  = google_cloudfunctions2_function.gmail_sync_accounts.name
+  role     = "roles/run.invoker"
+
+  members = [
+    "serviceAccount:${google_service_account.gmail_sync_connect.email}",
+    "serviceAccount:${google_service_account.scheduler.email}",
+  ]
+}
+
+resource "google_cloudfunctions2_function_iam_binding" "gmail_sync_accounts_invoker" {
+  project        = google_cloudfunctions2_function.gmail_sync_accounts.project
+  location       = google_cloudfunctions2_function.gmail_sync_accounts.location
+  cloud_function = google_cloudfunctions2_function.gmail_sync_accounts.name
+  role           = "roles/cloudfunctions.invoker"
+
+  members = [
+    "serviceAccount:${google_service_account.gmail_sync_connect.email}",
+    "serviceAccount:${google_service_account.scheduler.email}",
+  ]
+}
+
+resource "google_cloud_run_service_iam_binding" "gmail_sync_deferred_attachments_invoker" {
+  project  = google_cloudfunctions2_function.gmail_sync_deferred_attachments.project
+  location = google_cloudfunctions2_function.gmail_sync_deferred_attachments.location
+  service  = google_cloudfunctions2_function.gmail_sync_deferred_attachments.name
+  role     = "roles/run.invoker"
+
+  members = [
+    "serviceAccount:${google_service_account.gmail_sync_connect.email}",
+    "serviceAccount:${google_service_account.scheduler.email}",
+  ]
+}
+
+resource "google_cloudfunctions2_function_iam_binding" "gmail_sync_deferred_attachments_invoker" {
+  project        = google_cloudfunctions2_function.gmail_sync_deferred_attachments.project
+  location       = google_cloudfunctions2_function.gmail_sync_deferred_attachments.location
+  cloud_function = google_cloudfunctions2_function.gmail_sync_deferred_attachments.name
+  role           = "roles/cloudfunctions.invoker"
+
+  members = [
+    "serviceAccount:${google_service_account.gmail_sync_connect.email}",
+    "serviceAccount:${google_service_account.scheduler.email}",
+  ]
+}
+
+resource "google_cloud_run_service_iam_binding" "gmail_sync_backfill_invoker" {
+  project  = google_cloudfunctions2_function.gmail_sync_backfill.project
+  location = google_cloudfunctions2_function.gmail_sync_backfill.location
+  service  = google_cloudfunctions2_function.gmail_sync_backfill.name
+  role     = "roles/run.invoker"
+
+  members = [
+    "serviceAccount:${google_service_account.gmail_sync_connect.email}",
+  ]
+}
+
+resource "google_cloudfunctions2_function_iam_binding" "gmail_sync_backfill_invoker" {
+  project        = google_cloudfunctions2_function.gmail_sync_backfill.project
+  location       = google_cloudfunctions2_function.gmail_sync_backfill.location
+  cloud_function = google_cloudfunctions2_function.gmail_sync_backfill.name
+  role           = "roles/cloudfunctions.invoker"
+
+  members = [
+    "serviceAccount:${google_service_account.gmail_sync_connect.email}",
+  ]
+}
+
 resource "google_secret_manager_secret_iam_binding" "gmail_sync_client_secret_sa_binding" {
   project   = data.google_secret_manager_secret.gmail_sync_connect_client_secret.project
   secret_id = data.google_secret_manager_secret.gmail_sync_connect_client_secret.secret_id
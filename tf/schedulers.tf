@@ -33,3 +33,39 @@ resource "google_cloud_scheduler_job" "invoke_gmail_sync_renew_watch" {
     }
   }
 }
+
+resource "google_cloud_scheduler_job" "invoke_gmail_sync_accounts" {
+  name        = "invoke-gmail-sync-accounts"
+  description = "Sync every registered Gmail account"
+  schedule    = var.gmail_sync_accounts_schedule
+  project     = google_cloudfunctions2_function.gmail_sync_accounts.project
+  region      = google_cloudfunctions2_function.gmail_sync_accounts.location
+  time_zone   = var.scheduler_timezone
+
+  http_target {
+    uri         = google_cloudfunctions2_function.gmail_sync_accounts.url
+    http_method = "POST"
+    oidc_token {
+      audience              = "${google_cloudfunctions2_function.gmail_sync_accounts.service_config[0].uri}/"
+      service_account_email = google_service_account.gmail_sync_connect.email
+    }
+  }
+}
+
+resource "google_cloud_scheduler_job" "invoke_gmail_sync_deferred_attachments" {
+  name        = "invoke-gmail-sync-deferred-attachments"
+  description = "Save the Gmail attachments deferred for being oversized"
+  schedule    = var.gmail_sync_deferred_attachments_schedule
+  project     = google_cloudfunctions2_function.gmail_sync_deferred_attachments.project
+  region      = google_cloudfunctions2_function.gmail_sync_deferred_attachments.location
+  time_zone   = var.scheduler_timezone
+
+  http_target {
+    uri         = google_cloudfunctions2_function.gmail_sync_deferred_attachments.url
+    http_method = "POST"
+    oidc_token {
+      audience              = "${google_cloudfunctions2_function.gmail_sync_deferred_attachments.service_config[0].uri}/"
+      service_account_email = google_service_account.gmail_sync_connect.email
+    }
+  }
+}
@@ -55,6 +55,60 @@ variable "gmail_sync_download_label_id" {
   description = "The Gmail label ID used to filter messages for download."
 }
 
+variable "gmail_sync_download_request_concurrency" {
+  type        = number
+  default     = 8
+  description = "Requests the download function serves at once, so notifications of a burst share a sync."
+}
+
+variable "gmail_sync_download_debounce_seconds" {
+  type        = number
+  default     = 2
+  description = "How long the download function waits for the rest of a burst of notifications before syncing. Only useful with a request concurrency above 1."
+}
+
+variable "gmail_sync_accounts_document_id" {
+  type        = string
+  default     = "gmail_accounts"
+  description = "The Firestore document listing the Gmail accounts synced by the accounts function."
+}
+
+variable "gmail_sync_accounts_max_workers" {
+  type        = number
+  default     = 4
+  description = "Gmail accounts the accounts function syncs at once."
+}
+
+variable "gmail_sync_accounts_request_concurrency" {
+  type        = number
+  default     = 8
+  description = "Requests the accounts function serves at once, so notifications of an account share a sync."
+}
+
+variable "gmail_sync_accounts_schedule" {
+  type        = string
+  default     = "*/15 * * * *"
+  description = "The schedule for the Cloud Scheduler job syncing every Gmail account."
+}
+
+variable "gmail_sync_deferred_attachments_schedule" {
+  type        = string
+  default     = "0 */6 * * *"
+  description = "The schedule for the Cloud Scheduler job saving the attachments deferred for being oversized."
+}
+
+variable "gmail_sync_deferred_attachments_memory" {
+  type        = string
+  default     = "1Gi"
+  description = "Memory of the function saving deferred attachments, which are the largest ones."
+}
+
+variable "gmail_sync_backfill_max_workers" {
+  type        = number
+  default     = 4
+  description = "Date shards the backfill function scans at once."
+}
+
 variable "gmail_sync_pubsub_topic_name" {
   type        = string
   description = "The Pub/Sub topic name for Gmail notifications."